@@ -0,0 +1,138 @@
+"""
+per pixel access to a catalogue of Gaia sources
+
+the catalogue is sorted once by source_id, the healpix index being the high bits of the source_id
+the sources of a pixel, or of a range of NESTED pixels, are contiguous. An offsets array (CSR layout)
+gives for each pixel of the index level its first row, so a pixel at this level or any coarser level
+is a slice of the sorted catalogue, without scan nor copy.
+"""
+
+import numpy as np
+import pandas as pd
+
+from gaiapix.gaiapix import sparsepix, sourceIdToPixel
+
+
+def unitVectors(ra,dec):
+    """unit vectors of shape (n,3) of ra,dec in deg"""
+    ra,dec = np.deg2rad(ra),np.deg2rad(dec)
+    return np.stack([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)],axis=-1)
+
+def angularDistance(u,v):
+    """angle in deg between unit vectors, accurate for small angles (chord formula)"""
+    return np.rad2deg(2*np.arcsin(np.minimum(np.linalg.norm(u-v,axis=-1)/2,1)))
+
+def _slices(start,stop):
+    """concatenation of the ranges start:stop"""
+    n = stop-start
+    return np.repeat(start-np.cumsum(n)+n,n)+np.arange(n.sum())
+
+
+class CatalogueIndex :
+    """
+    a catalogue sorted by source_id with the row offsets of each pixel
+    p_df : a pandas data frame with a source_id column
+    sourceId : source index encoding healpix index
+    level : healpix level of the offsets, the offsets take 8*12*4^level bytes
+    ra,dec : position columns in deg used by coneSearch
+    data : the sorted catalogue
+    offsets : array of length 12*4^level+1, the rows of pixel i are offsets[i]:offsets[i+1]
+    """
+
+    def __init__(self,p_df,sourceId='source_id',level=8,ra='ra',dec='dec') :
+        self.level = level
+        self.sourceId = sourceId
+        self.raColumn,self.decColumn = ra,dec
+        self._xyz = None
+        order = np.argsort(p_df[sourceId].values,kind='stable')
+        self.data = p_df.iloc[order]
+        self.ids = self.data[sourceId].values
+        pix = sourceIdToPixel(self.ids,level)
+        self.offsets = np.searchsorted(pix,np.arange(12*4**level+1)).astype(np.int64)
+
+    def __len__(self) :
+        return len(self.data)
+
+    def _offsets(self,level) :
+        """the offsets at a coarser level, a strided view of the index offsets"""
+        if level is None or level == self.level :
+            return self.offsets
+        if level > self.level :
+            raise ValueError("level %d is finer than the index level %d" % (level,self.level))
+        return self.offsets[::4**(self.level-level)]
+
+    def bounds(self,i,level=None) :
+        """
+        first and last+1 rows of the pixels i
+        level : healpix level of i, up to 12, default the index level.
+                Finer than the index level the rows are found by bisection of the source_ids.
+        """
+        i = np.asarray(i,dtype=np.int64)
+        if level is not None and level > self.level :
+            shift = 35+2*(12-level)
+            return (np.searchsorted(self.ids,i << shift),np.searchsorted(self.ids,(i+1) << shift))
+        offsets = self._offsets(level)
+        return offsets[i],offsets[i+1]
+
+    def pixel(self,i,level=None) :
+        """the sources of pixel i, a slice of data"""
+        start,stop = self.bounds(i,level)
+        return self.data.iloc[int(start):int(stop)]
+
+    def pixelRange(self,first,last,level=None) :
+        """the sources of the NESTED pixels first to last included, a slice of data"""
+        start = self.bounds(first,level)[0]
+        stop = self.bounds(last,level)[1]
+        return self.data.iloc[int(start):int(stop)]
+
+    def rows(self,i,level=None) :
+        """the rows of the sources of the pixels i, e.g. the pixels of a query_disc"""
+        return _slices(*self.bounds(np.atleast_1d(i),level))
+
+    def pixels(self,i,level=None) :
+        """the sources of the pixels i"""
+        return self.data.iloc[self.rows(i,level)]
+
+    def counts(self,level=None) :
+        """the number of sources of each pixel, a full healpix map"""
+        return np.diff(self._offsets(level))
+
+    def reduce(self,keyValue,ufunc=np.add,level=None,fill=0.) :
+        """
+        per pixel reduction of a column with ufunc.reduceat over the pixel slices
+        return : a full healpix map, fill for the empty pixels
+        """
+        offsets = self._offsets(level)
+        n = np.diff(offsets)
+        res = np.full(len(n),fill,dtype=float)
+        full = n>0
+        if full.any() :
+            res[full] = ufunc.reduceat(self.data[keyValue].values,offsets[:-1][full])
+        return res
+
+    @property
+    def xyz(self) :
+        """unit vectors of the sorted sources, computed on first use"""
+        if self._xyz is None :
+            self._xyz = unitVectors(self.data[self.raColumn].values,self.data[self.decColumn].values)
+        return self._xyz
+
+    def coneSearch(self,ra,dec,radius) :
+        """
+        sources within radius of many targets, the candidate sources are read from the pixels
+        of each disc at the index level and their distances computed from unit vectors
+        ra,dec : arrays of target positions in deg
+        radius : search radius in deg, scalar or per target
+        return : pandas DataFrame in long form sorted by target and distance with the columns
+                 target (index of the target), source_id, row (position in data) and distance in deg
+        """
+        ra,dec,radius = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v,dtype=float)) for v in (ra,dec,radius)))
+        discs = sparsepix(self.level).query_discs(ra,dec,radius)
+        start,stop = self.bounds(discs.hp.values)
+        rows = _slices(start,stop)
+        target = np.repeat(discs.target.values,stop-start)
+        distance = angularDistance(self.xyz[rows],unitVectors(ra,dec)[target])
+        keep = distance<=radius[target]
+        res = pd.DataFrame({'target':target[keep],self.sourceId:self.ids[rows[keep]],
+                            'row':rows[keep],'distance':distance[keep]})
+        return res.sort_values(['target','distance'],kind='stable').reset_index(drop=True)
@@ -0,0 +1,238 @@
+"""
+positional crossmatch of two catalogues partitioned by healpix pixel
+
+the first catalogue is split in NESTED pixels at the partition level, each source in one partition.
+The second catalogue is split in the same pixels with a margin: a source is also copied in the
+partitions whose pixel is within the match radius, found from the neighbours of its pixel at a finer
+margin level. The partitions are then matched independently with a KD tree on unit vectors
+(chord distances, without wrap-around nor pole distortion), in a process pool.
+
+crossmatchPartitioned matches catalogues too large for memory, already split in partitions files
+(e.g. the outputs of lens.simulation): the margins are extracted in a first pass reading each
+partition once, then each worker reads one partition of both catalogues. The tasks are submitted
+to the pool a few at a time (boundedMap) so that only the partitions in flight are in memory.
+"""
+
+import os
+import itertools
+from collections import deque
+import numpy as np
+import pandas as pd
+import healpy as hp
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor
+
+from gaiapix.catalogue import unitVectors
+
+# the margin pixels must be larger than MARGIN_FACTOR times the match radius
+MARGIN_FACTOR = 2.
+MAX_LEVEL = 29
+
+
+def marginLevel(level,radius):
+    """finest level not finer than MAX_LEVEL and not coarser than level with pixels large enough for radius in deg"""
+    if radius <= 0 :
+        return level
+    resol = np.rad2deg(hp.nside2resol(2**np.arange(MAX_LEVEL+1)))
+    ok = np.flatnonzero(resol >= MARGIN_FACTOR*radius)
+    if len(ok)==0 or ok[-1] < level :
+        raise ValueError("radius %g deg is too large for the partition level %d" % (radius,level))
+    return int(ok[-1])
+
+def partitionRows(ra,dec,level,radius=0.):
+    """
+    rows of each partition
+    ra,dec : positions in deg
+    level : healpix level of the partitions
+    radius : margin in deg, 0 for a partition without margin
+    return : pix the sorted non empty partitions, rows the rows sorted by partition,
+             starts the first entry of each partition in rows (CSR layout, of length len(pix)+1)
+    """
+    ra = np.asarray(ra,dtype=float)
+    dec = np.asarray(dec,dtype=float)
+    fine = marginLevel(level,radius)
+    shift = 2*(fine-level)
+    f = hp.ang2pix(2**fine,ra,dec,nest=True,lonlat=True)
+    if radius <= 0 :
+        rows = np.arange(len(f))
+        parts = f >> shift
+    else :
+        # the partitions of a fine pixel and of its neighbours (-1 when missing), without duplicates
+        uf,inv = np.unique(f,return_inverse=True)
+        cand = np.vstack([uf[None,:],hp.get_all_neighbours(2**fine,uf,nest=True)]).T >> shift
+        cand.sort(axis=1)
+        valid = np.c_[np.ones(len(uf),dtype=bool),cand[:,1:]!=cand[:,:-1]] & (cand>=0)
+        rows = np.repeat(np.arange(len(f)),valid.sum(axis=1)[inv])
+        parts = cand[inv][valid[inv]]
+    order = np.argsort(parts,kind='stable')
+    rows,parts = rows[order],parts[order]
+    starts = np.flatnonzero(np.r_[True,parts[1:]!=parts[:-1]]) if len(parts) else np.zeros(0,dtype=np.int64)
+    return parts[starts],rows,np.r_[starts,len(parts)]
+
+def _batch(task):
+    function,tasks = task
+    return [function(t) for t in tasks]
+
+def boundedMap(function,tasks,max_workers=None,chunksize=1,maxPending=None):
+    """
+    map of a process pool yielding the results in order, the tasks being consumed lazily
+    max_workers : number of processes, 1 to run in the current process
+    chunksize : number of tasks sent at once to a process
+    maxPending : maximum number of chunks submitted and not yet yielded, default twice the processes
+    """
+    if max_workers == 1 :
+        yield from map(function,tasks)
+        return
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool :
+        maxPending = maxPending or 2*(max_workers or os.cpu_count() or 1)
+        pending = deque()
+        while True :
+            chunk = list(itertools.islice(tasks,chunksize))
+            if chunk :
+                pending.append(pool.submit(_batch,(function,chunk)))
+            if pending and (len(pending) >= maxPending or not chunk) :
+                yield from pending.popleft().result()
+            elif not chunk :
+                return
+
+def matchPartition(xyz1,xyz2,chord):
+    """
+    all the pairs of unit vectors within chord
+    return : the local indices i in xyz1, j in xyz2 and the chord distances
+    """
+    if len(xyz1)==0 or len(xyz2)==0 :
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64),np.zeros(0)
+    pairs = cKDTree(xyz1).sparse_distance_matrix(cKDTree(xyz2),chord,output_type='ndarray')
+    return pairs['i'].astype(np.int64),pairs['j'].astype(np.int64),pairs['v']
+
+def _matchTask(task):
+    return matchPartition(*task)
+
+def _tasks(xyz1,xyz2,part1,part2,chord):
+    """the unit vectors of the partitions present in both catalogues, built lazily"""
+    for r1,r2 in zip(part1,part2) :
+        yield xyz1[r1],xyz2[r2],chord
+
+
+def crossmatch(ra1,dec1,ra2,dec2,radius,level=5,max_workers=None,chunksize=16,maxPending=None,best=False):
+    """
+    positional crossmatch of two in-memory catalogues, see crossmatchPartitioned for larger ones
+    ra1,dec1 : positions in deg of the first catalogue, e.g. the targets
+    ra2,dec2 : positions in deg of the second catalogue, e.g. Gaia sources
+    radius : match radius in deg
+    level : healpix level of the partitions, each partition being a task
+    max_workers : number of processes, 1 to match in the current process
+    chunksize, maxPending : see boundedMap
+    best : to keep only the nearest match of each source of the first catalogue
+    return : pandas DataFrame sorted by row1 and distance with the columns
+             row1, row2 (positions in the catalogues), distance in deg and best (nearest match of row1)
+    """
+    pix1,rows1,starts1 = partitionRows(ra1,dec1,level)
+    pix2,rows2,starts2 = partitionRows(ra2,dec2,level,radius)
+    common,k1,k2 = np.intersect1d(pix1,pix2,return_indices=True)
+    part1 = [rows1[starts1[k]:starts1[k+1]] for k in k1]
+    part2 = [rows2[starts2[k]:starts2[k+1]] for k in k2]
+    xyz1 = unitVectors(ra1,dec1)
+    xyz2 = unitVectors(ra2,dec2)
+    chord = 2*np.sin(np.deg2rad(radius)/2)
+    tasks = _tasks(xyz1,xyz2,part1,part2,chord)
+    res = _collect(zip(part1,part2,boundedMap(_matchTask,tasks,max_workers,chunksize,maxPending)))
+    return res[res.best].reset_index(drop=True) if best else res
+
+def _collect(results,names=('row1','row2')):
+    """
+    global rows of the partition matches, sorted by row1 and distance
+    results : iterable of the rows (or ids) of the partitions and of their local matches
+    """
+    i,j,d = [np.zeros(0,dtype=np.int64)],[np.zeros(0,dtype=np.int64)],[np.zeros(0)]
+    for r1,r2,(li,lj,ld) in results :
+        i.append(r1[li])
+        j.append(r2[lj])
+        d.append(ld)
+    i,j,d = np.concatenate(i),np.concatenate(j),np.rad2deg(2*np.arcsin(np.concatenate(d)/2))
+    order = np.lexsort((j,d,i))
+    i,j,d = i[order],j[order],d[order]
+    return pd.DataFrame({names[0]:i,names[1]:j,'distance':d,'best':np.r_[True,i[1:]!=i[:-1]][:len(i)]})
+
+
+def _readFiles(files,read,columns):
+    return pd.concat([read(f)[list(columns)] for f in files],ignore_index=True)
+
+def _marginTask(task):
+    """the margin rows of one partition for each of its neighbour partitions in targets"""
+    p,files,read,columns,ra,dec,level,radius,targets = task
+    p_df = _readFiles(files,read,columns)
+    pix,rows,starts = partitionRows(p_df[ra].values,p_df[dec].values,level,radius)
+    return {q:p_df.iloc[rows[starts[k]:starts[k+1]]] for k,q in enumerate(pix) if q != p and q in targets}
+
+def partitionMargins(files,level,radius,read,columns,ra='ra',dec='dec',targets=None,max_workers=None,maxPending=None):
+    """
+    margins of partitioned files in one pass, each partition being read once
+    files : dict pixel -> list of files of the partitions at level
+    radius : margin in deg, smaller than the partition pixels
+    read : function reading one file as a pandas data frame (picklable)
+    columns : columns kept in the margins, with ra and dec
+    targets : partitions whose margin is wanted, default all the partitions of files
+    return : dict pixel -> DataFrame of the rows of the other partitions within radius of the pixel
+    """
+    targets = set(files) if targets is None else set(targets)
+    tasks = ((p,f,read,columns,ra,dec,level,radius,targets) for p,f in files.items())
+    margins = {}
+    for res in boundedMap(_marginTask,tasks,max_workers,maxPending=maxPending) :
+        for q,m in res.items() :
+            margins.setdefault(q,[]).append(m)
+    return {q:pd.concat(m,ignore_index=True) for q,m in margins.items()}
+
+def _matchFiles(task):
+    """match one partition of the first catalogue with the partition and margin of the second"""
+    files1,files2,margin,read,columns1,columns2,chord = task
+    c1 = _readFiles(files1,read,columns1)
+    c2 = pd.concat([_readFiles(files2,read,columns2)]+([] if margin is None else [margin]),ignore_index=True)
+    return c1[columns1[0]].values,c2[columns2[0]].values,\
+           matchPartition(unitVectors(c1[columns1[1]].values,c1[columns1[2]].values),
+                          unitVectors(c2[columns2[1]].values,c2[columns2[2]].values),chord)
+
+def crossmatchPartitioned(files1,files2,level,radius,read,ids=('source_id','source_id'),ra=('ra','ra'),
+                          dec=('dec','dec'),max_workers=None,maxPending=None,best=False):
+    """
+    out of core positional crossmatch of two partitioned catalogues, only the partitions in flight
+    and the margins being in memory
+    files1,files2 : dict pixel -> list of files of the partitions at level, e.g. lens.simulation.partitions
+    level : healpix level of the partitions of both catalogues, e.g. lens.simulation.partitionLevel
+    radius : match radius in deg, smaller than the partition pixels
+    read : function reading one file as a pandas data frame (picklable), e.g. lens.simulation.readPartition
+    ids,ra,dec : id and position columns of the first and second catalogues
+    max_workers, maxPending : see boundedMap
+    best : to keep only the nearest match of each source of the first catalogue
+    return : pandas DataFrame sorted by id1 and distance with the columns id1, id2, distance in deg and best
+    """
+    columns1 = (ids[0],ra[0],dec[0])
+    columns2 = (ids[1],ra[1],dec[1])
+    margins = partitionMargins(files2,level,radius,read,columns2,ra[1],dec[1],files1,max_workers,maxPending)
+    pix = [p for p in sorted(files1) if p in files2 or p in margins]
+    chord = 2*np.sin(np.deg2rad(radius)/2)
+    tasks = ((files1[p],files2.get(p,[]),margins.get(p),read,columns1,columns2,chord) for p in pix)
+    res = _collect(boundedMap(_matchFiles,tasks,max_workers,maxPending=maxPending),('id1','id2'))
+    return res[res.best].reset_index(drop=True) if best else res
+
+def crossmatchFrames(left,right,radius,ra=('ra','ra'),dec=('dec','dec'),suffixes=('','_2'),best=True,**kwargs):
+    """
+    crossmatch of two catalogues as pandas data frames
+    left,right : pandas data frames with positions in deg
+    ra,dec : position columns of left and right
+    suffixes : added to the overlapping column names of left and right
+    best : to keep only the nearest right source of each left source
+    kwargs : passed to crossmatch
+    return : the matched rows of left and right side by side with a distance column in arcsec
+    """
+    m = crossmatch(left[ra[0]].values,left[dec[0]].values,right[ra[1]].values,right[dec[1]].values,
+                   radius,best=best,**kwargs)
+    a = left.iloc[m.row1.values].reset_index(drop=True)
+    b = right.iloc[m.row2.values].reset_index(drop=True)
+    common = a.columns.intersection(b.columns)
+    a = a.rename(columns={c:c+suffixes[0] for c in common})
+    b = b.rename(columns={c:c+suffixes[1] for c in common})
+    res = pd.concat([a,b],axis=1)
+    res['distance'] = m.distance.values*3600
+    return res
@@ -2,16 +2,33 @@
 to plot healpix maps using data from a pandas DataFrame with at leat one column source_id that follows Gaia data model specification
 """
 
+import os
+import json
 import numpy as np
 import matplotlib as mp
 import matplotlib.pyplot as plt
 import pandas as pd
 import healpy as hp
 
+from gaiapix.stats import PixelStats, groupReduce, groupMedian, groupStatistics
+
+MAP_VERSION = 1
+
+def sourceIdToPixel(sourceId,level=12):
+    """exact nested healpix index at level of Gaia source_ids, source_id >> (35+2*(12-level))"""
+    return np.right_shift(np.asarray(sourceId,dtype=np.int64),35+2*(12-level))
+
+def _openArrays(path,names,mmap):
+    return {n:np.load(os.path.join(path,n+'.npy'),mmap_mode='r' if mmap else None) for n in names}
+
 class gaiapix :
     nnn=34359738368
     
     def __init__(self,i) :
+        self._setLevel(i)
+        self.values= np.zeros(self.shape)
+        
+    def _setLevel(self,i) :
         healpix_expression='source_id/34359738368'
         healpix_max_level=12
         self.healpix_level=i
@@ -21,69 +38,211 @@ class gaiapix :
         self.s = 34359738368*self.scaling 
         self.expr = "%s/%s" % (healpix_expression, self.scaling)
         self.shape = hp.nside2npix(self.NSIDE)
-        self.values= np.zeros(self.shape)
         
         
-    def setValues(self,p_df,sourceId='source_id',keyValue='val',mode='median'):
+    def setValues(self,p_df,sourceId='source_id',keyValue='val',mode='median',errorSuffix='_error'):
         """
-        computes and set the healpix value to the median per pixel
+        computes and set the healpix value to a statistic per pixel
         p_df : a pandas data frame
         sourceId : source index encoding healpix index
         keyValue : values column name
+        mode : count, mean, median, std, wmean (weighted by the inverse variance of keyValue+errorSuffix)
+               or a quantile given as a float
+        the pixels without a finite statistic (e.g. std of a single source) are masked as the empty ones
         """
-        if mode=='median' :
-            g = p_df.groupby(np.int32(p_df[sourceId]/self.s))[keyValue].median()
-        else :
-            g = p_df.groupby(np.int32(p_df[sourceId]/self.s))[keyValue].median()
-        values= np.zeros(self.shape)
-        for i,v in zip(g.index,g.values):
-            values[i]=v
-        
-        self.values = hp.ma(values,badval=0)
+        t = self.setTable(p_df,[keyValue],[mode],sourceId=sourceId,errorSuffix=errorSuffix)
+        v = t['%s_%s' % (keyValue,mode)].values
+        keep = np.isfinite(v)
+        self._setMap(t.index.values[keep],v[keep],masked=True)
+        self.stat = '%s_%s' % (keyValue,mode)
         
+    def setTable(self,p_df,keyValues,stats=('count','mean','median','std'),sourceId='source_id',hp=None,errorSuffix='_error'):
+        """
+        computes several statistics of several columns per pixel in one pass, see gaiapix.stats.groupStatistics
+        p_df : a pandas data frame
+        keyValues : values column names
+        stats : list of count, mean, median, std, wmean or quantiles given as floats
+        sourceId : source index encoding healpix index
+        hp : healpix index column (nested) used instead of sourceId
+        errorSuffix : the error column of x used by wmean is x+errorSuffix
+        return : pandas DataFrame indexed by pixel with <column>_<stat> columns, also kept in table
+        """
+        i = p_df[hp].values if hp is not None else self.pixelIndex(p_df[sourceId].values)
+        errors = {k:p_df[k+errorSuffix].values for k in keyValues if k+errorSuffix in p_df} if 'wmean' in stats else None
+        self.table = groupStatistics(i,{k:p_df[k].values for k in keyValues},stats,errors)
+        return self.table
+
+    def getMap(self,column):
+        """the full healpix map of one column of table, 0 for the empty pixels"""
+        values = np.zeros(self.shape)
+        values[self.table.index.values] = self.table[column].values
+        return values
+
+    def _setMap(self,pixels,data,masked=False):
+        values = np.zeros(self.shape)
+        values[pixels] = data
+        self.values = hp.ma(values,badval=0) if masked else values
             
     def setHpValues(self,p_df,hp='hp',keyValue='val',grp=True):
         """
         computes and set the healpix value to the median per pixel
         p_df : a pandas data frame
-        sourceId : source index encoding healpix index
+        hp : healpix index (nested)
         keyValue : values column name
+        grp : if False the values are set as given, the last one being kept for duplicated pixels
         """
         if grp :
-            g = p_df.groupby(np.int32(p_df[hp]))[keyValue].median()
-            self.values= np.zeros(self.shape)
-            for i,v in zip(g.index,g.values):
-                self.values[i]=v
+            self._setMap(*groupMedian(p_df[hp].values,p_df[keyValue].values))
         else :
-            self.values= np.zeros(self.shape)
-            for i,v in zip(p_df[hp].values,p_df[keyValue].values) :
-                self.values[i]=v
+            self._setMap(np.asarray(p_df[hp].values,dtype=np.int64),p_df[keyValue].values)
+        self.stat = keyValue+'_median' if grp else keyValue
           
             
     def setCount(self,p_df,sourceId='source_id'):
         """
-        computes and set the healpix value to the median per pixel
+        computes and set the healpix value to the number of sources per pixel
         p_df : a pandas data frame
         sourceId : source index encoding healpix index
-        keyValue : values column name
         """
-        g = p_df.groupby(np.int32(p_df[sourceId]/self.s))[sourceId].count()
-        
-        self.values= np.zeros(self.shape)
-        for i,v in zip(g.index,g.values):
-            self.values[i]=v
+        self.values = np.bincount(self.pixelIndex(p_df[sourceId].values),minlength=self.shape).astype(float)
+        self.stat = 'count'
             
     def setHpCount(self,p_df,hp='hp'):
         """
         p_df : a pandas data frame
         hp : healpix index (nested) 
         """
-        g = p_df.groupby(np.int32(p_df[hp]))[hp].count()
-        
-        self.values= np.zeros(self.shape)
-        for i,v in zip(g.index,g.values):
-            self.values[i]=v
+        self.values = np.bincount(np.asarray(p_df[hp].values,dtype=np.int64),minlength=self.shape).astype(float)
+        self.stat = 'count'
             
+    def pixelIndex(self,sourceId):
+        """healpix index at this level of Gaia source_ids"""
+        return sourceIdToPixel(sourceId,self.healpix_level)
+
+    def accumulate(self,chunks,sourceId='source_id',keyValue='val',stats=None,range=None,bins=256,hpIndex=None):
+        """
+        ingest data chunk by chunk into mergeable per pixel statistics, e.g.
+        stats = hpX.accumulate(pd.read_csv(path,chunksize=10**6),keyValue='phot_g_mean_mag',range=(3,21))
+        chunks : a pandas data frame or an iterable of data frames
+        sourceId : source index encoding healpix index
+        keyValue : values column name
+        stats : PixelStats to update, e.g. the merged result of other processes, a new one if None
+        range, bins : quantile sketch definition of a new PixelStats, no median without range
+        hpIndex : healpix index column (nested, this level) used instead of sourceId
+        return : the updated PixelStats
+        """
+        if stats is None :
+            stats = PixelStats(range,bins)
+        if isinstance(chunks,pd.DataFrame) :
+            chunks = [chunks]
+        for p_df in chunks :
+            i = p_df[hpIndex].values if hpIndex is not None else self.pixelIndex(p_df[sourceId].values)
+            stats.add(i,p_df[keyValue].values)
+        return stats
+
+    def setStats(self,stats,stat='median'):
+        """
+        set the healpix values to a statistic of accumulated PixelStats, 0 for the empty pixels
+        stat : count, sum, mean, std, min, max, median or a quantile given as a float
+        """
+        values = stats.dense(self.shape,stat)
+        self.values = values if stat=='count' else hp.ma(values,badval=0)
+        self.stat = str(stat)
+
+    def _meta(self,kind,stat,masked,columns):
+        return {'version':MAP_VERSION,'kind':kind,'ordering':'NESTED','level':self.healpix_level,
+                'nside':self.NSIDE,'stat':stat,'masked':bool(masked),'columns':columns}
+
+    def save(self,path,stat=None):
+        """
+        save the map in the directory path: values.npy, the table columns if any and meta.json
+        with the NESTED ordering, the level and the statistic names, see gaiapix.load
+        stat : name of the statistic of values, default the one set by setValues, setCount or setStats
+        """
+        os.makedirs(path,exist_ok=True)
+        np.save(os.path.join(path,'values.npy'),np.ma.getdata(self.values))
+        columns = self._saveTable(path)
+        meta = self._meta('dense',stat or getattr(self,'stat',None),np.ma.isMaskedArray(self.values),columns)
+        with open(os.path.join(path,'meta.json'),'w') as fp :
+            json.dump(meta,fp)
+
+    def _saveTable(self,path):
+        table = getattr(self,'table',None)
+        if table is None :
+            return []
+        np.save(os.path.join(path,'table_hp.npy'),table.index.values.astype(np.int64))
+        for c in table.columns :
+            np.save(os.path.join(path,'table_%s.npy' % c),table[c].values)
+        return list(table.columns)
+
+    def _loadTable(self,path,meta,mmap):
+        if meta['columns'] :
+            a = _openArrays(path,['table_hp']+['table_'+c for c in meta['columns']],mmap)
+            self.table = pd.DataFrame({c:a['table_'+c] for c in meta['columns']},
+                                      index=pd.Index(a['table_hp'],name='hp'),copy=False)
+
+    @staticmethod
+    def load(path,mmap=True):
+        """
+        open a map saved by save, as a gaiapix or a sparsepix
+        mmap : memory map the arrays, nothing is read before the pixels are touched and the
+               processes opening the same map share the pages. The values are read only and never masked.
+        """
+        with open(os.path.join(path,'meta.json')) as fp :
+            meta = json.load(fp)
+        if meta.get('version') != MAP_VERSION or meta.get('ordering') != 'NESTED' :
+            raise ValueError("unsupported healpix map %s" % path)
+        cls = sparsepix if meta['kind']=='sparse' else gaiapix
+        res = cls.__new__(cls)
+        res._setLevel(meta['level'])
+        res._loadArrays(path,meta,mmap)
+        res._loadTable(path,meta,mmap)
+        res.stat = meta['stat']
+        res.path = path
+        return res
+
+    def _loadArrays(self,path,meta,mmap):
+        self.values = _openArrays(path,['values'],mmap)['values']
+        if not mmap and meta['masked'] :
+            self.values = hp.ma(self.values,badval=0)
+
+    def saveFits(self,path,stat=None,overwrite=False):
+        """
+        save the map as a healpix FITS file (NESTED), the level and the statistic are in the header
+        the empty pixels of a sparsepix are written as a partial map
+        """
+        hp.write_map(path,self._fitsValues(),nest=True,partial=isinstance(self,sparsepix),overwrite=overwrite,
+                     column_names=[str(stat or getattr(self,'stat',None) or 'values')[:68]],
+                     extra_header=[('HPXLEVEL',self.healpix_level)])
+
+    def _fitsValues(self):
+        return np.ma.getdata(self.values)
+
+    @staticmethod
+    def loadFits(path):
+        """read a healpix FITS map written by saveFits (or any NESTED or RING full sky map) as a gaiapix"""
+        values,header = hp.read_map(path,nest=True,h=True)
+        header = dict(header)
+        res = gaiapix.__new__(gaiapix)
+        res._setLevel(int(header.get('HPXLEVEL',hp.nside2order(hp.npix2nside(len(values))))))
+        res.values = np.where(values==hp.UNSEEN,0.,values)
+        res.stat = header.get('TTYPE1')
+        return res
+
+    def __getstate__(self):
+        # memory mapped arrays are pickled as their file name so that the worker processes map the same file
+        state = self.__dict__.copy()
+        for k,v in state.items() :
+            if isinstance(v,np.memmap) and v.filename is not None :
+                state[k] = ('__memmap__',v.filename)
+        return state
+
+    def __setstate__(self,state):
+        for k,v in state.items() :
+            if isinstance(v,tuple) and len(v)==2 and v[0]=='__memmap__' :
+                state[k] = np.load(v[1],mmap_mode='r')
+        self.__dict__.update(state)
+
     def plot(self,title='',unit='',coord='C', sub=None,vmin=-100,vmax=100,cmap=plt.cm.bwr,norm=None):
         """
         moll view plot
@@ -113,14 +272,34 @@ class gaiapix :
         dec_deg = (np.pi/2 - theta) / np.pi *180
         return [ra_deg,dec_deg,0.0]
     
-    def query_disc(self,ra,dec,r):
-        phi = ra
-        theta = np.pi/2-dec
-        iL = hp.query_disc(self.NSIDE,hp.ang2vec(theta,phi),r,nest=True)
-        thetaL, phiL = hp.pix2ang(hpE.NSIDE,iL,nest=True)
-        x = iL,phiL-ra,np.pi/2-thetaL-dec,self.values[iL]
-        return pd.DataFrame((np.array(x)).transpose()
-             ,columns=['hp','r','d','n'])
+    def lookup(self,i):
+        """values of the pixels i"""
+        return np.asarray(self.values)[i]
+
+    def query_disc(self,ra,dec,r,inclusive=False):
+        """
+        pixels within r of one centre with their offsets and values
+        ra,dec,r : centre and radius in deg
+        inclusive : to include the pixels overlapping the disc, not only those with their centre in it
+        return : pandas DataFrame hp, r and d the ra and dec offsets of the pixel centres in deg, n the pixel values
+        """
+        iL = hp.query_disc(self.NSIDE,hp.ang2vec(ra,dec,lonlat=True),np.deg2rad(r),inclusive=inclusive,nest=True)
+        raL,decL = self.pixel2angle(iL)
+        return pd.DataFrame({'hp':iL,'r':np.mod(raL-ra+180,360)-180,'d':decL-dec,'n':self.lookup(iL)})
+
+    def query_discs(self,ra,dec,r,inclusive=True):
+        """
+        pixels of many discs
+        ra,dec,r : arrays of centres and radii in deg (r can be a scalar)
+        inclusive : to include the pixels overlapping the discs, as needed to find the sources in the discs
+        return : pandas DataFrame target (index of the disc), hp in long form
+        """
+        ra,dec,r = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v,dtype=float)) for v in (ra,dec,r)))
+        vec = hp.ang2vec(ra,dec,lonlat=True).reshape(-1,3)
+        pix = [hp.query_disc(self.NSIDE,v,np.deg2rad(x),inclusive=inclusive,nest=True) for v,x in zip(vec,r)]
+        n = np.array([len(p) for p in pix],dtype=np.int64)
+        return pd.DataFrame({'target':np.repeat(np.arange(len(pix)),n),
+                             'hp':np.concatenate(pix) if len(pix) else np.zeros(0,dtype=np.int64)})
     
     def zoom(self,rot,f,
              extent = (1,10,1,10),
@@ -142,4 +321,163 @@ class gaiapix :
     def angle2pixel(self,ra_deg,dec_deg):
         phi = ra_deg * np.pi / 180
         theta = np.pi/2 - (dec_deg * np.pi/180)
-        return hp.ang2pix(self.NSIDE,theta,phi,nest=True)
\ No newline at end of file
+        return hp.ang2pix(self.NSIDE,theta,phi,nest=True)
+
+
+
+class sparsepix(gaiapix) :
+    """
+    a gaiapix map holding only the occupied pixels: the sorted pixel indices and their values,
+    memory scales with the occupied pixels. The full map is built lazily when values is used, e.g. to plot.
+    pixels : sorted nested healpix indices
+    data : values of the pixels
+    """
+
+    def __init__(self,i) :
+        self._setLevel(i)
+        self._set(np.zeros(0,dtype=np.int64),np.zeros(0))
+
+    def _set(self,pixels,data,masked=True) :
+        self.pixels = np.asarray(pixels,dtype=np.int64)
+        self.data = np.asarray(data,dtype=float)
+        self.masked = masked
+        self._dense = None
+
+    @property
+    def values(self) :
+        """the full healpix map, built on first use"""
+        if self._dense is None :
+            values = np.zeros(self.shape)
+            values[self.pixels] = self.data
+            self._dense = hp.ma(values,badval=0) if self.masked else values
+        return self._dense
+
+    @values.setter
+    def values(self,values) :
+        values = np.asarray(values)
+        i = np.flatnonzero(values)
+        self._set(i,values[i])
+
+    def __len__(self) :
+        return len(self.pixels)
+
+    def save(self,path,stat=None):
+        """save the map in the directory path: pixels.npy, data.npy, the table columns if any and meta.json"""
+        os.makedirs(path,exist_ok=True)
+        np.save(os.path.join(path,'pixels.npy'),self.pixels)
+        np.save(os.path.join(path,'data.npy'),self.data)
+        columns = self._saveTable(path)
+        meta = self._meta('sparse',stat or getattr(self,'stat',None),self.masked,columns)
+        with open(os.path.join(path,'meta.json'),'w') as fp :
+            json.dump(meta,fp)
+
+    def _loadArrays(self,path,meta,mmap):
+        a = _openArrays(path,['pixels','data'],mmap)
+        self.pixels,self.data = a['pixels'],a['data']
+        self.masked = meta['masked']
+        self._dense = None
+
+    def _fitsValues(self):
+        values = np.full(self.shape,hp.UNSEEN)
+        values[self.pixels] = self.data
+        return values
+
+    def lookup(self,i) :
+        """values of the pixels i, 0 for the empty pixels"""
+        i = np.asarray(i,dtype=np.int64)
+        k = np.minimum(np.searchsorted(self.pixels,i),max(len(self.pixels)-1,0))
+        found = (self.pixels[k]==i) if len(self.pixels) else np.zeros(i.shape,dtype=bool)
+        return np.where(found,self.data[k] if len(self.pixels) else 0.,0.)
+
+    def setValues(self,p_df,sourceId='source_id',keyValue='val',mode='median',errorSuffix='_error'):
+        """
+        computes and set the pixel values to a statistic per pixel, see gaiapix.setValues
+        """
+        t = self.setTable(p_df,[keyValue],[mode],sourceId=sourceId,errorSuffix=errorSuffix)
+        v = t['%s_%s' % (keyValue,mode)].values
+        keep = np.isfinite(v)
+        self._set(t.index.values[keep],v[keep])
+        self.stat = '%s_%s' % (keyValue,mode)
+
+    def getMap(self,column):
+        """a sparsepix of one column of table"""
+        res = sparsepix(self.healpix_level)
+        res._set(self.table.index.values,self.table[column].values)
+        return res
+
+    def setHpValues(self,p_df,hp='hp',keyValue='val',grp=True):
+        """
+        computes and set the healpix value to the median per pixel
+        p_df : a pandas data frame
+        hp : healpix index (nested)
+        keyValue : values column name
+        grp : if False the values are set as given, the last one being kept for duplicated pixels
+        """
+        if grp :
+            self._set(*groupMedian(p_df[hp].values,p_df[keyValue].values),masked=False)
+        else :
+            i = np.asarray(p_df[hp].values,dtype=np.int64)
+            pix,last = np.unique(i[::-1],return_index=True)
+            self._set(pix,p_df[keyValue].values[::-1][last],masked=False)
+        self.stat = keyValue+'_median' if grp else keyValue
+
+    def setCount(self,p_df,sourceId='source_id'):
+        """
+        computes and set the healpix value to the number of sources per pixel
+        p_df : a pandas data frame
+        sourceId : source index encoding healpix index
+        """
+        i = self.pixelIndex(p_df[sourceId].values)
+        self._set(*groupReduce(i,np.ones(len(i))),masked=False)
+        self.stat = 'count'
+
+    def setHpCount(self,p_df,hp='hp'):
+        """
+        p_df : a pandas data frame
+        hp : healpix index (nested) 
+        """
+        i = p_df[hp].values
+        self._set(*groupReduce(i,np.ones(len(i))),masked=False)
+        self.stat = 'count'
+
+    def setStats(self,stats,stat='median'):
+        """set the pixel values to a statistic of accumulated PixelStats, see gaiapix.setStats"""
+        self._set(stats.pixels,stats.statistic(stat),masked=stat!='count')
+        self.stat = str(stat)
+
+
+
+class pyramid :
+    """
+    multi-resolution healpix statistics: the data are grouped once at the finest level,
+    every coarser NESTED level is derived from the finest one by bit shift of the pixel index
+    stats : PixelStats at level, e.g. from gaiapix(12).accumulate
+    level : healpix level of stats
+    """
+
+    def __init__(self,stats,level=12) :
+        self.level = level
+        self.stats = {level:stats}
+
+    @classmethod
+    def fromData(cls,chunks,sourceId='source_id',keyValue='val',range=None,bins=256,level=12):
+        """build the pyramid of Gaia data, see gaiapix.accumulate"""
+        return cls(gaiapix(level).accumulate(chunks,sourceId,keyValue,range=range,bins=bins),level)
+
+    def getStats(self,level):
+        """PixelStats at level, derived from the closest finer level already computed"""
+        if level > self.level :
+            raise ValueError("level %d is finer than the pyramid level %d" % (level,self.level))
+        if level not in self.stats :
+            finer = min(l for l in self.stats if l > level)
+            self.stats[level] = self.stats[finer].degrade(finer-level)
+        return self.stats[level]
+
+    def map(self,level,stat='median'):
+        """a gaiapix map of the statistic stat at level"""
+        res = gaiapix(level)
+        res.setStats(self.getStats(level),stat)
+        return res
+
+    def __getitem__(self,level):
+        return self.map(level,'median' if self.stats[self.level].hasSketch else 'count')
@@ -0,0 +1,292 @@
+"""
+mergeable per pixel statistics for out-of-core healpix maps
+
+the state is kept for the touched pixels only, as arrays sorted by pixel index:
+count, sum, sum of squares, min, max and a fixed bin histogram used as quantile sketch.
+Chunks are reduced with a sort and ufunc.reduceat, and two states computed on different
+chunks or processes are merged exactly (the sums up to floating point rounding).
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def groupStarts(pixels):
+    """
+    sort the pixel indices
+    return : order the sorting permutation, the unique pixels and the start of each group in the sorted array
+    """
+    order = np.argsort(pixels)
+    p = pixels[order]
+    starts = np.flatnonzero(np.r_[True,p[1:]!=p[:-1]]) if len(p) else np.zeros(0,dtype=np.int64)
+    return order,p[starts],starts
+
+def groupReduce(pixels,values,ufunc=np.add):
+    """
+    reduce values by pixel with ufunc
+    return : the sorted unique pixels and the reduced values
+    """
+    pixels = np.asarray(pixels,dtype=np.int64)
+    values = np.asarray(values)
+    order,pix,starts = groupStarts(pixels)
+    if len(pix)==0 :
+        return pix,values[:0]
+    return pix,ufunc.reduceat(values[order],starts)
+
+def groupMedian(pixels,values):
+    """
+    median of values by pixel as pandas groupby median, nan values are ignored
+    return : the sorted unique pixels and the medians
+    """
+    t = groupStatistics(pixels,{'v':values},['median'])
+    return t.index.values,t.v_median.values
+
+def groupStatistics(pixels,values,stats=('count','mean','median','std'),errors=None):
+    """
+    several statistics of several columns by pixel, the pixels being sorted once
+    pixels : healpix index of each row
+    values : dict column name -> values, nan values are ignored
+    stats : list of count, mean, median, std, wmean or quantiles given as floats (linear interpolation as pandas)
+    errors : dict column name -> errors used by wmean, the inverse-variance weighted mean
+             (rows with a non positive or nan error are ignored, nan without errors),
+             its error is given in <column>_wmean_error
+    return : pandas DataFrame indexed by the sorted unique pixels (hp) with <column>_<stat> columns
+    """
+    pixels = np.asarray(pixels,dtype=np.int64)
+    order,pix,starts = groupStarts(pixels)
+    size = np.diff(np.r_[starts,len(pixels)])
+    group = np.repeat(np.arange(len(pix)),size)
+    res = {}
+    if len(pix)==0 :
+        # reduceat does not accept empty arrays, evaluate the statistics on a dummy empty pixel
+        res = groupStatistics([0],{name:[np.nan] for name in values},stats,
+                              None if errors is None else {name:[np.nan] for name in errors})
+        return res.iloc[:0]
+    for name,v in values.items() :
+        v = np.asarray(v,dtype=float)[order]
+        ok = ~np.isnan(v)
+        vz = np.where(ok,v,0.)
+        n = np.add.reduceat(ok.astype(np.int64),starts)
+        with np.errstate(invalid='ignore',divide='ignore') :
+            mean = np.add.reduceat(vz,starts)/n
+            sorted_ = None
+            for stat in stats :
+                key = '%s_%s' % (name,stat)
+                if stat == 'count' :
+                    res[key] = n
+                elif stat == 'mean' :
+                    res[key] = mean
+                elif stat == 'std' :
+                    dev = np.where(ok,v-mean[group],0.)
+                    res[key] = np.sqrt(np.add.reduceat(dev*dev,starts)/(n-1))
+                elif stat == 'wmean' :
+                    e = np.asarray(errors[name],dtype=float)[order] if errors and name in errors else np.full(len(v),np.nan)
+                    good = ok & (e>0)
+                    w = np.where(good,1/np.where(good,e,1)**2,0.)
+                    sw = np.add.reduceat(w,starts)
+                    res[key] = np.add.reduceat(w*vz,starts)/sw
+                    res[key+'_error'] = 1/np.sqrt(sw)
+                else :
+                    q = 0.5 if stat == 'median' else float(stat)
+                    if sorted_ is None :
+                        # sort by (pixel, rank of the value), nan values are ranked last
+                        rank = np.empty(len(v),dtype=np.int64)
+                        rank[np.argsort(v)] = np.arange(len(v))
+                        sorted_ = v[np.argsort(group*len(v)+rank)]
+                    pos = starts+q*np.maximum(n-1,0)
+                    lo = np.floor(pos).astype(np.int64)
+                    hi = np.ceil(pos).astype(np.int64)
+                    r = sorted_[lo]+(pos-lo)*(sorted_[hi]-sorted_[lo])
+                    res[key] = np.where(n>0,r,np.nan)
+    return pd.DataFrame(res,index=pd.Index(pix,name='hp'))
+
+
+class PixelStats :
+    """
+    mergeable statistics of the values falling in each pixel
+    the quantile sketch is a sparse histogram: the sorted keys pixel*(bins+2)+bin of the non empty bins and their counts
+    range : (min,max) of the quantile sketch, values outside fall in an underflow and an overflow bin
+    bins : number of bins of the quantile sketch, no sketch (no median nor quantiles) when range is None
+    """
+
+    def __init__(self,range=None,bins=256) :
+        self.range = None if range is None else (float(range[0]),float(range[1]))
+        self.bins = None if range is None else int(bins)
+        self._set(np.zeros(0,dtype=np.int64))
+
+    def _set(self,pixels) :
+        """reset the state to empty statistics on pixels"""
+        n = len(pixels)
+        self.pixels = pixels
+        self.count = np.zeros(n,dtype=np.int64)
+        self.sum = np.zeros(n)
+        self.sumsq = np.zeros(n)
+        self.min = np.full(n,np.inf)
+        self.max = np.full(n,-np.inf)
+        self.sketchKey = np.zeros(0,dtype=np.int64)
+        self.sketchCount = np.zeros(0,dtype=np.int64)
+        return self
+
+    def __len__(self) :
+        return len(self.pixels)
+
+    @property
+    def hasSketch(self) :
+        return self.range is not None
+
+    def _new(self,pixels) :
+        res = PixelStats(self.range,self.bins if self.hasSketch else 256)
+        return res._set(pixels)
+
+    def binIndex(self,values) :
+        """sketch bin of values, 0 and bins+1 being the underflow and overflow bins"""
+        lo,hi = self.range
+        b = np.floor((values-lo)/(hi-lo)*self.bins).astype(np.int64)+1
+        return np.clip(b,0,self.bins+1)
+
+    def _setSketch(self,keys,counts) :
+        """set the sketch from unsorted keys with duplicates"""
+        pix,c = groupReduce(keys,counts)
+        self.sketchKey,self.sketchCount = pix,c
+
+    @classmethod
+    def fromValues(cls,pixels,values,range=None,bins=256) :
+        """the statistics of one chunk, nan values are ignored"""
+        res = cls(range,bins)
+        res.add(pixels,values)
+        return res
+
+    def add(self,pixels,values) :
+        """ingest a chunk of values and their pixel indices, nan values are ignored"""
+        pixels = np.asarray(pixels,dtype=np.int64).ravel()
+        values = np.asarray(values,dtype=float).ravel()
+        ok = ~np.isnan(values)
+        pixels,values = pixels[ok],values[ok]
+        order,pix,starts = groupStarts(pixels)
+        if len(pix)==0 :
+            return self
+        v = values[order]
+        chunk = self._new(pix)
+        chunk.count = np.diff(np.r_[starts,len(v)])
+        chunk.sum = np.add.reduceat(v,starts)
+        chunk.sumsq = np.add.reduceat(v*v,starts)
+        chunk.min = np.minimum.reduceat(v,starts)
+        chunk.max = np.maximum.reduceat(v,starts)
+        if self.hasSketch :
+            chunk._setSketch(pixels[order]*(self.bins+2)+self.binIndex(v),np.ones(len(v),dtype=np.int64))
+        return self.merge(chunk)
+
+    def merge(self,other) :
+        """add the state of other, computed on other values with the same sketch definition"""
+        if (self.range,self.bins) != (other.range,other.bins) :
+            raise ValueError("cannot merge statistics with different sketches")
+        res = self._new(np.union1d(self.pixels,other.pixels))
+        for s in (self,other) :
+            i = np.searchsorted(res.pixels,s.pixels)
+            res.count[i] += s.count
+            res.sum[i] += s.sum
+            res.sumsq[i] += s.sumsq
+            res.min[i] = np.minimum(res.min[i],s.min)
+            res.max[i] = np.maximum(res.max[i],s.max)
+        if self.hasSketch :
+            res._setSketch(np.r_[self.sketchKey,other.sketchKey],np.r_[self.sketchCount,other.sketchCount])
+        self.__dict__.update(res.__dict__)
+        return self
+
+    def degrade(self,n) :
+        """
+        the statistics n NESTED levels coarser, the parent pixel being pixel >> 2n
+        the sorted pixels stay sorted so each parent is reduced from a contiguous run
+        """
+        pix = self.pixels >> (2*n)
+        starts = np.flatnonzero(np.r_[True,pix[1:]!=pix[:-1]]) if len(pix) else np.zeros(0,dtype=np.int64)
+        res = self._new(pix[starts])
+        if len(pix)==0 :
+            return res
+        res.count = np.add.reduceat(self.count,starts)
+        res.sum = np.add.reduceat(self.sum,starts)
+        res.sumsq = np.add.reduceat(self.sumsq,starts)
+        res.min = np.minimum.reduceat(self.min,starts)
+        res.max = np.maximum.reduceat(self.max,starts)
+        if self.hasSketch :
+            b = self.bins+2
+            res._setSketch(((self.sketchKey//b) >> (2*n))*b+self.sketchKey%b,self.sketchCount)
+        return res
+
+    def __iadd__(self,other) :
+        return self.merge(other)
+
+    def __add__(self,other) :
+        return self._new(self.pixels[:0]).merge(self).merge(other)
+
+    def histogram(self) :
+        """the sketch as a dense array of shape (len(pixels),bins+2)"""
+        b = self.bins+2
+        res = np.zeros((len(self.pixels),b),dtype=np.int64)
+        res[np.searchsorted(self.pixels,self.sketchKey//b),self.sketchKey%b] = self.sketchCount
+        return res
+
+    def mean(self) :
+        return self.sum/self.count
+
+    def std(self) :
+        """sample standard deviation, nan for the pixels with one value"""
+        with np.errstate(invalid='ignore',divide='ignore') :
+            var = (self.sumsq-self.sum*self.sum/self.count)/(self.count-1)
+        return np.sqrt(np.maximum(var,0))
+
+    def _orderStatistic(self,rank) :
+        """
+        estimate of the value of the given rank (0 for the min) of each pixel, the values of a bin
+        being evenly spread over the bin, exact for the min and the max
+        """
+        lo,hi = self.range
+        width = (hi-lo)/self.bins
+        b = self.bins+2
+        # the keys are sorted by pixel, each pixel owning a contiguous run of non empty bins
+        row = np.searchsorted(self.pixels,self.sketchKey//b)
+        starts = np.flatnonzero(np.r_[True,row[1:]!=row[:-1]])
+        cum = np.cumsum(self.sketchCount)
+        cum = cum - np.repeat(cum[starts]-self.sketchCount[starts],np.diff(np.r_[starts,len(cum)]))
+        below = np.add.reduceat((cum<=rank[row]).astype(np.int64),starts)
+        entry = np.minimum(starts+below,np.r_[starts[1:],len(cum)]-1)
+        k = self.sketchKey[entry]%b
+        inBin = self.sketchCount[entry]
+        frac = (rank-(cum[entry]-inBin)+0.5)/inBin
+        left = np.maximum(np.where(k==0,self.min,lo+(k-1)*width),self.min)
+        right = np.minimum(np.where(k==self.bins+1,self.max,lo+k*width),self.max)
+        value = np.clip(left+frac*(right-left),self.min,self.max)
+        return np.where(rank<=0,self.min,np.where(rank>=self.count-1,self.max,value))
+
+    def quantile(self,q) :
+        """
+        approximate quantile from the sketch: linear interpolation between the order statistics
+        around the rank q*(count-1), as numpy.quantile, each order statistic being estimated within
+        its bin (see _orderStatistic) so the error is at most the bin width inside range
+        """
+        if not self.hasSketch :
+            raise ValueError("no quantile sketch, set a range")
+        if len(self.pixels)==0 :
+            return np.zeros(0)
+        h = q*(self.count-1)
+        below = np.floor(h)
+        v0 = self._orderStatistic(below)
+        v1 = self._orderStatistic(np.minimum(below+1,self.count-1))
+        return v0+(h-below)*(v1-v0)
+
+    def median(self) :
+        return self.quantile(0.5)
+
+    def statistic(self,stat) :
+        """one of count, sum, mean, std, min, max, median or a quantile given as a float"""
+        if isinstance(stat,float) :
+            return self.quantile(stat)
+        if stat in ('count','sum','sumsq','min','max') :
+            return getattr(self,stat)
+        return getattr(self,stat)()
+
+    def dense(self,npix,stat='mean',fill=0.) :
+        """return the statistic as a full healpix map of npix pixels"""
+        res = np.full(npix,fill,dtype=float)
+        res[self.pixels] = self.statistic(stat)
+        return res
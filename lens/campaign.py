@@ -0,0 +1,230 @@
+"""
+MCMC campaign over a catalogue of lensed QSOs
+
+each system (e.g. the images of data/LQSO_CASTLES5.csv grouped by qso_name, or a simulated set)
+is fitted by its own emcee sampler in a process pool. Chains are checkpointed to disk
+chunk by chunk so that an interrupted campaign resumes where it stopped,
+and a summary table of the posteriors is written at the end.
+"""
+
+import os
+import json
+import zlib
+import warnings
+import numpy as np
+import pandas as pd
+import emcee
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import lens.sis.inference as sisI
+import lens.sis.inferencePM as sisPM
+import lens.sie.inference as sieI
+import lens.sie.inferencePM as siePM
+from lens.data import LensData, detectionProbability
+
+# model name : (walker-vectorized log10 posterior, parameter names)
+MODELS = {
+    'sis' : (sisI.log_posterior_batch,"xS,yS,gS,bL,xL,yL".split(',')),
+    'sis_pm' : (sisPM.log_posterior_pm_batch,"xS,yS,dxS,dyS,gS,bL,xL,yL".split(',')),
+    'sie' : (sieI.log_posterior_batch,"xS,yS,gS,bL,qL,xL,yL,thetaL".split(',')),
+    'sie_pm' : (siePM.log_posterior_pm_batch,"xS,yS,dxS,dyS,gS,bL,qL,xL,yL,thetaL".split(',')),
+}
+
+
+def defaultModel(data):
+    """
+    model and image matching suited to the image count of a system: the SIS for doubles,
+    the SIE for the other systems with the best assignment of the images,
+    and a detection function when the SIE cannot produce the observed image count
+    return : model, match, detection
+    """
+    pm = '_pm' if data.d == 5 else ''
+    if len(data) == 2 :
+        return 'sis'+pm,False,None
+    return 'sie'+pm,True,(None if len(data) == 4 else detectionProbability)
+
+def lnPosterior(models,posterior,data,match=False,detection=None):
+    """
+    natural log posterior given to emcee, the posteriors being in log10
+    (emcee fed with a log10 posterior samples it at a temperature of log(10))
+    """
+    return posterior(models,data,match,detection)*np.log(10)
+
+
+def systemsFromFrame(p_df,key='qso_name',pm=True,minImages=2,magError=0.01):
+    """
+    group a catalogue of images into systems
+    p_df : a pandas data frame with Gaia columns, see LensData.fromFrame
+    key : column identifying the system of each image
+    pm : to keep the proper motions, images without proper motion are dropped
+    minImages : systems with less images are ignored
+    return : dict name -> LensData
+    """
+    if pm :
+        p_df = p_df.dropna(subset=['pmra','pmdec','pmra_error','pmdec_error'])
+    res = {}
+    for name,g in p_df.groupby(key) :
+        if len(g) >= minImages :
+            res[str(name)] = LensData.fromFrame(g,pm=pm,magError=magError)
+    return res
+
+def loadSystems(path='data/LQSO_CASTLES5.csv',**kwargs):
+    """return the systems of a csv catalogue of images, kwargs are passed to systemsFromFrame"""
+    return systemsFromFrame(pd.read_csv(path),**kwargs)
+
+
+def initWalkers(model,data,nwalkers,rng,ntry=100,match=False,detection=None):
+    """
+    draw initial walkers with a finite posterior around a rough guess deduced from the data:
+    lens at the images barycentre, Einstein radius half the largest image separation
+    match, detection : image matching of the posterior, see LensData.logpdf
+    """
+    posterior,names = MODELS[model]
+    xy = data.obs[:,:2]
+    sep = np.max(np.hypot(*(xy[:,None,:]-xy[None,:,:]).transpose(2,0,1)))
+    guess = {'xS':0.,'yS':0.,'dxS':0.,'dyS':0.,'gS':np.min(data.obs[:,-1])+0.5,'bL':max(sep/2,0.1),
+             'qL':0.6,'xL':np.mean(xy[:,0]),'yL':np.mean(xy[:,1]),'thetaL':np.pi/2}
+    scale = {'xS':0.05,'yS':0.05,'dxS':0.1,'dyS':0.1,'gS':0.1,'bL':0.05*guess['bL'],
+             'qL':0.2,'xL':0.02,'yL':0.02,'thetaL':1.}
+    mean = np.array([guess[n] for n in names])
+    sigma = np.array([scale[n] for n in names])
+    walkers = mean + sigma*rng.normal(size=(nwalkers,len(names)))
+    for i in range(ntry) :
+        bad = ~np.isfinite(posterior(walkers,data,match,detection))
+        if not bad.any() :
+            return walkers
+        walkers[bad] = mean + sigma*rng.normal(size=(bad.sum(),len(names)))
+    if bad.all() :
+        raise ValueError("no initial walker with a finite posterior")
+    # duplicate the valid walkers with a small jitter
+    good = walkers[~bad]
+    walkers[bad] = good[rng.integers(len(good),size=bad.sum())] + 1e-4*sigma*rng.normal(size=(bad.sum(),len(names)))
+    return walkers
+
+
+def _systemDir(outdir,name):
+    return os.path.join(outdir,name.replace(os.sep,'_'))
+
+def _loadChunks(path):
+    """return the checkpointed chain and log posterior of one system"""
+    state = os.path.join(path,'state.json')
+    if not os.path.exists(state) :
+        return None,None,0
+    with open(state) as fp :
+        nchunks = json.load(fp)['nchunks']
+    chain = [np.load(os.path.join(path,'chain_%05d.npy' % k)) for k in range(nchunks)]
+    lnprob = [np.load(os.path.join(path,'lnprob_%05d.npy' % k)) for k in range(nchunks)]
+    return np.concatenate(chain),np.concatenate(lnprob),nchunks
+
+def _writeState(path,state):
+    """write state.json through a temporary file so that an interruption leaves the previous state"""
+    tmp = os.path.join(path,'state.json.tmp')
+    with open(tmp,'w') as fp :
+        json.dump(state,fp)
+    os.replace(tmp,os.path.join(path,'state.json'))
+
+def _detectionName(detection):
+    """json name of a detection function, None without detection"""
+    if detection is None :
+        return None
+    return '%s.%s' % (getattr(detection,'__module__',''),getattr(detection,'__qualname__',repr(detection)))
+
+def _checkState(path,settings):
+    """raise ValueError when the checkpoints of path were run with other settings (model, nwalkers, seed, match, detection)"""
+    state = os.path.join(path,'state.json')
+    if not os.path.exists(state) :
+        return
+    with open(state) as fp :
+        state = json.load(fp)
+    for key,value in settings.items() :
+        if state.get(key) != value :
+            raise ValueError("%s: checkpoint %s %s differs from %s" % (path,key,state.get(key),value))
+
+def runSystem(name,data,model=None,outdir='campaign',nwalkers=50,nsteps=2000,checkpoint=200,seed=0,
+              match=None,detection=None):
+    """
+    sample the posterior of one system, resuming from its checkpoints
+    the chain is saved every checkpoint steps as chain_k.npy (checkpoint,nwalkers,ndim) and lnprob_k.npy (log10)
+    model : one of MODELS, default (with match and detection) from defaultModel
+    match, detection : image matching, see LensData.logpdf, default False and None for an explicit model
+    return : name, the chain of shape (nsteps,nwalkers,ndim) and the log10 posterior of shape (nsteps,nwalkers)
+    """
+    if model is None :
+        model,defaultMatch,defaultDetection = defaultModel(data)
+        match = defaultMatch if match is None else match
+        detection = defaultDetection if detection is None else detection
+    posterior,names = MODELS[model]
+    match = bool(match)
+    path = _systemDir(outdir,name)
+    os.makedirs(path,exist_ok=True)
+    settings = {'model':model,'nwalkers':nwalkers,'seed':seed,'match':match,'detection':_detectionName(detection)}
+    _checkState(path,settings)
+    chain,lnprob,nchunks = _loadChunks(path)
+    done = 0 if chain is None else len(chain)
+    key = [seed,zlib.crc32(name.encode())]
+    if done == 0 :
+        state = initWalkers(model,data,nwalkers,np.random.default_rng(key),match=match,detection=detection)
+    else :
+        state = chain[-1]
+    sampler = emcee.EnsembleSampler(nwalkers,len(names),lnPosterior,args=[posterior,data,match,detection],
+                                    vectorize=True)
+    while done < nsteps :
+        n = min(checkpoint,nsteps-done)
+        # one random stream per chunk so that a resumed run is reproducible
+        chunkSeed = np.random.SeedSequence(key+[nchunks]).generate_state(1)[0]
+        sampler.random_state = np.random.RandomState(chunkSeed).get_state()
+        sampler.reset()
+        state = sampler.run_mcmc(state,n,progress=False).coords
+        np.save(os.path.join(path,'chain_%05d.npy' % nchunks),sampler.get_chain())
+        np.save(os.path.join(path,'lnprob_%05d.npy' % nchunks),sampler.get_log_prob()/np.log(10))
+        nchunks += 1
+        done += n
+        _writeState(path,dict(settings,nchunks=nchunks,nsteps=done))
+    chain,lnprob,nchunks = _loadChunks(path)
+    return name,chain,lnprob
+
+
+def summarize(name,chain,lnprob,model,data,discard=0.5):
+    """one row of the summary table: image count, acceptance, median and 68% interval of each parameter"""
+    posterior,names = MODELS[model]
+    kept = chain[int(discard*len(chain)):].reshape(-1,chain.shape[-1])
+    row = {'qso_name':name,'model':model,'nimages':len(data),'nsteps':len(chain),
+           'acceptance':np.mean(np.any(np.diff(chain,axis=0)!=0,axis=-1)) if len(chain)>1 else np.nan,
+           'lnprob_max':np.max(lnprob)}
+    for i,n in enumerate(names) :
+        p16,p50,p84 = np.percentile(kept[:,i],[16,50,84])
+        row[n] = p50
+        row[n+'_p16'] = p16
+        row[n+'_p84'] = p84
+    return row
+
+def runCampaign(systems,model=None,outdir='campaign',nwalkers=50,nsteps=2000,checkpoint=200,
+                seed=0,max_workers=None,discard=0.5):
+    """
+    fit every system in a process pool, one sampler per system
+    systems : dict name -> LensData, e.g. from loadSystems
+    model : one of MODELS, default per system from defaultModel
+    outdir : directory of the checkpoints and of summary.csv
+    max_workers : number of processes, default the number of cores
+    return : the summary table as a pandas DataFrame
+    """
+    os.makedirs(outdir,exist_ok=True)
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool :
+        jobs = {pool.submit(runSystem,name,data,model,outdir,nwalkers,nsteps,checkpoint,seed):name
+                for name,data in systems.items()}
+        for job in as_completed(jobs) :
+            name = jobs[job]
+            try :
+                name,chain,lnprob = job.result()
+            except Exception as e :
+                # one failed system, e.g. a singular covariance, does not stop the campaign
+                warnings.warn("%s: %s: %s" % (name,type(e).__name__,e))
+                continue
+            used = defaultModel(systems[name])[0] if model is None else model
+            rows.append(summarize(name,chain,lnprob,used,systems[name],discard))
+    res = pd.DataFrame(rows)
+    if len(res) :
+        res = res.sort_values('qso_name').reset_index(drop=True)
+    res.to_csv(os.path.join(outdir,'summary.csv'),index=False)
+    return res
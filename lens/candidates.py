@@ -0,0 +1,155 @@
+"""
+catalogue wide search of lensed QSO candidates: groups of sources within a few arcsec
+
+friends of friends: two sources closer than the linking length belong to the same group.
+The sky is cut in NESTED healpix partitions linked independently in a process pool, each with
+a margin of the sources of the neighbour partitions within the linking length, so that the pairs
+across pixel edges are found. A pair is kept by the partition of its smallest id only.
+The workers return the linked pairs, a small fraction of the catalogue, and the groups are
+stitched as the connected components of the pairs.
+
+the partitioned output of lens.simulation (outdir/hp<level>=<pixel>/part-*) is processed one
+partition at a time, the margins being extracted first in one pass over the partitions
+(see gaiapix.crossmatch.partitionMargins), so memory is bounded by the partitions in flight.
+"""
+
+import numpy as np
+import pandas as pd
+import healpy as hp
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+import astropy.units as u
+
+from gaiapix.catalogue import unitVectors, angularDistance
+from gaiapix.crossmatch import partitionRows, partitionMargins, boundedMap
+from lens.simulation import partitions, partitionLevel, readPartition
+
+# largest number of pairs of sources whose separation is computed at once by stitchGroups
+MAX_BLOCK = 2**22
+
+
+def linkPartition(ids,ra,dec,core,link=5.):
+    """
+    pairs of sources closer than link in one partition
+    ids,ra,dec : source ids and positions in deg of the partition and of its margin
+    core : True for the sources of the partition, False for the margin
+    link : linking length in arcsec
+    return : edges DataFrame id1<id2 and separation in arcsec, the pairs whose id1 is in the core,
+             nodes DataFrame id, ra, dec of the sources of these pairs
+    """
+    ids = np.asarray(ids)
+    xyz = unitVectors(ra,dec)
+    chord = 2*np.sin(np.deg2rad(link*u.arcsec.to(u.deg))/2)
+    pairs = cKDTree(xyz).query_pairs(chord,output_type='ndarray') if len(xyz) else np.zeros((0,2),dtype=np.int64)
+    i,j = pairs[:,0],pairs[:,1]
+    swap = ids[j]<ids[i]
+    i,j = np.where(swap,j,i),np.where(swap,i,j)
+    keep = core[i]
+    i,j = i[keep],j[keep]
+    edges = pd.DataFrame({'id1':ids[i],'id2':ids[j],'separation':angularDistance(xyz[i],xyz[j])*3600})
+    k = np.unique(np.r_[i,j])
+    nodes = pd.DataFrame({'id':ids[k],'ra':np.asarray(ra)[k],'dec':np.asarray(dec)[k]})
+    return edges,nodes
+
+def _linkTask(task):
+    return linkPartition(*task)
+
+def _linkFiles(task):
+    """link one partition of a partitioned output given its files and its margin"""
+    coreFiles,margin,link,idColumn,ra,dec = task
+    core = pd.concat([readPartition(f)[[idColumn,ra,dec]] for f in coreFiles],ignore_index=True)
+    n = len(core)
+    if margin is not None :
+        core = pd.concat([core,margin],ignore_index=True)
+    return linkPartition(core[idColumn].values,core[ra].values,core[dec].values,np.arange(len(core))<n,link)
+
+def _maxSeparation(xyz,starts,size):
+    """largest separation in arcsec of each group, the groups of equal size at once by blocks of MAX_BLOCK pairs"""
+    maxSep = np.zeros(len(size))
+    for s in np.unique(size) :
+        g = np.flatnonzero(size==s)
+        step = max(1,MAX_BLOCK//(s*s))
+        rows = max(1,MAX_BLOCK//s)
+        for k in range(0,len(g),step) :
+            v = xyz[starts[g[k:k+step]][:,None]+np.arange(s)]
+            sep = np.zeros(len(v))
+            for r in range(0,s,rows) :
+                sep = np.maximum(sep,np.max(angularDistance(v[:,r:r+rows,None,:],v[:,None,:,:]),axis=(1,2)))
+            maxSep[g[k:k+step]] = sep*3600
+    return maxSep
+
+
+def stitchGroups(results,idColumn='source_id'):
+    """
+    groups of the linked pairs of all the partitions
+    results : iterable of (edges,nodes) returned by linkPartition
+    idColumn : name of the id column of the output
+    return : members DataFrame sorted by group with the columns <idColumn>, group, n, ra, dec,
+             groups DataFrame indexed by group with n, ra, dec (mean direction), minSeparation
+             and maxSeparation in arcsec
+    """
+    results = list(results)
+    if not results :
+        empty = np.zeros(0,dtype=np.int64)
+        results = [linkPartition(empty,empty,empty,empty.astype(bool))]
+    edges = pd.concat([e for e,n in results],ignore_index=True)
+    nodes = pd.concat([n for e,n in results],ignore_index=True)
+    nodes = nodes.drop_duplicates('id').sort_values('id')
+    ids = nodes.id.values
+    m = len(edges)
+    i,j = np.searchsorted(ids,edges.id1.values),np.searchsorted(ids,edges.id2.values)
+    graph = coo_matrix((np.ones(m),(i,j)),shape=(len(ids),len(ids)))
+    ngroups,labels = connected_components(graph,directed=False)
+    members = pd.DataFrame({idColumn:ids,'group':labels,
+                            'ra':nodes.ra.values,'dec':nodes.dec.values})
+    members = members.sort_values(['group',idColumn],kind='stable').reset_index(drop=True)
+    size = np.bincount(labels,minlength=ngroups)
+    members['n'] = size[members.group.values]
+    # mean direction and largest separation of each group, the groups of equal size at once
+    xyz = unitVectors(members.ra.values,members.dec.values)
+    starts = np.r_[0,np.cumsum(size)[:-1]]
+    mean = np.add.reduceat(xyz,starts,axis=0) if ngroups else np.zeros((0,3))
+    mean /= np.linalg.norm(mean,axis=-1,keepdims=True)
+    maxSep = _maxSeparation(xyz,starts,size)
+    minSep = np.full(ngroups,np.inf)
+    np.minimum.at(minSep,labels[i],edges.separation.values)
+    groups = pd.DataFrame({'n':size,'ra':np.rad2deg(np.arctan2(mean[:,1],mean[:,0]))%360,
+                           'dec':np.rad2deg(np.arcsin(np.clip(mean[:,2],-1,1))),
+                           'minSeparation':minSep,'maxSeparation':maxSep},index=pd.Index(np.arange(ngroups),name='group'))
+    return members[[idColumn,'group','n','ra','dec']],groups
+
+
+def friendsOfFriends(ra,dec,link=5.,ids=None,level=5,max_workers=None,chunksize=16,maxPending=None):
+    """
+    groups of sources of an in-memory catalogue, the sources without a friend are not returned
+    ra,dec : positions in deg
+    link : linking length in arcsec
+    ids : source ids, default the row numbers (the id column is then named row)
+    level : healpix level of the partitions
+    max_workers : number of processes, 1 to link in the current process
+    chunksize, maxPending : see gaiapix.crossmatch.boundedMap
+    return : members, groups, see stitchGroups
+    """
+    ra = np.asarray(ra,dtype=float)
+    dec = np.asarray(dec,dtype=float)
+    idColumn = 'row' if ids is None else 'source_id'
+    ids = np.arange(len(ra)) if ids is None else np.asarray(ids)
+    corePix = hp.ang2pix(2**level,ra,dec,nest=True,lonlat=True)
+    pix,rows,starts = partitionRows(ra,dec,level,link*u.arcsec.to(u.deg))
+    tasks = ((ids[r],ra[r],dec[r],corePix[r]==p,link) for p,r in
+             ((p,rows[starts[k]:starts[k+1]]) for k,p in enumerate(pix)))
+    return stitchGroups(boundedMap(_linkTask,tasks,max_workers,chunksize,maxPending),idColumn)
+
+def friendsOfFriendsPartitioned(outdir,link=5.,idColumn='source_id',ra='ra',dec='dec',max_workers=None,maxPending=None):
+    """
+    groups of sources of a partitioned output of lens.simulation, see friendsOfFriends
+    the margins of all the partitions are extracted in one pass, each partition being read once,
+    then each task reads one partition; the linking length must be smaller than the partition pixels
+    """
+    files = partitions(outdir)
+    level = partitionLevel(outdir)
+    margins = partitionMargins(files,level,link*u.arcsec.to(u.deg),readPartition,(idColumn,ra,dec),ra,dec,
+                               max_workers=max_workers,maxPending=maxPending)
+    tasks = ((coreFiles,margins.get(p),link,idColumn,ra,dec) for p,coreFiles in files.items())
+    return stitchGroups(boundedMap(_linkFiles,tasks,max_workers,maxPending=maxPending),idColumn)
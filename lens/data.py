@@ -0,0 +1,219 @@
+"""
+Observed images of a lensed QSO with precomputed Gaussian likelihood terms
+
+the data of one system are compiled once: the covariance of each image is factorized
+and the whitening matrices and log normalisations are kept, so that scoring model images
+is a few array operations. Used by the SIS and SIE likelihoods.
+"""
+
+import itertools
+import numpy as np
+import astropy.units as u
+
+# Gaia columns of the image astrometry and their correlation columns
+GAIA_POSITION = ['ra','dec']
+GAIA_PM = ['pmra','pmdec']
+
+
+class LensData :
+    """
+    observed images of one lensed system
+    obs : observed values of shape (nobs,d), d=3 (x,y,g) or d=5 (x,y,dx,dy,g)
+    cov : covariances of shape (nobs,d,d)
+    """
+
+    def __init__(self,obs,cov) :
+        self.obs = np.asarray(obs,dtype=float)
+        self.cov = np.asarray(cov,dtype=float)
+        self.nobs,self.d = self.obs.shape
+        chol = np.linalg.cholesky(self.cov)
+        self.whiten = np.linalg.inv(chol)
+        self.prec = np.matmul(np.swapaxes(self.whiten,-1,-2),self.whiten)
+        self.lognorms = -np.sum(np.log(np.diagonal(chol,axis1=-2,axis2=-1)),axis=-1) - 0.5*self.d*np.log(2*np.pi)
+        self.lognorm = np.sum(self.lognorms)
+
+    def __len__(self) :
+        return self.nobs
+
+    @classmethod
+    def fromArray(cls,data) :
+        """
+        data : array of shape (nobs,2d) with the values followed by their errors,
+        i.e. x,y,g,xe,ye,ge or x,y,dx,dy,g,xe,ye,dxe,dye,ge as used in the notebooks
+        """
+        data = np.atleast_2d(np.asarray(data,dtype=float))
+        d = data.shape[1]//2
+        cov = np.zeros((data.shape[0],d,d))
+        cov[:,np.arange(d),np.arange(d)] = np.power(data[:,d:],2)
+        return cls(data[:,:d],cov)
+
+    @classmethod
+    def fromFrame(cls,p_df,center=None,pm=True,magError=0.01) :
+        """
+        build the data of one system from Gaia columns
+        p_df : a pandas data frame with ra, dec (deg), ra_error, dec_error (mas), phot_g_mean_mag
+               and pmra, pmdec, pmra_error, pmdec_error (mas/yr) when pm is True.
+               The correlation columns ra_dec_corr, ra_pmra_corr, ..., pmra_pmdec_corr are used when present.
+        center : (ra,dec) in deg of the origin of the local frame, default the mean direction
+        pm : to include the proper motions
+        magError : G magnitude error used when phot_g_mean_flux_over_error is not available
+        return : LensData with positions in arcsec relative to the center
+        """
+        if center is None :
+            ra,dec = np.deg2rad(p_df.ra.values),np.deg2rad(p_df.dec.values)
+            v = np.array([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)]).mean(axis=1)
+            center = (np.rad2deg(np.arctan2(v[1],v[0]))%360,np.rad2deg(np.arctan2(v[2],np.hypot(v[0],v[1]))))
+        ra0,dec0 = center
+        scale = u.deg.to(u.arcsec)
+        # ra offsets wrapped in [-180,180) for the systems across ra=0
+        x = ((p_df.ra.values-ra0+180)%360-180)*np.cos(np.deg2rad(p_df.dec.values))*scale
+        y = (p_df.dec.values-dec0)*scale
+        g = p_df.phot_g_mean_mag.values
+        if 'phot_g_mean_flux_over_error' in p_df :
+            ge = 2.5/np.log(10)/p_df.phot_g_mean_flux_over_error.values
+        else :
+            ge = np.full(len(p_df),magError)
+        astrometry = GAIA_POSITION+GAIA_PM if pm else GAIA_POSITION
+        errors = [p_df[c+'_error'].values*(u.mas.to(u.arcsec) if c in GAIA_POSITION else 1) for c in astrometry]
+        values = [x,y]+([p_df.pmra.values,p_df.pmdec.values] if pm else [])+[g]
+        errors = errors+[ge]
+        d = len(values)
+        cov = np.zeros((len(p_df),d,d))
+        for i in range(d) :
+            cov[:,i,i] = np.power(errors[i],2)
+        for i,a in enumerate(astrometry) :
+            for j,b in enumerate(astrometry[i+1:],i+1) :
+                col = '%s_%s_corr' % (a,b)
+                if col in p_df :
+                    cov[:,i,j] = cov[:,j,i] = np.nan_to_num(p_df[col].values)*errors[i]*errors[j]
+        return cls(np.stack(values,axis=-1),cov)
+
+    def logpdf(self,images,n,match=False,detection=None) :
+        """
+        log10 (normalized) likelihood of model images
+        images : padded model images of shape (nwalkers,k,d)
+        n : number of model images per walker
+        match : if False the model images are paired with the observed ones in order,
+                otherwise the best assignment of model images to observed images is used, see logpdfMatch
+        detection : detection probability as a function of the magnitude, used when match is True
+        return : array of length nwalkers, -inf when the images cannot be paired
+        """
+        if match :
+            return self.logpdfMatch(images,n,detection)
+        images = np.asarray(images,dtype=float)
+        n = np.asarray(n)
+        res = np.full(len(n),-np.inf)
+        ok = n==self.nobs
+        if self.nobs>images.shape[1] or not ok.any() :
+            return res
+        z = np.einsum('ide,wie->wid',self.whiten,images[ok,:self.nobs]-self.obs)
+        res[ok] = -0.5*np.sum(z*z,axis=(1,2)) + self.lognorm
+        return res/np.log(10)
+
+    def logpdfMatch(self,images,n,detection=None) :
+        """
+        log10 likelihood of model images under their best assignment to the observed images
+        all the injective assignments of observed images to model images are scored at once.
+        Without detection function the numbers of images must be equal, otherwise a model image
+        left unmatched contributes log(1-p) and a matched one log(p), p = detection(magnitude).
+        images : padded model images of shape (nwalkers,k,d), the magnitude being the last column
+        n : number of model images per walker
+        detection : detection probability as a function of the magnitude, e.g. detectionProbability
+        return : array of length nwalkers, -inf when there are less model than observed images
+        """
+        images = np.asarray(images,dtype=float)
+        n = np.asarray(n)
+        k = images.shape[1]
+        res = np.full(len(n),-np.inf)
+        ok = n>=self.nobs if detection is not None else n==self.nobs
+        if self.nobs>k or not ok.any() :
+            return res
+        images,n = images[ok],n[ok]
+        # pairwise log likelihood of observed image j given model image i, shape (w,k,nobs)
+        cost = -0.5*self._pairChi2(images) + self.lognorms
+        valid = np.arange(k)<n[:,None]
+        if detection is not None :
+            with np.errstate(divide='ignore') :
+                p = np.clip(detection(images[...,-1]),0,1)
+                logDet = np.where(valid,np.log(p),0.)
+                logMiss = np.where(valid,np.log1p(-p),0.)
+            cost = cost + logDet[:,:,None]
+        else :
+            logMiss = np.zeros(valid.shape)
+        cost = np.where(valid[:,:,None],cost,-np.inf)
+        perms = self._assignments(k)
+        unmatched = np.ones((len(perms),k),dtype=bool)
+        unmatched[np.arange(len(perms))[:,None],perms] = False
+        score = np.sum(cost[:,perms,np.arange(self.nobs)],axis=-1)
+        score = score + np.sum(np.where(unmatched,logMiss[:,None,:],0.),axis=-1)
+        res[ok] = np.max(score,axis=1)
+        return res/np.log(10)
+
+    def _pairChi2(self,images) :
+        """squared whitened residual of each observed image j given each model image i, shape (w,k,nobs)"""
+        z = np.einsum('jde,wije->wijd',self.whiten,images[:,:,None,:]-self.obs)
+        return np.sum(z*z,axis=-1)
+
+    def _assignments(self,k) :
+        """the injective assignments of the observed images to k model images, shape (npermutations,nobs)"""
+        return np.array(list(itertools.permutations(range(k),self.nobs)))
+
+    def subset(self,rows) :
+        """the observed images rows, e.g. reordered"""
+        return LensData(self.obs[rows],self.cov[rows])
+
+    def assignment(self,images) :
+        """
+        best assignment (least chi-square) of one set of model images of shape (k,d) to the observed images
+        return : the model image of each observed image, None when there are less model than observed images
+        """
+        images = np.asarray(images,dtype=float)
+        if len(images) < self.nobs :
+            return None
+        perms = self._assignments(len(images))
+        cost = self._pairChi2(images[None])[0]
+        return perms[np.argmin(np.sum(cost[perms,np.arange(self.nobs)],axis=-1))]
+
+    def chi2(self,images,n,match=False) :
+        """
+        chi-square of model images, the sum of the squared whitened residuals of the observed images
+        images : padded model images of shape (nwalkers,k,d)
+        n : number of model images per walker
+        match : if False the model images are paired with the observed ones in order, otherwise
+                the best assignment is used and the model images left unmatched do not contribute
+        return : array of length nwalkers, inf when the images cannot be paired
+        """
+        images = np.asarray(images,dtype=float)
+        n = np.asarray(n)
+        k = images.shape[1]
+        res = np.full(len(n),np.inf)
+        ok = n>=self.nobs if match else n==self.nobs
+        if self.nobs>k or not ok.any() :
+            return res
+        if not match :
+            z = np.einsum('ide,wie->wid',self.whiten,images[ok,:self.nobs]-self.obs)
+            res[ok] = np.sum(z*z,axis=(1,2))
+            return res
+        cost = np.where((np.arange(k)<n[ok][:,None])[:,:,None],self._pairChi2(images[ok]),np.inf)
+        res[ok] = np.min(np.sum(cost[:,self._assignments(k),np.arange(self.nobs)],axis=-1),axis=1)
+        return res
+
+    def gradient(self,images,jac) :
+        """
+        gradient of the log10 likelihood of one set of model images paired with the observed ones in order
+        images : model images of shape (nobs,d)
+        jac : derivatives of the images with respect to the model parameters, of shape (nobs,d,p)
+        return : array of length p
+        """
+        return np.einsum('ide,ie,idp->p',self.prec,self.obs-images,jac)/np.log(10)
+
+
+def detectionProbability(g,gLimit=20.7,width=0.2) :
+    """a smooth Gaia completeness in G magnitude: 1/2 at gLimit, width is the magnitude scale of the drop"""
+    return 1/(1+np.exp((g-gLimit)/width))
+
+def asLensData(data) :
+    """return data as a LensData, data being a LensData or an array accepted by LensData.fromArray"""
+    if isinstance(data,LensData) :
+        return data
+    return LensData.fromArray(data)
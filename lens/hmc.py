@@ -0,0 +1,119 @@
+"""
+Hamiltonian Monte Carlo sampler for the lens posteriors
+
+uses the analytic gradients of the SIS and SIE posteriors, e.g.
+lens.sie.inferencePM.log_posterior_pm_and_grad, which are in log10 as the posteriors.
+The interface follows emcee: run_mcmc, chain, lnprobability and acceptance_fraction.
+The log10 posterior is converted to natural log, so the sampled distribution is the posterior itself
+(emcee fed directly with a log10 posterior samples it at a temperature of log(10)).
+"""
+
+import numpy as np
+
+
+class HMCSampler :
+    """
+    Hamiltonian Monte Carlo with a jittered number of leapfrog steps,
+    the step size is tuned by dual averaging (Hoffman & Gelman 2014) and
+    a diagonal mass matrix is estimated from the warmup samples
+    ndim : number of parameters
+    log_prob_and_grad : function returning the log10 posterior and its gradient
+    args : extra arguments of log_prob_and_grad, e.g. [data]
+    step : initial leapfrog step size
+    nleapfrog : mean number of leapfrog steps per trajectory
+    target : target acceptance probability
+    seed : seed or numpy.random.Generator
+    """
+
+    def __init__(self,ndim,log_prob_and_grad,args=[],step=0.01,nleapfrog=20,target=0.8,seed=None) :
+        self.ndim = ndim
+        self.log_prob_and_grad = log_prob_and_grad
+        self.args = args
+        self.step = step
+        self.nleapfrog = nleapfrog
+        self.target = target
+        self.rng = np.random.default_rng(seed)
+        self.invMass = np.ones(ndim)
+        self.chain = np.zeros((0,ndim))
+        self.lnprobability = np.zeros(0)
+        self.accepted = 0
+
+    def _lnprob(self,x) :
+        """natural log posterior and gradient"""
+        lp,grad = self.log_prob_and_grad(x,*self.args)
+        return lp*np.log(10),np.asarray(grad)*np.log(10)
+
+    def _trajectory(self,x,lp,grad,step) :
+        """one HMC transition, return the new state and the acceptance probability"""
+        p = self.rng.normal(size=self.ndim)/np.sqrt(self.invMass)
+        h0 = lp - 0.5*np.sum(self.invMass*p*p)
+        n = max(1,int(self.rng.integers(self.nleapfrog//2,3*self.nleapfrog//2+1)))
+        xn,lpn,gradn = x,lp,grad
+        with np.errstate(invalid='ignore',over='ignore') :
+            p = p + 0.5*step*gradn
+            for i in range(n) :
+                xn = xn + step*self.invMass*p
+                lpn,gradn = self._lnprob(xn)
+                if not np.isfinite(lpn) :
+                    return x,lp,grad,0.
+                if i < n-1 :
+                    p = p + step*gradn
+            p = p + 0.5*step*gradn
+            h1 = lpn - 0.5*np.sum(self.invMass*p*p)
+        alpha = min(1.,np.exp(h1-h0)) if np.isfinite(h1) else 0.
+        if self.rng.uniform() < alpha :
+            return xn,lpn,gradn,alpha
+        return x,lp,grad,alpha
+
+    def run_mcmc(self,x0,nsteps,nwarmup=500) :
+        """
+        sample the posterior
+        x0 : initial position, the posterior must be finite there
+        nsteps : number of samples kept in chain
+        nwarmup : number of warmup steps used to adapt the step size and the mass matrix
+        return : the last position
+        """
+        x = np.asarray(x0,dtype=float)
+        lp,grad = self._lnprob(x)
+        if not np.isfinite(lp) :
+            raise ValueError("the posterior is not finite at the initial position")
+        step = self.step
+        # dual averaging state
+        mu,hBar,logStepBar,m = np.log(10*step),0.,0.,0
+        window = (nwarmup//4,3*nwarmup//4)
+        samples = []
+        for i in range(nwarmup) :
+            x,lp,grad,alpha = self._trajectory(x,lp,grad,step)
+            m += 1
+            hBar = (1-1/(m+10))*hBar + (self.target-alpha)/(m+10)
+            logStep = mu - np.sqrt(m)/0.05*hBar
+            logStepBar = np.power(m,-0.75)*logStep + (1-np.power(m,-0.75))*logStepBar
+            step = np.exp(logStep)
+            if window[0] <= i < window[1] :
+                samples.append(x)
+            if i == window[1]-1 and len(samples) > 2 :
+                # regularized diagonal mass matrix, then restart the step size adaptation
+                n = len(samples)
+                var = np.var(samples,axis=0)
+                self.invMass = (n/(n+5))*var + 1e-3*(5/(n+5))
+                mu,hBar,logStepBar,m = np.log(10*step),0.,0.,0
+        if nwarmup > 0 :
+            step = np.exp(logStepBar) if m > 0 else step
+        self.step = step
+        chain = np.zeros((nsteps,self.ndim))
+        lnprob = np.zeros(nsteps)
+        accepted = 0
+        for i in range(nsteps) :
+            xn,lp,grad,alpha = self._trajectory(x,lp,grad,step)
+            accepted += not np.array_equal(xn,x)
+            x = xn
+            chain[i] = x
+            lnprob[i] = lp/np.log(10)
+        self.chain = np.concatenate([self.chain,chain])
+        self.lnprobability = np.concatenate([self.lnprobability,lnprob])
+        self.accepted += accepted
+        return x
+
+    @property
+    def acceptance_fraction(self) :
+        return self.accepted/max(1,len(self.chain))
@@ -0,0 +1,203 @@
+"""
+fast screening of lensed QSO candidates by multistart optimization of the SIS and SIE posteriors
+
+each candidate group (e.g. from lens.candidates.friendsOfFriends) is fitted by every model:
+many random starting points are drawn around the rough guess of lens.campaign.initWalkers and
+scored at once with the walker-vectorized posterior, the best ones are refined with a local
+least squares optimizer using the analytic image derivatives and the best optimum is kept. The model images being unordered the best assignment
+of the model images to the observed ones is used (match). The systems are fitted in a process
+pool and ranked by the chi-square z-score of their best model, only the top candidates
+deserving a full sampling with lens.campaign.runCampaign.
+"""
+
+import zlib
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize, least_squares
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import lens.sis.inference as sisI
+import lens.sis.inferencePM as sisPM
+import lens.sie.inference as sieI
+import lens.sie.inferencePM as siePM
+from lens.campaign import MODELS, initWalkers, systemsFromFrame
+
+# model name : images of one model and their derivatives with respect to the parameters
+JACOBIANS = {
+    'sis' : sisI.getImages_jac,
+    'sis_pm' : sisPM.getImages_pm_jac,
+    'sie' : sieI.getImages_jac,
+    'sie_pm' : siePM.getImages_pm_jac,
+}
+
+# model name : walker-vectorized images, see MODELS
+IMAGES = {
+    'sis' : sisI.getImages_batch,
+    'sis_pm' : sisPM.getImages_pm_batch,
+    'sie' : sieI.getImages_batch,
+    'sie_pm' : siePM.getImages_pm_batch,
+}
+
+
+def systemsFromGroups(members,catalogue,idColumn='source_id',pm=True,minImages=2,maxImages=4,magError=0.01):
+    """
+    the candidate systems of friends of friends groups
+    members : the members table of lens.candidates.friendsOfFriends, with group and idColumn
+    catalogue : a pandas data frame with the Gaia columns of the members, see LensData.fromFrame
+    return : dict group -> LensData of the groups with minImages to maxImages images
+    """
+    members = members[(members.n>=minImages) & (members.n<=maxImages)]
+    p_df = members[[idColumn,'group']].merge(catalogue.drop(columns=['group'],errors='ignore'),on=idColumn)
+    return systemsFromFrame(p_df,key='group',pm=pm,minImages=minImages,magError=magError)
+
+
+# support of the priors bounding the local optimizations
+BOUNDS = {'bL':(1e-6,np.inf),'qL':(1e-6,1-1e-6),'gS':(5+1e-6,np.inf)}
+# standard deviation of the Gaussian priors, added as residuals to the local optimizations
+PRIOR_SCALE = {'xS':0.1,'yS':0.1,'xL':0.1,'yL':0.1,'dxS':0.5,'dyS':0.5}
+# residual when the numbers of model and observed images differ, so that the trust region shrinks
+PENALTY = 1e10
+
+
+def _residuals(model,data,names):
+    """whitened residuals of the images paired in order and of the Gaussian priors, and their jacobian"""
+    scale = np.array([PRIOR_SCALE.get(name,np.inf) for name in names])
+    m = data.nobs*data.d
+    def fun(x) :
+        images,jac = JACOBIANS[model](x)
+        if len(images) != data.nobs :
+            return np.full(m+len(x),PENALTY),np.zeros((m+len(x),len(x)))
+        r = np.einsum('ide,ie->id',data.whiten,images-data.obs).ravel()
+        J = np.einsum('ide,iep->idp',data.whiten,jac).reshape(m,len(x))
+        return np.r_[r,x/scale],np.r_[J,np.diag(1/scale)]
+    return fun
+
+def localFit(model,data,x0,match=True,detection=None,maxiter=200,rounds=3):
+    """
+    local maximization of the log10 posterior of one model from x0
+    without detection function the whitened residuals of the images and of the Gaussian priors are
+    minimized by a trust region least squares (the magnitude and radius priors are left out):
+    the model images are paired with the observed ones by their best assignment, updated after
+    each optimization until it is stable. With a detection function, or when the numbers of images
+    differ, Nelder-Mead on the posterior.
+    return : the parameters and their log10 posterior
+    """
+    posterior,names = MODELS[model]
+    x = np.asarray(x0,dtype=float)
+    if detection is None :
+        perm = None
+        lower,upper = np.array([BOUNDS.get(name,(-np.inf,np.inf)) for name in names]).T
+        for i in range(rounds) :
+            images,n = IMAGES[model](x[None,:])
+            if n[0] != data.nobs :
+                break
+            # the residuals (JACOBIANS) must give the images of the assignment, in the same order
+            jacImages = JACOBIANS[model](x)[0]
+            assert jacImages.shape == images[0,:n[0]].shape and np.allclose(jacImages,images[0,:n[0]]), \
+                "%s: the images of JACOBIANS and IMAGES differ" % model
+            new = data.assignment(images[0,:n[0]]) if match else np.arange(data.nobs)
+            if perm is not None and np.array_equal(new,perm) :
+                break
+            perm = new
+            fun = _residuals(model,data.subset(np.argsort(perm)),names)
+            fit = least_squares(lambda y : fun(y)[0],np.clip(x,lower,upper),jac=lambda y : fun(y)[1],
+                                bounds=(lower,upper),x_scale='jac',ftol=1e-6,max_nfev=maxiter)
+            x = fit.x
+        if perm is not None :
+            return x,posterior(x[None,:],data,match)[0]
+    cost = lambda y : -posterior(y[None,:],data,match,detection)[0]
+    fit = minimize(cost,x,method='Nelder-Mead',options={'maxiter':maxiter*len(x),'adaptive':True})
+    return fit.x,-fit.fun
+
+def fitModel(model,data,rng,nsample=200,nstart=5,match=True,detection=None,maxiter=200):
+    """
+    multistart maximization of the log10 posterior of one model
+    nsample : number of random points scored to choose the starting points
+    nstart : number of local optimizations, from the best points, see localFit
+    return : the best parameters, their log10 posterior and the number of optimizations
+             that reached it (within 0.01)
+    """
+    posterior,names = MODELS[model]
+    points = initWalkers(model,data,nsample,rng,match=match,detection=detection)
+    lp = posterior(points,data,match,detection)
+    fits = [localFit(model,data,x0,match,detection,maxiter) for x0 in points[np.argsort(-lp)[:nstart]]]
+    values = np.array([v for x,v in fits])
+    best = int(np.argmax(values))
+    return fits[best][0],values[best],int(np.sum(values>=values[best]-0.01))
+
+def chi2Score(chi2,dof):
+    """
+    minus the Wilson-Hilferty normal deviate of a chi-square with dof degrees of freedom,
+    higher for a better fit: unlike the log probability it does not underflow for a large chi2
+    """
+    h = 2/(9*np.asarray(dof,dtype=float))
+    return -((np.asarray(chi2)/dof)**(1/3)-(1-h))/np.sqrt(h)
+
+def screenSystem(name,data,models=('sis_pm','sie_pm'),seed=0,match=True,detection=None,**kwargs):
+    """
+    fit every model to one system
+    kwargs : passed to fitModel
+    return : list of rows, one per model, with the best parameters, lnprob (log10 posterior), chi2,
+             dof (number of observed values minus number of parameters, at least 1) and score,
+             see chi2Score
+    """
+    rng = np.random.default_rng([seed,zlib.crc32(str(name).encode())])
+    rows = []
+    for model in models :
+        posterior,names = MODELS[model]
+        row = {'name':name,'model':model,'nimages':len(data)}
+        try :
+            x,lnprob,nconverged = fitModel(model,data,rng,match=match,detection=detection,**kwargs)
+        except ValueError :
+            # no starting point with a finite posterior, e.g. 4 images for the SIS
+            row.update({'lnprob':-np.inf,'chi2':np.inf,'dof':np.nan,'score':-np.inf})
+            rows.append(row)
+            continue
+        images,n = IMAGES[model](x[None,:])
+        chi2 = data.chi2(images,n,match)[0]
+        dof = max(data.nobs*data.d-len(names),1)
+        row.update({'lnprob':lnprob,'chi2':chi2,'dof':dof,'score':chi2Score(chi2,dof),
+                    'nmodel':int(n[0]),'nconverged':nconverged})
+        row.update(dict(zip(names,x)))
+        rows.append(row)
+    return rows
+
+def _screenTask(task):
+    name,data,models,seed,match,detection,kwargs = task
+    return screenSystem(name,data,models,seed,match,detection,**kwargs)
+
+
+def screen(systems,models=('sis_pm','sie_pm'),seed=0,match=True,detection=None,max_workers=None,outfile=None,**kwargs):
+    """
+    screen every system in a process pool
+    systems : dict name -> LensData, e.g. from systemsFromGroups or lens.campaign.loadSystems
+    models : models of MODELS fitted to each system
+    match, detection : image matching, see LensData.logpdf
+    max_workers : number of processes, 1 to screen in the current process
+    outfile : csv file of the table
+    kwargs : passed to fitModel
+    return : pandas DataFrame with one row per system and model, sorted by rank, the rank of the
+             system by the score of its best model (0 for the most lens-like)
+    """
+    tasks = [(name,data,models,seed,match,detection,kwargs) for name,data in systems.items()]
+    rows = []
+    if max_workers == 1 :
+        for task in tasks :
+            rows += _screenTask(task)
+    else :
+        with ProcessPoolExecutor(max_workers=max_workers) as pool :
+            for job in as_completed([pool.submit(_screenTask,task) for task in tasks]) :
+                rows += job.result()
+    res = pd.DataFrame(rows)
+    if len(res) :
+        best = res.groupby('name').score.max().sort_values(ascending=False,kind='stable')
+        rank = pd.Series(np.arange(len(best)),index=best.index)
+        res['rank'] = rank[res['name']].values
+        res = res.sort_values(['rank','score'],ascending=[True,False]).reset_index(drop=True)
+    if outfile is not None :
+        res.to_csv(outfile,index=False)
+    return res
+
+def topCandidates(table,n=10):
+    """the names of the n best ranked systems of a screen table"""
+    return list(table[table['rank']<n].drop_duplicates('name')['name'])
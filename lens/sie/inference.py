@@ -7,6 +7,8 @@ from LQSO images position and magnitude
 import lens.sie.model as sie 
 import numpy as np
 from scipy.stats import beta, uniform, norm, gamma, cauchy, multivariate_normal
+from scipy.special import gammaln
+from lens.data import asLensData
 
 def radiusPrior(b):
     """SIE Einstein radius prior in as"""
@@ -55,23 +57,123 @@ def getImages(model):
         res.append([bL*r*np.cos(phi+thetaL)+xL,bL*r*np.sin(phi+thetaL)+yL,g])
     return res
     
-def log_likelihood(model,data) :
-    """Return log10 (normalized) likelihood: P(3D astrometry | 3D phase space, Covariance)"""
-    functions = []
-    for s in data :
-        functions.append(imageLikelyhood(s))
-    images = getImages(model)
+def log_likelihood(model,data,match=False,detection=None) :
+    """Return log10 (normalized) likelihood: P(3D astrometry | 3D phase space, Covariance)
+    data : LensData or array of x,y,g,xe,ye,ge rows
+    """
+    images = np.array(getImages(model)).reshape(1,-1,3)
+    return asLensData(data).logpdf(images,[images.shape[1]],match,detection)[0]
     
-    if(len(images)==len(functions)): # probably a very bad idea
-        res = []
-        for point,f in zip(images,functions):
-            res.append(f.logpdf(point)/np.log(10))
-        return sum(res)
-    else :
-        return -np.inf
-    
-def log_posterior(model,data) :
+def log_posterior(model,data,match=False,detection=None) :
     logprior = log_prior(model)
-    res = logprior + log_likelihood(model,data) if np.isfinite(logprior) else -np.inf
+    res = logprior + log_likelihood(model,data,match,detection) if np.isfinite(logprior) else -np.inf
     return np.array(res)
     
+
+def logPositionPrior(x):
+    """log10 of the SIE source and lens position prior"""
+    return (-0.5*np.power(x/0.1,2) - np.log(0.1*np.sqrt(2*np.pi)))/np.log(10)
+
+def logMagnitudePrior(x):
+    """log10 of the SIE source magnitude prior"""
+    with np.errstate(divide='ignore',invalid='ignore') :
+        res = 9*np.log(x-5) - (x-5) - gammaln(10)
+    return np.where(x>5,res,-np.inf)/np.log(10)
+
+def logRadiusPrior(b):
+    """log10 of the SIE Einstein radius prior in as"""
+    with np.errstate(divide='ignore',invalid='ignore') :
+        res = 2*np.log(b) - b - np.log(2)
+    return np.where(b>0,res,-np.inf)/np.log(10)
+
+def logRatioPrior(q):
+    """log10 of the SIE axis ratio prior in [0,1]"""
+    return np.where((q>=0) & (q<=1),0.,-np.inf)
+
+def logThetaPrior(theta):
+    """log10 of the SIE lens orientation prior in [0,pi]"""
+    return np.where((theta>=0) & (theta<=np.pi),-np.log10(np.pi),-np.inf)
+
+def log_prior_batch(models):
+    """Return log10 of the priors for an array of models of shape (nwalkers,8)"""
+    (xs,ys,gs,b,q,xl,yl,theta) = tuple(np.atleast_2d(models).T)
+    res = logPositionPrior(xs) + logPositionPrior(ys) + logMagnitudePrior(gs)
+    res = res + logPositionPrior(xl) + logPositionPrior(yl)
+    res = res + logRadiusPrior(b) + logRatioPrior(q) + logThetaPrior(theta)
+    return res
+
+def getImages_batch(models,solver=None):
+    """
+    return the SIE images of an array of models as a padded array of shape (nwalkers,4,3) and the image counts
+    solver : object with a solveBatch(f,y1,y2) method, e.g. a lens.sie.table.SolutionTable, default lens.sie.model
+    """
+    (xS,yS,gS,bL,qL,xL,yL,thetaL) = tuple(np.atleast_2d(models).T[:,:,None])
+    rI,phiI,n = (sie if solver is None else solver).solveBatch(qL[:,0],xS[:,0],yS[:,0])
+    magI = gS - 2.5 * np.log10(np.abs(sie.magnification(rI,phiI,qL)))
+    return np.stack([bL*rI*np.cos(phiI+thetaL)+xL,bL*rI*np.sin(phiI+thetaL)+yL,magI],axis=-1),n
+
+def log_likelihood_batch(models,data,match=False,detection=None,solver=None):
+    """Return log10 (normalized) likelihood for an array of models of shape (nwalkers,8)"""
+    images,n = getImages_batch(models,solver)
+    return asLensData(data).logpdf(images,n,match,detection)
+
+def log_posterior_batch(models,data,match=False,detection=None,solver=None):
+    """
+    Return the log10 posterior for an array of models of shape (nwalkers,8),
+    to be used with emcee.EnsembleSampler(...,vectorize=True)
+    match, detection : permutation-invariant image matching, see LensData.logpdf
+    solver : SIE solver, see getImages_batch
+    images outside the cut (r<=0) are not counted, unlike in log_posterior
+    """
+    models = np.atleast_2d(models)
+    res = log_prior_batch(models)
+    ok = np.isfinite(res)
+    res[~ok] = -np.inf
+    res[ok] = res[ok] + log_likelihood_batch(models[ok],data,match,detection,solver)
+    return res
+
+def grad_log_prior(model):
+    """Return the gradient of log10 of the priors"""
+    (xs,ys,gs,b,q,xl,yl,theta) = tuple(model)
+    res = np.array([-xs/0.01,-ys/0.01,9/(gs-5)-1,2/b-1,0,-xl/0.01,-yl/0.01,0])
+    return res/np.log(10)
+
+def getImages_jac(model):
+    """return the SIE images of model, of shape (k,3), and their derivatives with respect to the model parameters, of shape (k,3,8)"""
+    (xS,yS,gS,bL,qL,xL,yL,thetaL) = tuple(model)
+    # the images of the batched solver, as used by the batched posterior
+    rI,phiI,n = sie.solveBatch(qL,xS,yS)
+    rI,phiI = rI[0,:n[0]],phiI[0,:n[0]]
+    k = sie.kappa(rI,phiI,qL)
+    # derivatives with respect to q,xS,yS
+    dphi,dr,dk = sie.imageDerivatives(rI,phiI,qL,xS,yS)
+    c,s,r = np.cos(phiI+thetaL)[:,None],np.sin(phiI+thetaL)[:,None],rI[:,None]
+    images = np.stack([bL*rI*c[:,0]+xL,bL*rI*s[:,0]+yL,gS+2.5*np.log10(np.abs(1-2*k))],axis=-1)
+    jac = np.zeros((len(rI),3,8))
+    jac[:,0,[4,0,1]] = bL*(dr*c-r*s*dphi)
+    jac[:,1,[4,0,1]] = bL*(dr*s+r*c*dphi)
+    jac[:,2,[4,0,1]] = -5/np.log(10)*dk/(1-2*k)[:,None]
+    jac[:,2,2] = 1
+    jac[:,0,3] = rI*c[:,0]
+    jac[:,1,3] = rI*s[:,0]
+    jac[:,0,5] = 1
+    jac[:,1,6] = 1
+    jac[:,0,7] = -bL*rI*s[:,0]
+    jac[:,1,7] = bL*rI*c[:,0]
+    return images,jac
+
+def log_posterior_and_grad(model,data):
+    """Return the log10 posterior and its gradient with respect to the model parameters"""
+    data = asLensData(data)
+    logprior = log_prior_batch(model)[0]
+    if not np.isfinite(logprior) :
+        return -np.inf,np.zeros(len(model))
+    images,jac = getImages_jac(model)
+    if len(images)!=len(data) :
+        return -np.inf,np.zeros(len(model))
+    logl = data.logpdf(images[None],[len(images)])[0]
+    return logprior+logl,grad_log_prior(model)+data.gradient(images,jac)
+
+def grad_log_posterior(model,data):
+    """Return the gradient of the log10 posterior with respect to the model parameters"""
+    return log_posterior_and_grad(model,data)[1]
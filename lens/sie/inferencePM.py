@@ -36,42 +36,137 @@ def imageLikelyhood_pm(s):
 def getImages_pm(model):
     """return SIE images from model with proper motion"""
     (xS,yS,dxS,dyS,gS,bL,qL,xL,yL,thetaL) = tuple(model)
-    phiI,rI = sie.solve(qL,xS,yS)
+    rI,phiI = sie.solve(qL,xS,yS)
     
-    # images magnitude    
-    magI = gS - 2.5 * np.log10(np.abs(sie.magnification(rI,phiI,qL)))
-    
-    # images proper motion
-    rot = np.array([[np.cos(thetaL),np.sin(thetaL)],[-np.sin(thetaL),np.cos(thetaL)]])
-    dxI = [] 
-    dyI = []
-    for phi,r in zip(phiI,rI) :
-        dx = np.dot(rot,np.dot(np.linalg.inv(sie.A(r,phi,qL)),np.array([dxS,dyS])))
-        dxI.append(dx[0])
-        dyI.append(dx[1])
+    # images magnitude and proper motion
+    mu,dxI,dyI = sie.imageKinematics(rI,phiI,qL,dxS,dyS,thetaL)
+    magI = gS - 2.5 * np.log10(np.abs(mu))
     
     res = []
     for phi,r,dx,dy,g in zip(phiI,rI,dxI,dyI,magI):
         res.append([bL*r*np.cos(phi+thetaL)+xL,bL*r*np.sin(phi+thetaL)+yL,dx,dy,g])
     return res
     
-def log_likelihood_pm(model,data) :
-    """return log10 (normalized) likelihood for model and data with proper motion"""
-    functions = []
-    for s in data :
-        functions.append(imageLikelyhood_pm(s))
-    images = getImages_pm(model)
-    
-    if(len(images)==len(functions)): # probably a very bad idea
-        res = []
-        for point,f in zip(images,functions):
-            res.append(f.logpdf(point)/np.log(10))
-        return sum(res)
-    else :
-        return -np.inf
-
-def log_posterior_pm(model,data) :
+def log_likelihood_pm(model,data,match=False,detection=None) :
+    """return log10 (normalized) likelihood for model and data with proper motion
+    data : LensData or array of x,y,dx,dy,g,xe,ye,dxe,dye,ge rows
+    """
+    images = np.array(getImages_pm(model)).reshape(1,-1,5)
+    return asLensData(data).logpdf(images,[images.shape[1]],match,detection)[0]
+
+def log_posterior_pm(model,data,match=False,detection=None) :
     """return the log 10 posterior prior for model and data with proper motion"""
     logprior = log_prior_pm(model)
-    res = logprior + log_likelihood_pm(model,data) if np.isfinite(logprior) else -np.inf
-    return np.array(res)
\ No newline at end of file
+    res = logprior + log_likelihood_pm(model,data,match,detection) if np.isfinite(logprior) else -np.inf
+    return np.array(res)
+
+def logPmPrior(x):
+    """log10 of the SIE L-S proper motion prior"""
+    return (-0.5*np.power(x/0.5,2) - np.log(0.5*np.sqrt(2*np.pi)))/np.log(10)
+
+def log_prior_pm_batch(models):
+    """Return log10 of all the priors for an array of models with proper motion of shape (nwalkers,10)"""
+    (xs,ys,dxs,dys,gs,b,q,xl,yl,theta) = tuple(np.atleast_2d(models).T)
+    res = logPositionPrior(xs) + logPositionPrior(ys) + logMagnitudePrior(gs)
+    res = res + logPmPrior(dxs) + logPmPrior(dys)
+    res = res + logPositionPrior(xl) + logPositionPrior(yl)
+    res = res + logRadiusPrior(b) + logRatioPrior(q) + logThetaPrior(theta)
+    return res
+
+def getImages_pm_batch(models,solver=None):
+    """
+    return the SIE images of an array of models with proper motion as a padded array of shape (nwalkers,4,5) and the image counts
+    solver : SIE solver, see getImages_batch
+    """
+    (xS,yS,dxS,dyS,gS,bL,qL,xL,yL,thetaL) = tuple(np.atleast_2d(models).T[:,:,None])
+    rI,phiI,n = (sie if solver is None else solver).solveBatch(qL[:,0],xS[:,0],yS[:,0])
+
+    # images magnitude and proper motion
+    mu,dxI,dyI = sie.imageKinematics(rI,phiI,qL,dxS,dyS,thetaL)
+    magI = gS - 2.5 * np.log10(np.abs(mu))
+
+    return np.stack([bL*rI*np.cos(phiI+thetaL)+xL,bL*rI*np.sin(phiI+thetaL)+yL,dxI,dyI,magI],axis=-1),n
+
+def log_likelihood_pm_batch(models,data,match=False,detection=None,solver=None):
+    """return log10 (normalized) likelihood for an array of models with proper motion of shape (nwalkers,10)"""
+    images,n = getImages_pm_batch(models,solver)
+    return asLensData(data).logpdf(images,n,match,detection)
+
+def log_posterior_pm_batch(models,data,match=False,detection=None,solver=None):
+    """
+    return the log10 posterior for an array of models with proper motion of shape (nwalkers,10),
+    to be used with emcee.EnsembleSampler(...,vectorize=True)
+    match, detection : permutation-invariant image matching, see LensData.logpdf
+    solver : SIE solver, see getImages_batch
+    """
+    models = np.atleast_2d(models)
+    res = log_prior_pm_batch(models)
+    ok = np.isfinite(res)
+    res[~ok] = -np.inf
+    res[ok] = res[ok] + log_likelihood_pm_batch(models[ok],data,match,detection,solver)
+    return res
+
+def grad_log_prior_pm(model):
+    """Return the gradient of log10 of all the priors for model with proper motion"""
+    (xs,ys,dxs,dys,gs,b,q,xl,yl,theta) = tuple(model)
+    res = np.array([-xs/0.01,-ys/0.01,-dxs/0.25,-dys/0.25,9/(gs-5)-1,2/b-1,0,-xl/0.01,-yl/0.01,0])
+    return res/np.log(10)
+
+def getImages_pm_jac(model):
+    """
+    return the SIE images of model with proper motion, of shape (k,5),
+    and their derivatives with respect to the model parameters, of shape (k,5,10)
+    """
+    (xS,yS,dxS,dyS,gS,bL,qL,xL,yL,thetaL) = tuple(model)
+    # the images of the batched solver, as used by the batched posterior
+    rI,phiI,n = sie.solveBatch(qL,xS,yS)
+    rI,phiI = rI[0,:n[0]],phiI[0,:n[0]]
+    k = sie.kappa(rI,phiI,qL)[:,None]
+    # derivatives with respect to q,xS,yS
+    dphi,dr,dk = sie.imageDerivatives(rI,phiI,qL,xS,yS)
+    c,s,r = np.cos(phiI+thetaL)[:,None],np.sin(phiI+thetaL)[:,None],rI[:,None]
+
+    # images proper motion w = A^-1 v = (v - 2 kappa (e.v) e)/(1 - 2 kappa) with e = (cos phi, sin phi)
+    v = np.array([dxS,dyS])
+    e = np.stack([np.cos(phiI),np.sin(phiI)],axis=1)
+    eT = np.stack([-np.sin(phiI),np.cos(phiI)],axis=1)
+    p = e.dot(v)[:,None]
+    w = (v-2*k*p*e)/(1-2*k)
+    dwdk = 2*(v-p*e)/np.power(1-2*k,2)
+    dwdphi = -2*k*(eT.dot(v)[:,None]*e+p*eT)/(1-2*k)
+    dwdv = (np.eye(2)-2*k[:,:,None]*e[:,:,None]*e[:,None,:])/(1-2*k)[:,:,None]
+    rot = np.array([[np.cos(thetaL),np.sin(thetaL)],[-np.sin(thetaL),np.cos(thetaL)]])
+    drot = np.array([[-np.sin(thetaL),np.cos(thetaL)],[-np.cos(thetaL),-np.sin(thetaL)]])
+
+    images = np.concatenate([bL*r*c+xL,bL*r*s+yL,w.dot(rot.T),gS+2.5*np.log10(np.abs(1-2*k))],axis=1)
+    jac = np.zeros((len(rI),5,10))
+    jac[:,0,[6,0,1]] = bL*(dr*c-r*s*dphi)
+    jac[:,1,[6,0,1]] = bL*(dr*s+r*c*dphi)
+    jac[:,2:4,[6,0,1]] = np.einsum('ij,kjp->kip',rot,dwdk[:,:,None]*dk[:,None,:]+dwdphi[:,:,None]*dphi[:,None,:])
+    jac[:,2:4,2:4] = np.einsum('ij,kjl->kil',rot,dwdv)
+    jac[:,2:4,9] = w.dot(drot.T)
+    jac[:,4,[6,0,1]] = -5/np.log(10)*dk/(1-2*k)
+    jac[:,4,4] = 1
+    jac[:,0,5] = r[:,0]*c[:,0]
+    jac[:,1,5] = r[:,0]*s[:,0]
+    jac[:,0,7] = 1
+    jac[:,1,8] = 1
+    jac[:,0,9] = -bL*r[:,0]*s[:,0]
+    jac[:,1,9] = bL*r[:,0]*c[:,0]
+    return images,jac
+
+def log_posterior_pm_and_grad(model,data):
+    """return the log10 posterior for model and data with proper motion and its gradient with respect to the model parameters"""
+    data = asLensData(data)
+    logprior = log_prior_pm_batch(model)[0]
+    if not np.isfinite(logprior) :
+        return -np.inf,np.zeros(len(model))
+    images,jac = getImages_pm_jac(model)
+    if len(images)!=len(data) :
+        return -np.inf,np.zeros(len(model))
+    logl = data.logpdf(images[None],[len(images)])[0]
+    return logprior+logl,grad_log_prior_pm(model)+data.gradient(images,jac)
+
+def grad_log_posterior_pm(model,data):
+    """return the gradient of the log10 posterior for model and data with proper motion"""
+    return log_posterior_pm_and_grad(model,data)[1]
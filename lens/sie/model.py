@@ -1,5 +1,6 @@
 import numpy as np
 from scipy import optimize
+from collections import namedtuple
 
 """
 Alex Bombrun 
@@ -45,6 +46,25 @@ def A(r,phi,f):
     A22 = 1-2*kappa(r,phi,f)*np.power(np.cos(phi),2)
     return np.array([[A11,A12],[A12,A22]])
 
+def imageKinematics(r,phi,f,dy1,dy2,theta=0.):
+    """
+    SIE image magnifications and proper motions w = R A^-1 dy, batched over any array shape
+    with the closed form A^-1 = (I - 2 kappa e e^T)/(1 - 2 kappa), e = (cos phi, sin phi)
+    r,phi : angular polar coordinate of the images
+    f : SIE lens parameter
+    dy1,dy2 : source proper motion relative to the lens
+    theta : lens orientation, R the rotation [[cos,sin],[-sin,cos]]
+    return : mu,dx1,dx2 the magnifications and the image proper motions
+    """
+    c,s = np.cos(phi),np.sin(phi)
+    k2 = 2*kappa(r,phi,f)
+    mu = 1/(1-k2)
+    p = k2*(c*dy1+s*dy2)
+    w1 = (dy1-p*c)*mu
+    w2 = (dy2-p*s)*mu
+    ct,st = np.cos(theta),np.sin(theta)
+    return mu,ct*w1+st*w2,ct*w2-st*w1
+
 def alpha(phi,f):
     """SIE deflection angle"""
     return -fRatio(f)*np.array([np.arcsinh(np.sqrt(1-f*f)*np.cos(phi)/f),np.arcsin(np.sqrt(1-f*f)*np.sin(phi))])
@@ -91,6 +111,20 @@ def eq2(phi,f,y1,y2) :
     eqB =-(y2+fRatio(f)*np.arcsin(np.sin(phi)*np.sqrt(1-f*f)))*np.cos(phi)
     return eqA+eqB
 
+def deq2(phi,f,y1,y2) :
+    """
+    derivative of the SIE lens equation eq2 with respect to phi
+    phi : polar angle of lens image
+    f : SIE lens parameter
+    y1,y2 : source location
+    """
+    s = np.sqrt(1-f*f)
+    u = s*np.cos(phi)/f
+    v = s*np.sin(phi)
+    dA = -fRatio(f)*s*np.power(np.sin(phi),2)/(f*np.sqrt(1+u*u)) + (y1+fRatio(f)*np.arcsinh(u))*np.cos(phi)
+    dB = -fRatio(f)*s*np.power(np.cos(phi),2)/np.sqrt(1-v*v) + (y2+fRatio(f)*np.arcsin(v))*np.sin(phi)
+    return dA+dB
+
 def solve(f,y1,y2) : 
     """ solve SIE lens equation with
     f : axis ratio
@@ -107,4 +141,168 @@ def solve(f,y1,y2) :
         phiI.append(root%(2*np.pi))
     phiI = np.array(phiI)
     rI = radius(phiI,f,y1,y2)
-    return rI,phiI
\ No newline at end of file
+    return rI,phiI
+
+Images = namedtuple('Images',['r','phi','n','mu','A'])
+
+def _newtonStep(phi,f,y1,y2) :
+    """
+    eq2 and eq2/deq2 sharing the intermediate terms
+    return : eq2, Newton step
+    """
+    F = fRatio(f)
+    s = np.sqrt(1-f*f)
+    c = np.cos(phi)
+    sn = np.sin(phi)
+    u = s*c/f
+    v = s*sn
+    a1 = y1+F*np.arcsinh(u)
+    a2 = y2+F*np.arcsin(v)
+    g = a1*sn-a2*c
+    dg = -F*s*sn*sn/(f*np.sqrt(1+u*u)) + a1*c - F*s*c*c/np.sqrt(1-v*v) + a2*sn
+    with np.errstate(divide='ignore',invalid='ignore') :
+        return g,g/dg
+
+def _bracketRoots(f,y1,y2,step,tol,maxiter) :
+    """
+    bracket the roots of eq2 on a periodic phi grid and refine them
+    with safeguarded Newton/bisection iterations, all sources at once
+    return : phi padded roots as an array of shape (N,4) and the number of roots
+    """
+    phiTest = np.arange(0,2*np.pi,step)
+    test = eq2(phiTest,f[:,None],y1[:,None],y2[:,None])>0
+    change = test != np.roll(test,-1,axis=1)
+    iS,iK = np.nonzero(change)
+    # keep at most 4 roots per source, in increasing phi
+    rank = np.arange(iS.size) - np.searchsorted(iS,iS)
+    keep = rank<4
+    iS,iK,rank = iS[keep],iK[keep],rank[keep]
+    a = phiTest[iK]
+    b = a+step
+    fS,y1S,y2S = f[iS],y1[iS],y2[iS]
+    ga = eq2(a,fS,y1S,y2S)
+    x = 0.5*(a+b)
+    active = np.ones(x.size,dtype=bool)
+    for i in range(maxiter) :
+        if not active.any() :
+            break
+        j = np.nonzero(active)[0]
+        fj,y1j,y2j = fS[j],y1S[j],y2S[j]
+        gx,dx = _newtonStep(x[j],fj,y1j,y2j)
+        left = (gx>0) == (ga[j]>0)
+        a[j] = np.where(left,x[j],a[j])
+        ga[j] = np.where(left,gx,ga[j])
+        b[j] = np.where(left,b[j],x[j])
+        xn = x[j]-dx
+        outside = ~((xn>=a[j]) & (xn<=b[j]))
+        xn = np.where(outside,0.5*(a[j]+b[j]),xn)
+        xn = np.where(gx==0,x[j],xn)
+        done = (np.abs(xn-x[j])<tol) | (gx==0)
+        x[j] = xn
+        active[j[done]] = False
+    phiI = np.full((f.size,4),np.nan)
+    phiI[iS,rank] = x%(2*np.pi)
+    return phiI,np.bincount(iS,minlength=f.size)
+
+def solveBatch(f,y1,y2,step=0.1,tol=1e-12,maxiter=50,chunk=65536) :
+    """ solve SIE lens equation for many sources at once
+    f : axis ratio, scalar or array
+    y1,y2 : arrays of relative source position with respect to the lens
+    step : phi grid step used to bracket the roots
+    tol : convergence tolerance on phi
+    maxiter : maximum number of Newton/bisection iterations
+    chunk : number of sources processed together, bounds the memory used by the grid
+    return : r,phi,n padded image positions in polar coordinate as arrays of shape (N,4)
+             ordered by increasing phi in [0,2pi) as in solve, nan beyond the n images of each source
+             images with r<=0 (source outside the cut) are dropped
+    """
+    f,y1,y2 = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v,dtype=float)) for v in (f,y1,y2)))
+    phiI = np.full((f.size,4),np.nan)
+    for k in range(0,f.size,chunk) :
+        sl = slice(k,k+chunk)
+        phiI[sl] = _bracketRoots(f[sl],y1[sl],y2[sl],step,tol,maxiter)[0]
+    rI = radius(phiI,f[:,None],y1[:,None],y2[:,None])
+    valid = rI>0
+    # move the dropped images at the end of each row
+    order = np.argsort(~valid,axis=-1,kind='stable')
+    rI = np.take_along_axis(np.where(valid,rI,np.nan),order,axis=-1)
+    phiI = np.take_along_axis(np.where(valid,phiI,np.nan),order,axis=-1)
+    return rI,phiI,valid.sum(axis=-1)
+
+def imagesBatch(f,y1,y2,**kwargs) :
+    """ solve SIE lens equation for many sources at once
+    f : axis ratio, scalar or array
+    y1,y2 : arrays of relative source position with respect to the lens
+    kwargs : passed to solveBatch
+    return : Images(r,phi,n,mu,A) with the padded image positions, the image counts,
+             the magnifications of shape (N,4) and the distortion matrices of shape (N,4,2,2)
+    """
+    rI,phiI,n = solveBatch(f,y1,y2,**kwargs)
+    f = np.broadcast_to(np.asarray(f,dtype=float).reshape(-1,1),rI.shape[:1]+(1,))
+    mu = magnification(rI,phiI,f)
+    a = np.moveaxis(A(rI,phiI,f),(0,1),(-2,-1))
+    return Images(rI,phiI,n,mu,a)
+
+def eq2Partials(phi,f,y1,y2) :
+    """
+    partial derivatives of the SIE lens equation eq2
+    return : d/dphi, d/df, d/dy1, d/dy2
+    """
+    F = fRatio(f)
+    dF = F*(1/(2*f)+f/(1-f*f))
+    s = np.sqrt(1-f*f)
+    u = s*np.cos(phi)/f
+    v = s*np.sin(phi)
+    da1 = dF*np.arcsinh(u) - F*np.cos(phi)/(f*f*s*np.sqrt(1+u*u))
+    da2 = dF*np.arcsin(v) - F*f*np.sin(phi)/(s*np.sqrt(1-v*v))
+    dphi = deq2(phi,f,y1,y2)
+    df = da1*np.sin(phi) - da2*np.cos(phi)
+    return dphi,df,np.sin(phi),-np.cos(phi)
+
+def radiusPartials(phi,f,y1,y2) :
+    """
+    partial derivatives of the SIE lens equation radius
+    return : d/dphi, d/df, d/dy1, d/dy2
+    """
+    F = fRatio(f)
+    dF = F*(1/(2*f)+f/(1-f*f))
+    s = np.sqrt(1-f*f)
+    u = s*np.cos(phi)/f
+    v = s*np.sin(phi)
+    a1 = F*np.arcsinh(u)
+    a2 = F*np.arcsin(v)
+    da1 = -F*s*np.sin(phi)/(f*np.sqrt(1+u*u))
+    da2 = F*s*np.cos(phi)/np.sqrt(1-v*v)
+    dphi = -(y1+a1)*np.sin(phi) + (y2+a2)*np.cos(phi) + np.cos(phi)*da1 + np.sin(phi)*da2
+    df = np.cos(phi)*(dF*np.arcsinh(u) - F*np.cos(phi)/(f*f*s*np.sqrt(1+u*u)))
+    df = df + np.sin(phi)*(dF*np.arcsin(v) - F*f*np.sin(phi)/(s*np.sqrt(1-v*v)))
+    return dphi,df,np.cos(phi),np.sin(phi)
+
+def kappaPartials(r,phi,f) :
+    """
+    partial derivatives of the SIE dimensionless surface mass density kappa
+    return : d/dr, d/dphi, d/df
+    """
+    k = kappa(r,phi,f)
+    D2 = np.power(np.cos(phi),2)+np.power(f,2)*np.power(np.cos(phi),2)
+    dD2phi = -2*np.cos(phi)*np.sin(phi)*(1+np.power(f,2))
+    dD2f = 2*f*np.power(np.cos(phi),2)
+    return -k/r,-0.5*k*dD2phi/D2,k*(0.5/f-0.5*dD2f/D2)
+
+def imageDerivatives(r,phi,f,y1,y2) :
+    """
+    derivatives of the image position and of kappa with respect to the source and lens parameters
+    the image angle follows the lens equation eq2(phi,f,y1,y2)=0 (implicit function theorem)
+    r,phi : image polar coordinates, solutions of the lens equation
+    f : SIE lens parameter
+    y1,y2 : source location
+    return : dphi,dr,dkappa arrays of shape r.shape+(3,) with the derivatives with respect to f,y1,y2
+    """
+    e = eq2Partials(phi,f,y1,y2)
+    dphi = np.stack([-e[1]/e[0],-e[2]/e[0],-e[3]/e[0]],axis=-1)
+    rp = radiusPartials(phi,f,y1,y2)
+    dr = rp[0][...,None]*dphi + np.stack(rp[1:],axis=-1)
+    kp = kappaPartials(r,phi,f)
+    dkappa = kp[0][...,None]*dr + kp[1][...,None]*dphi
+    dkappa[...,0] += kp[2]
+    return dphi,dr,dkappa
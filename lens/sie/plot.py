@@ -37,7 +37,7 @@ def plotSourceImage(y1,y2,f,ax = plt.subplot(111,aspect='equal')):
     xs,phis = sie.solve(f,y1,y2)
     dy =  circle(0.1)
     for phi,x in zip(phis,xs) :
-        dx = np.dot(np.linalg.inv(sie.A(x,phi,f)),dy)
+        dx = sie.imageKinematics(x,phi,f,dy[0],dy[1])[1:]
         x1 = x*np.cos(phi)
         x2 = x*np.sin(phi)
         ax.scatter(x1,x2,color='C0')#s = np.exp(np.abs(mag(x,phi,f)))
@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import astropy.units as u
 import healpy as hp
+from concurrent.futures import ProcessPoolExecutor
 
 from lens.sie.plot import *
 
@@ -25,19 +26,12 @@ def lensedQSO(f,scale,w,y,dy,gy):
     xs,phis = sie.solve(f,y[0],y[1])
     
     # compute images position proper motion and magnitude 
-    ra = []
-    dec = []
-    pmra = []
-    pmdec = []
-    g = []
-    R = np.array([[np.cos(w),np.sin(w)],[-np.sin(w),np.cos(w)]])
-    for phi,x in zip(phis,xs) :
-        dx = np.dot(R,np.dot(np.linalg.inv(sie.A(x,phi,f)),dy))
-        ra.append(x*np.cos(phi+w)*scale)
-        dec.append(x*np.sin(phi+w)*scale)
-        pmra.append(dx[0]*scale)
-        pmdec.append(dx[1]*scale)
-        g.append(gy-2.5*np.log10(np.abs(sie.magnification(x,phi,f))))
+    mu,dx1,dx2 = sie.imageKinematics(xs,phis,f,dy[0],dy[1],w)
+    ra = xs*np.cos(phis+w)*scale
+    dec = xs*np.sin(phis+w)*scale
+    pmra = dx1*scale
+    pmdec = dx2*scale
+    g = gy-2.5*np.log10(np.abs(mu))
     
     # set a pandas data frame to store the result
     res = pd.DataFrame()
@@ -48,11 +42,23 @@ def lensedQSO(f,scale,w,y,dy,gy):
     res['phot_g_mean_mag'] = g
     return res
 
-def getSourceId(ra_rad,dec_rad):
+SOURCE_ID_RANGE = 34359738368
+
+def getSourceId(ra_rad,dec_rad,rng=None,index=None):
+    """
+    Gaia like source_id, the healpix index 12 times 2^35 plus a random number
+    rng : numpy.random.Generator or RandomState, default the global numpy random state
+    index : unique numbers in [0,2^35) used instead of the random number, the source_ids are then unique
+    """
     x = np.asarray(ra_rad)
     y = np.asarray(dec_rad)
-    s=34359738368
+    s=SOURCE_ID_RANGE
     sourceid = angle2pixel(x*u.rad.to(u.deg),y*u.rad.to(u.deg))*s
+    if index is not None :
+        return sourceid + np.asarray(index,dtype=np.int64)
+    if rng is not None :
+        integers = rng.integers if hasattr(rng,'integers') else rng.randint
+        return sourceid + integers(0,s,x.shape,dtype=np.int64)
     if x.size==1 :
         return sourceid + np.int64(np.random.uniform(0,s))
     else :
@@ -101,7 +107,102 @@ def randomLQSO(verbose=False):
     res['qsoid'] = res.phot_g_mean_mag.idxmin()
     return res
 
-def generateLQSO(n):
-    """return n random QSO in a pandas DataFrame"""
-    res = [randomLQSO() for i in range(0,n)]
-    return pd.concat(res)
\ No newline at end of file
+def randomSky(n,rng,minLatitude=10*u.deg.to(u.rad)):
+    """n random sky locations in rad as randomLQSO, avoiding the poles and the low latitudes"""
+    ra = rng.uniform(0,2*np.pi,n)
+    dec = rng.uniform(-np.pi/2+0.1,np.pi/2-0.1,n) # a bit wrong as we exclude the pole
+    bad = np.abs(dec) < minLatitude
+    while bad.any() :
+        dec[bad] = rng.uniform(-np.pi/2+0.1,np.pi/2-0.1,bad.sum())
+        bad = np.abs(dec) < minLatitude
+    return ra,dec
+
+def randomLQSOBatch(n,rng,offset=None):
+    """
+    n random lensed QSOs drawn as randomLQSO but as arrays, the images being solved in batch
+    rng : numpy.random.Generator or RandomState
+    offset : if given the images are numbered from offset in their source_id instead of a random number
+    return : a pandas DataFrame of the images indexed by source_id, qsoid being the source_id of the brightest image
+    """
+    scale = rng.uniform(1,2,n)
+    f = rng.uniform(size=n)
+    y = rng.uniform(-0.5,0.5,(n,2))
+    dy = rng.normal(0,0.1,(n,2))
+    gy = rng.uniform(18,20,n)
+    w = rng.uniform(0,2*np.pi,n)
+    ra0,dec0 = randomSky(n,rng)
+
+    # images of all the systems, padded arrays of shape (n,4)
+    xs,phis,nI = sie.solveBatch(f,y[:,0],y[:,1])
+    mu,dx1,dx2 = sie.imageKinematics(xs,phis,f[:,None],dy[:,:1],dy[:,1:],w[:,None])
+    valid = np.arange(xs.shape[1])<nI[:,None]
+    iS = np.nonzero(valid)[0]
+    k = scale[:,None]*u.arcsecond.to(u.rad)
+    ra = (ra0[:,None] + xs*np.cos(phis+w[:,None])*k)[valid]
+    dec = (dec0[:,None] + xs*np.sin(phis+w[:,None])*k)[valid]
+    g = gy[:,None]-2.5*np.log10(np.abs(mu))
+
+    index = None if offset is None else offset+np.arange(len(ra))
+    sourceId = getSourceId(ra,dec,rng,index)
+    brightest = np.argmin(np.where(valid,g,np.inf),axis=1)
+    first = np.cumsum(nI)-nI
+    res = pd.DataFrame({'ra':ra,'dec':dec,
+                        'pmra':(dx1*scale[:,None])[valid],'pmdec':(dx2*scale[:,None])[valid],
+                        'phot_g_mean_mag':g[valid],'source_id':sourceId,
+                        'qsoid':sourceId[(first+brightest)[iS]]})
+    res.index = res.source_id
+    return res
+
+def generateLQSOChunks(n,chunk=100000,rng=None):
+    """
+    generate n random lensed QSOs by chunks
+    chunk : number of systems per chunk
+    rng : numpy.random.Generator, RandomState or seed, default the global numpy random state (np.random.seed)
+    return : a generator of pandas DataFrame as randomLQSOBatch
+    """
+    if rng is None :
+        rng = np.random.mtrand._rand
+    elif not isinstance(rng,np.random.RandomState) :
+        rng = np.random.default_rng(rng)
+    for k in range(0,n,chunk) :
+        yield randomLQSOBatch(min(chunk,n-k),rng)
+
+def generateLQSO(n,rng=None):
+    """
+    return n random QSO in a pandas DataFrame, see generateLQSOChunks
+    the images are solved by sie.solveBatch: unlike sie.solve in randomLQSO the images
+    with r<=0 and the duplicated roots are dropped
+    """
+    return pd.concat(generateLQSOChunks(n,rng=rng))
+
+
+def chunkSeed(seed,k):
+    """the seed of chunk k, the k-th child of SeedSequence(seed) as given by spawn"""
+    return np.random.SeedSequence(seed,spawn_key=(k,))
+
+def simulateChunk(k,chunk=100000,seed=0,n=None):
+    """
+    generate the chunk k of a simulation, the same chunk is regenerated bit for bit from (k,chunk,seed)
+    the images of the chunk are numbered from 4*chunk*k so that the source_ids are unique over the simulation
+    n : number of systems of the chunk, default chunk, smaller for the last chunk of a simulation
+    return : a pandas DataFrame as randomLQSOBatch
+    """
+    n = chunk if n is None else n
+    return randomLQSOBatch(n,np.random.default_rng(chunkSeed(seed,k)),offset=4*chunk*k)
+
+def simulateLQSO(n,chunk=100000,seed=0,max_workers=None):
+    """
+    generate n random lensed QSOs in a process pool, one independent random stream per chunk
+    the result does not depend on the number of workers
+    n : number of systems
+    chunk : number of systems per chunk
+    max_workers : number of processes, default the number of cores
+    return : a generator of pandas DataFrame, one per chunk in order
+    """
+    nchunks = -(-n//chunk)
+    if 4*chunk*nchunks > SOURCE_ID_RANGE :
+        raise ValueError("too many systems for unique source_ids: %d" % n)
+    sizes = [min(chunk,n-k*chunk) for k in range(nchunks)]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool :
+        for res in pool.map(simulateChunk,range(nchunks),[chunk]*nchunks,[seed]*nchunks,sizes) :
+            yield res
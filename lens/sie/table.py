@@ -0,0 +1,152 @@
+"""
+Persistent SIE image solution table
+
+a grid over the axis ratio f and the source position (y1,y2) holding the image count
+and the image polar angles, stored on disk and memory-mapped.
+The table warm-starts the root finder: the roots at the nearest grid node are polished
+with a few Newton steps on eq2, sources near a caustic or outside the grid fall back to solveBatch.
+The table is versioned and invalidated when the lens equation changes.
+
+the table is opt-in: pass it as the solver of the batched posteriors, e.g.
+log_posterior_pm_batch(models,data,solver=loadTable(path)), which otherwise use sie.solveBatch.
+"""
+
+import os
+import json
+import inspect
+import hashlib
+import numpy as np
+
+import lens.sie.model as sie
+
+VERSION = 1
+
+def modelHash():
+    """hash of the SIE lens equation implementation, changes when eq2 or psiTilde change"""
+    src = ''.join(inspect.getsource(fn) for fn in (sie.fRatio,sie.psiTilde,sie.radius,sie.eq2,sie._newtonStep))
+    return hashlib.sha1(src.encode()).hexdigest()
+
+def _axis(start,stop,step):
+    n = int(round((stop-start)/step))+1
+    return {'start':float(start),'step':float(step),'n':n}
+
+def _values(axis):
+    return axis['start']+axis['step']*np.arange(axis['n'])
+
+def buildTable(path,f=(0.05,0.95,0.01),y=(-1.,1.,0.02),chunk=65536):
+    """
+    solve the SIE lens equation on a grid and save the table in the directory path
+    f : (start,stop,step) of the axis ratio grid
+    y : (start,stop,step) of the source position grid, used for y1 and y2
+    return : the memory-mapped SolutionTable
+    """
+    fAxis = _axis(*f)
+    yAxis = _axis(*y)
+    fG,y1G,y2G = np.meshgrid(_values(fAxis),_values(yAxis),_values(yAxis),indexing='ij')
+    shape = fG.shape
+    rI,phiI,n = sie.solveBatch(fG.ravel(),y1G.ravel(),y2G.ravel(),chunk=chunk)
+    os.makedirs(path,exist_ok=True)
+    np.save(os.path.join(path,'phi.npy'),phiI.reshape(shape+(4,)).astype(np.float32))
+    np.save(os.path.join(path,'n.npy'),n.reshape(shape).astype(np.int8))
+    meta = {'version':VERSION,'model':modelHash(),'f':fAxis,'y':yAxis}
+    with open(os.path.join(path,'meta.json'),'w') as fp :
+        json.dump(meta,fp)
+    return SolutionTable(path)
+
+def loadTable(path,build=True,**kwargs):
+    """
+    open the table stored in path, (re)building it if it is missing or out of date
+    path : table directory
+    build : if False raise a ValueError instead of building the table
+    kwargs : grid definition passed to buildTable
+    """
+    try :
+        return SolutionTable(path)
+    except (IOError,ValueError) as e :
+        if not build :
+            raise ValueError("no valid SIE solution table in %s: %s" % (path,e))
+        return buildTable(path,**kwargs)
+
+
+class SolutionTable :
+    """
+    memory-mapped SIE solution table
+    phi : image angles of shape (nf,ny,ny,4), nan padded
+    n : image counts of shape (nf,ny,ny)
+    """
+
+    def __init__(self,path) :
+        with open(os.path.join(path,'meta.json')) as fp :
+            meta = json.load(fp)
+        if meta.get('version') != VERSION or meta.get('model') != modelHash() :
+            raise ValueError("SIE solution table %s is out of date" % path)
+        self.path = path
+        self.fAxis = meta['f']
+        self.yAxis = meta['y']
+        self.phi = np.load(os.path.join(path,'phi.npy'),mmap_mode='r')
+        self.n = np.load(os.path.join(path,'n.npy'),mmap_mode='r')
+
+    def _index(self,v,axis):
+        """lower grid index of the cell containing v and whether v is inside the grid"""
+        x = (v-axis['start'])/axis['step']
+        i = np.floor(x).astype(np.int64)
+        inside = (i>=0) & (i<axis['n']-1)
+        return np.clip(i,0,axis['n']-2),np.clip(np.rint(x).astype(np.int64),0,axis['n']-1),inside
+
+    def warmStart(self,f,y1,y2):
+        """
+        return : phi,n the roots at the nearest grid node and whether they can be trusted,
+        i.e. the source lies inside the grid and all the corners of its cell have the same image count
+        """
+        i,ni,inF = self._index(f,self.fAxis)
+        j,nj,in1 = self._index(y1,self.yAxis)
+        k,nk,in2 = self._index(y2,self.yAxis)
+        n = np.asarray(self.n[ni,nj,nk])
+        trusted = inF & in1 & in2
+        for di in (0,1) :
+            for dj in (0,1) :
+                for dk in (0,1) :
+                    trusted &= np.asarray(self.n[i+di,j+dj,k+dk]) == n
+        return np.asarray(self.phi[ni,nj,nk],dtype=float),n.astype(np.int64),trusted
+
+    def solveBatch(self,f,y1,y2,polish=4,tol=1e-8,**kwargs):
+        """ solve SIE lens equation for many sources using the table as warm start
+        f : axis ratio, scalar or array
+        y1,y2 : arrays of relative source position with respect to the lens
+        polish : maximum number of Newton steps applied to the tabulated roots
+        tol : largest accepted last Newton step, otherwise the source is solved with sie.solveBatch
+        kwargs : passed to sie.solveBatch for the fallback
+        return : r,phi,n as sie.solveBatch
+        """
+        f,y1,y2 = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v,dtype=float)) for v in (f,y1,y2)))
+        phiI,n,ok = self.warmStart(f,y1,y2)
+        valid = np.arange(4)<n[:,None]
+        iS,iK = np.nonzero(valid & ok[:,None])
+        fS,y1S,y2S = f[iS],y1[iS],y2[iS]
+        x = phiI[iS,iK]
+        dx = np.full(x.size,np.inf)
+        active = np.arange(x.size)
+        for it in range(polish) :
+            dx[active] = sie._newtonStep(x[active],fS[active],y1S[active],y2S[active])[1]
+            x[active] -= dx[active]
+            active = active[~(np.abs(dx[active])<tol)]
+        phiI[iS,iK] = x%(2*np.pi)
+        phiI[~valid] = np.nan
+        rI = sie.radius(phiI,f[:,None],y1[:,None],y2[:,None])
+        bad = np.zeros(f.size,dtype=bool)
+        with np.errstate(invalid='ignore') :
+            np.logical_or.at(bad,iS,~(np.abs(dx)<tol))
+            bad |= ~np.where(valid,rI>0,True).all(axis=-1)
+            bad |= ~np.where(valid[:,1:],np.diff(phiI,axis=-1)>0,True).all(axis=-1)
+        ok &= ~bad
+        if not ok.all() :
+            m = ~ok
+            rI[m],phiI[m],n[m] = sie.solveBatch(f[m],y1[m],y2[m],**kwargs)
+        return rI,phiI,n
+
+    def solve(self,f,y1,y2):
+        """ solve SIE lens equation for one source, same output as sie.solve
+        return : r,phi image position in polar coordinate as arrays of length 2 or 4
+        """
+        rI,phiI,n = self.solveBatch(f,y1,y2)
+        return rI[0,:n[0]],phiI[0,:n[0]]
@@ -0,0 +1,290 @@
+"""
+Simulated Gaia DR2 query around known QSOs
+
+the pipeline of the notebooks Simulation of DR2 query part 1-3 (data/simDataSet1.csv.gzip) as a streaming job:
+the QSO base catalogue is read by chunks, each chunk gets Gaia like errors, its contaminant stars drawn
+from the per pixel contaminant model and some random lensed QSOs, and the rows are appended to
+columnar files partitioned by HEALPix pixel, outdir/hp<level>=<pixel>/part-<chunk>.parquet
+(or .npz when pyarrow is not available). Nothing larger than a chunk is held in memory.
+
+python -m lens.simulation qso.csv contaminantModel.csv starModel.npz outdir
+"""
+
+import os
+import glob
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+import healpy as hp
+import astropy.units as u
+from astropy.coordinates import SkyCoord
+
+from lens.sie.random import randomLQSOBatch, chunkSeed, SOURCE_ID_RANGE
+from gaiapix.gaiapix import gaiapix, sourceIdToPixel
+
+try :
+    import pyarrow
+    FORMAT = 'parquet'
+except ImportError :
+    FORMAT = 'npz'
+
+COLUMNS = ['ra','ra_error','dec','dec_error','parallax','parallax_error',
+           'pmra','pmra_error','pmdec','pmdec_error','phot_g_mean_mag',
+           'source_id','astrometric_pseudo_colour','qsoid','type']
+
+
+def positionError(g):
+    """DR1 like position error in mas as a function of G"""
+    x = np.maximum(np.asarray(g)-15,0)
+    return 0.05*np.exp(0.2*x*x)
+
+def pmError(g):
+    """DR2 like proper motion error in mas/yr as a function of G"""
+    return 0.06*np.exp(0.6*np.maximum(np.asarray(g)-15,0))
+
+def parallaxError(g):
+    """DR2 like parallax error in mas as a function of G"""
+    x = np.maximum(np.asarray(g)-15,0)
+    return 0.04*np.exp(0.5*x+0.01*x*x)
+
+
+def histogramModel(data,range=(-1,1),bins=1000):
+    """
+    the empirical distribution of data used by randomFromModel
+    return : array of shape (2,bins) with the bin mid points and the cumulative distribution
+    """
+    hist,edges = np.histogram(data,bins=bins,range=range)
+    cdf = np.cumsum(hist)
+    return np.array([edges[:-1]+np.diff(edges)/2,cdf/cdf[-1]])
+
+def randomFromModel(model,n,rng):
+    """generate n random points following the distribution of a histogramModel"""
+    mids,cdf = model
+    return mids[np.searchsorted(cdf,rng.random(n))]
+
+def buildStarModel(gum,tgas,qso=None,bins=1000):
+    """
+    the contaminant star distributions of the notebook part 3
+    gum : Gaia universe model (VizieR VI/137/gum_mw) with Gmag, pmRA, pmDE columns
+    tgas : TGAS (VizieR I/337/tgas) with a Plx column
+    qso : optional QSO g magnitudes (e.g. ALLWISE gmag) used when the base catalogue has no phot_g_mean_mag
+    return : dict name -> histogramModel, to be saved with np.savez
+    """
+    d0 = gum[(gum.Gmag<21) & (gum.Gmag>3)]
+    res = {'phot_g_mean_mag':histogramModel(d0.Gmag,(3,21),bins),
+           'pmra':histogramModel(d0.pmRA,(-100,100),bins),
+           'pmdec':histogramModel(d0.pmDE,(-100,100),bins),
+           'parallax':histogramModel(tgas.Plx,(-10,100),bins)}
+    if qso is not None :
+        qso = np.asarray(qso)
+        res['qso_phot_g_mean_mag'] = histogramModel(qso[qso<21],(15,22),bins)
+    return res
+
+def loadStarModel(path):
+    """return the star model saved by np.savez(path,**buildStarModel(...))"""
+    with np.load(path) as m :
+        return {k:m[k] for k in m.files}
+
+def loadContaminantModel(path,level=6):
+    """
+    return the expected number of contaminants of each pixel as a dense array
+    path : csv of the notebook part 1 with hp and n_outliers columns,
+           or a map saved by gaiapix.save (memory mapped)
+    """
+    if os.path.isdir(path) :
+        m = gaiapix.load(path)
+        if m.healpix_level != level :
+            raise ValueError("contaminant model %s is at level %d, not %d" % (path,m.healpix_level,level))
+        return m.values
+    m = pd.read_csv(path)
+    res = np.zeros(hp.nside2npix(2**level))
+    res[m.hp.values] = m.n_outliers.values
+    return res
+
+
+def pixel(ra_deg,dec_deg,level=12):
+    """nested healpix index of the given level"""
+    return hp.ang2pix(2**level,np.asarray(ra_deg),np.asarray(dec_deg),nest=True,lonlat=True)
+
+def setSourceId(p_df,counter):
+    """set Gaia like unique source_ids, the healpix index 12 times 2^35 plus a running number"""
+    p_df['source_id'] = pixel(p_df.ra.values,p_df.dec.values)*SOURCE_ID_RANGE + counter + np.arange(len(p_df))
+    return counter+len(p_df)
+
+def addErrors(p_df,rng,parallax=True):
+    """add the error columns, and a parallax drawn from its error when parallax is True"""
+    g = p_df.phot_g_mean_mag.values
+    p_df['ra_error'] = positionError(g)
+    p_df['dec_error'] = p_df['ra_error']
+    p_df['pmra_error'] = pmError(g)
+    p_df['pmdec_error'] = p_df['pmra_error']
+    p_df['parallax_error'] = parallaxError(g)
+    if parallax :
+        p_df['parallax'] = rng.normal(0,p_df.parallax_error.values)
+
+
+def simulateQSO(qso,rng,starModel,sinb=0.1):
+    """
+    the QSO rows of a chunk of the base catalogue
+    qso : DataFrame with ra, dec in deg and optionally phot_g_mean_mag, pmra, pmdec, parallax
+    sinb : QSOs with |sin b| below are ignored (galactic band)
+    """
+    res = pd.DataFrame({'ra':qso.ra.values,'dec':qso.dec.values})
+    if sinb > 0 :
+        b = SkyCoord(res.ra.values,res.dec.values,unit=u.deg).galactic.b.rad
+        keep = np.abs(np.sin(b))>sinb
+        res,qso = res[keep].reset_index(drop=True),qso[keep]
+    if 'phot_g_mean_mag' in qso :
+        res['phot_g_mean_mag'] = qso.phot_g_mean_mag.values
+    else :
+        res['phot_g_mean_mag'] = randomFromModel(starModel['qso_phot_g_mean_mag'],len(res),rng)
+    addErrors(res,rng,parallax=True)
+    for c in ['pmra','pmdec','parallax'] :
+        res[c] = qso[c].values if c in qso else rng.normal(0,res[c+'_error'].values)
+    res['astrometric_pseudo_colour'] = rng.normal(1.7,0.2,len(res))
+    res['type'] = 'QSO'
+    return res
+
+def simulateStars(qso,rng,contaminants,starModel,radius=5,level=6):
+    """
+    the contaminant stars around the QSOs, a Poisson number per QSO given the contaminant model
+    of its pixel, uniformly dispatched within radius arcsec in dec and in ra*cos(dec)
+    """
+    n = rng.poisson(contaminants[pixel(qso.ra.values,qso.dec.values,level)])
+    host = np.repeat(np.arange(len(qso)),n)
+    d = radius*u.arcsec.to(u.deg)
+    cosdec = np.maximum(np.cos(np.deg2rad(qso.dec.values[host])),1e-6)
+    res = pd.DataFrame({'ra':np.mod(qso.ra.values[host]+rng.uniform(-d,d,len(host))/cosdec,360),
+                        'dec':np.clip(qso.dec.values[host]+rng.uniform(-d,d,len(host)),-90,90),
+                        'qsoid':qso.source_id.values[host]})
+    for c in ['phot_g_mean_mag','pmra','pmdec'] :
+        res[c] = randomFromModel(starModel[c],len(res),rng)
+    addErrors(res,rng,parallax=False)
+    res['parallax'] = randomFromModel(starModel['parallax'],len(res),rng)-2*res.parallax_error.values
+    res['astrometric_pseudo_colour'] = rng.normal(1.6,0.2,len(res))
+    res['type'] = 'STAR'
+    return res
+
+def simulateLenses(n,rng,counter):
+    """n random lensed QSOs as lens.sie.random.randomLQSOBatch with Gaia like errors"""
+    res = randomLQSOBatch(n,rng,offset=counter).reset_index(drop=True)
+    res['ra'] = res.ra.values*u.rad.to(u.deg)
+    res['dec'] = res.dec.values*u.rad.to(u.deg)
+    addErrors(res,rng,parallax=True)
+    # one colour per system with a small scatter between the images
+    system,index = np.unique(res.qsoid.values,return_inverse=True)
+    res['astrometric_pseudo_colour'] = rng.normal(rng.normal(1.6,0.2,len(system))[index],0.05)
+    res['type'] = 'LQSO_true'
+    return res
+
+
+def writePartition(p_df,path):
+    """write a DataFrame as a columnar file, parquet when pyarrow is available otherwise npz"""
+    if FORMAT == 'parquet' :
+        p_df.to_parquet(path+'.parquet',index=False)
+    else :
+        columns = {c:p_df[c].to_numpy() for c in p_df.columns}
+        np.savez(path+'.npz',**{c:v.astype(str) if v.dtype==object else v for c,v in columns.items()})
+
+def readPartition(path):
+    """read a file written by writePartition"""
+    if path.endswith('.parquet') :
+        return pd.read_parquet(path)
+    with np.load(path,allow_pickle=False) as d :
+        return pd.DataFrame({c:d[c] for c in d.files})
+
+def partitions(outdir):
+    """return dict pixel -> list of files of the partitioned output in outdir"""
+    res = {}
+    for path in sorted(glob.glob(os.path.join(outdir,'hp*=*','part-*.*'))) :
+        res.setdefault(int(os.path.basename(os.path.dirname(path)).split('=')[1]),[]).append(path)
+    return res
+
+def partitionLevel(outdir):
+    """return the healpix level of the partitioned output in outdir, None when empty"""
+    dirs = glob.glob(os.path.join(outdir,'hp*=*'))
+    return int(os.path.basename(dirs[0]).split('=')[0][2:]) if dirs else None
+
+def readPixel(outdir,i):
+    """return the rows of the partition i of outdir as one DataFrame"""
+    return pd.concat([readPartition(p) for p in partitions(outdir).get(i,[])],ignore_index=True)
+
+def writeChunk(p_df,outdir,k,level):
+    """append a chunk to the partitioned output, one file per pixel of the given level"""
+    pix = sourceIdToPixel(p_df.source_id.values,level)
+    order = np.argsort(pix,kind='stable')
+    pix = pix[order]
+    p_df = p_df.iloc[order]
+    bounds = np.flatnonzero(np.diff(pix))+1
+    for start,stop in zip(np.r_[0,bounds],np.r_[bounds,len(pix)]) :
+        path = os.path.join(outdir,'hp%d=%d' % (level,pix[start]))
+        os.makedirs(path,exist_ok=True)
+        writePartition(p_df.iloc[start:stop],os.path.join(path,'part-%05d' % k))
+
+
+def simulateDR2(qso,contaminants,starModel,outdir,level=3,chunksize=1000000,lensRate=1e-4,
+                seed=0,radius=5,contaminantLevel=6,sinb=0.1,overwrite=False):
+    """
+    stream the simulated DR2 query to a partitioned columnar output
+    qso : path of a csv QSO base catalogue (ra, dec in deg), or an iterable of DataFrame chunks
+    contaminants : expected number of contaminants per pixel, see loadContaminantModel
+    starModel : dict of histogramModel, see buildStarModel
+    outdir : output directory
+    level : healpix level of the output partitions
+    chunksize : number of QSOs per chunk
+    lensRate : expected number of random lensed QSOs per QSO
+    seed : chunk k uses the random stream chunkSeed(seed,k)
+    overwrite : to remove the partitions of a previous output, otherwise a non empty outdir
+                raises ValueError (the part files of two runs would be mixed by readPixel)
+    return : the number of rows written per type
+    """
+    if isinstance(qso,str) :
+        qso = pd.read_csv(qso,chunksize=chunksize)
+    if os.path.isdir(outdir) and os.listdir(outdir) :
+        if not overwrite :
+            raise ValueError("output directory %s is not empty" % outdir)
+        for d in os.listdir(outdir) :
+            if d.startswith('hp') and os.path.isdir(os.path.join(outdir,d)) :
+                shutil.rmtree(os.path.join(outdir,d))
+    os.makedirs(outdir,exist_ok=True)
+    counter = 0
+    counts = {}
+    for k,chunk in enumerate(qso) :
+        rng = np.random.default_rng(chunkSeed(seed,k))
+        q = simulateQSO(chunk,rng,starModel,sinb)
+        counter = setSourceId(q,counter)
+        q['qsoid'] = q.source_id
+        s = simulateStars(q,rng,contaminants,starModel,radius,contaminantLevel)
+        counter = setSourceId(s,counter)
+        l = simulateLenses(rng.poisson(lensRate*len(q)),rng,counter)
+        counter += len(l)
+        if counter > SOURCE_ID_RANGE :
+            raise ValueError("too many sources for unique source_ids: %d" % counter)
+        res = pd.concat([q[COLUMNS],s[COLUMNS],l[COLUMNS]],ignore_index=True)
+        writeChunk(res,outdir,k,level)
+        for t,n in res.groupby('type').size().items() :
+            counts[t] = counts.get(t,0)+int(n)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="simulated Gaia DR2 query around known QSOs")
+    parser.add_argument('qso',help="csv QSO base catalogue with ra, dec in deg")
+    parser.add_argument('contaminants',help="csv contaminant model with hp and n_outliers columns")
+    parser.add_argument('stars',help="npz star model, see buildStarModel")
+    parser.add_argument('outdir',help="output directory")
+    parser.add_argument('--level',type=int,default=3,help="healpix level of the output partitions")
+    parser.add_argument('--chunksize',type=int,default=1000000)
+    parser.add_argument('--lens-rate',type=float,default=1e-4)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--overwrite',action='store_true',help="remove the partitions of a previous output")
+    args = parser.parse_args(argv)
+    counts = simulateDR2(args.qso,loadContaminantModel(args.contaminants),loadStarModel(args.stars),args.outdir,
+                         level=args.level,chunksize=args.chunksize,lensRate=args.lens_rate,seed=args.seed,
+                         overwrite=args.overwrite)
+    for t,n in sorted(counts.items()) :
+        print("%s: %d" % (t,n))
+
+if __name__ == '__main__' :
+    main()
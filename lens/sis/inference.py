@@ -7,6 +7,8 @@ from LQSO images position and magnitude
 import lens.sis.model as sis 
 import numpy as np
 from scipy.stats import beta, uniform, norm, gamma, cauchy, multivariate_normal
+from scipy.special import gammaln
+from lens.data import asLensData
 
 def radiusPrior(b):
     """SIS Einstein radius prior in as"""
@@ -48,23 +50,108 @@ def getImages(model):
         res.append([bL*r*np.cos(phi)+xL,bL*r*np.sin(phi)+yL,g])
     return res
     
-def log_likelihood(model,data) :
-    """Return log10 (normalized) likelihood: P(3D astrometry | 3D phase space, Covariance)"""
-    functions = []
-    for s in data :
-        functions.append(imageLikelyhood(s))
-    images = getImages(model)
+def log_likelihood(model,data,match=False,detection=None) :
+    """Return log10 (normalized) likelihood: P(3D astrometry | 3D phase space, Covariance)
+    data : LensData or array of x,y,g,xe,ye,ge rows
+    """
+    images = np.array(getImages(model)).reshape(1,-1,3)
+    return asLensData(data).logpdf(images,[images.shape[1]],match,detection)[0]
     
-    if(len(images)==len(functions)): # probably a very bad idea
-        res = []
-        for point,f in zip(images,functions):
-            res.append(f.logpdf(point)/np.log(10))
-        return sum(res)
-    else :
-        return -np.inf
-    
-def log_posterior(model,data) :
+def log_posterior(model,data,match=False,detection=None) :
     logprior = log_prior(model)
-    res = logprior + log_likelihood(model,data) if np.isfinite(logprior) else -np.inf
+    res = logprior + log_likelihood(model,data,match,detection) if np.isfinite(logprior) else -np.inf
     return np.array(res)
     
+
+def logPositionPrior(x):
+    """log10 of the SIS source and lens position prior"""
+    return (-0.5*np.power(x/0.1,2) - np.log(0.1*np.sqrt(2*np.pi)))/np.log(10)
+
+def logMagnitudePrior(x):
+    """log10 of the SIS source magnitude prior"""
+    with np.errstate(divide='ignore',invalid='ignore') :
+        res = 9*np.log(x-5) - (x-5) - gammaln(10)
+    return np.where(x>5,res,-np.inf)/np.log(10)
+
+def logRadiusPrior(b):
+    """log10 of the SIS Einstein radius prior in as"""
+    with np.errstate(divide='ignore',invalid='ignore') :
+        res = 2*np.log(b) - b - np.log(2)
+    return np.where(b>0,res,-np.inf)/np.log(10)
+
+def log_prior_batch(models):
+    """Return log10 of the priors for an array of models of shape (nwalkers,6)"""
+    (xS,yS,gS,bL,xL,yL) = tuple(np.atleast_2d(models).T)
+    res = logPositionPrior(xS) + logPositionPrior(yS) + logMagnitudePrior(gS)
+    res = res + logPositionPrior(xL) + logPositionPrior(yL)
+    res = res + logRadiusPrior(bL)
+    return res
+
+def getImages_batch(models):
+    """return the SIS images of an array of models as a padded array of shape (nwalkers,2,3) and the image counts"""
+    (xS,yS,gS,bL,xL,yL) = tuple(np.atleast_2d(models).T[:,:,None])
+    phiI,rI,n = sis.solveBatch(xS[:,0],yS[:,0])
+    magI = gS - 2.5 * np.log10(np.abs(sis.magnification(rI,phiI)))
+    return np.stack([bL*rI*np.cos(phiI)+xL,bL*rI*np.sin(phiI)+yL,magI],axis=-1),n
+
+def log_likelihood_batch(models,data,match=False,detection=None):
+    """Return log10 (normalized) likelihood for an array of models of shape (nwalkers,6)"""
+    images,n = getImages_batch(models)
+    return asLensData(data).logpdf(images,n,match,detection)
+
+def log_posterior_batch(models,data,match=False,detection=None):
+    """
+    Return the log10 posterior for an array of models of shape (nwalkers,6),
+    to be used with emcee.EnsembleSampler(...,vectorize=True)
+    match, detection : permutation-invariant image matching, see LensData.logpdf
+    images outside the cut (r<=0) are not counted, unlike in log_posterior
+    """
+    models = np.atleast_2d(models)
+    res = log_prior_batch(models)
+    ok = np.isfinite(res)
+    res[~ok] = -np.inf
+    res[ok] = res[ok] + log_likelihood_batch(models[ok],data,match,detection)
+    return res
+
+def grad_log_prior(model):
+    """Return the gradient of log10 of the priors"""
+    (xS,yS,gS,bL,xL,yL) = tuple(model)
+    res = np.array([-xS/0.01,-yS/0.01,9/(gS-5)-1,2/bL-1,-xL/0.01,-yL/0.01])
+    return res/np.log(10)
+
+def getImages_jac(model):
+    """return the SIS images of model, of shape (k,3), and their derivatives with respect to the model parameters, of shape (k,3,6)"""
+    (xS,yS,gS,bL,xL,yL) = tuple(model)
+    # the images of the batched solver, as used by the batched posterior
+    phiI,rI,n = sis.solveBatch(xS,yS)
+    phiI,rI = phiI[0,:n[0]],rI[0,:n[0]]
+    k = sis.kappa(rI,phiI)
+    dphi,dr,dk = sis.imageDerivatives(rI,phiI,xS,yS)
+    c,s,r = np.cos(phiI)[:,None],np.sin(phiI)[:,None],rI[:,None]
+    images = np.stack([bL*rI*np.cos(phiI)+xL,bL*rI*np.sin(phiI)+yL,gS+2.5*np.log10(np.abs(1-2*k))],axis=-1)
+    jac = np.zeros((len(rI),3,6))
+    jac[:,0,0:2] = bL*(dr*c-r*s*dphi)
+    jac[:,1,0:2] = bL*(dr*s+r*c*dphi)
+    jac[:,2,0:2] = -5/np.log(10)*dk/(1-2*k)[:,None]
+    jac[:,2,2] = 1
+    jac[:,0,3] = rI*c[:,0]
+    jac[:,1,3] = rI*s[:,0]
+    jac[:,0,4] = 1
+    jac[:,1,5] = 1
+    return images,jac
+
+def log_posterior_and_grad(model,data):
+    """Return the log10 posterior and its gradient with respect to the model parameters"""
+    data = asLensData(data)
+    logprior = log_prior_batch(model)[0]
+    if not np.isfinite(logprior) :
+        return -np.inf,np.zeros(len(model))
+    images,jac = getImages_jac(model)
+    if len(images)!=len(data) :
+        return -np.inf,np.zeros(len(model))
+    logl = data.logpdf(images[None],[len(images)])[0]
+    return logprior+logl,grad_log_prior(model)+data.gradient(images,jac)
+
+def grad_log_posterior(model,data):
+    """Return the gradient of the log10 posterior with respect to the model parameters"""
+    return log_posterior_and_grad(model,data)[1]
@@ -40,39 +40,124 @@ def getImages_pm(model):
     (xS,yS,dxS,dyS,gS,bL,xL,yL) = tuple(model)
     phiI,rI = sis.solve(xS,yS)
     
-    # images magnitude    
-    magI = gS - 2.5 * np.log10(np.abs(sis.magnification(rI,phiI)))
-    
-    # images proper motion
-    dxI = [] 
-    dyI = []
-    for phi,r in zip(phiI,rI) :
-        dx = np.dot(np.linalg.inv(sis.A(r,phi)),np.array([dxS,dyS]))
-        dxI.append(dx[0])
-        dyI.append(dx[1])
+    # images magnitude and proper motion
+    mu,dxI,dyI = sis.imageKinematics(rI,phiI,dxS,dyS)
+    magI = gS - 2.5 * np.log10(np.abs(mu))
     
     res = []
     for phi,r,dx,dy,g in zip(phiI,rI,dxI,dyI,magI):
         res.append([bL*r*np.cos(phi)+xL,bL*r*np.sin(phi)+yL,dx,dy,g])
     return res
     
-def log_likelihood_pm(model,data) :
-    """return log10 (normalized) likelihood for model and data with proper motion"""
-    functions = []
-    for s in data :
-        functions.append(imageLikelyhood_pm(s))
-    images = getImages_pm(model)
-    
-    if(len(images)==len(functions)): # probably a very bad idea
-        res = []
-        for point,f in zip(images,functions):
-            res.append(f.logpdf(point)/np.log(10))
-        return sum(res)
-    else :
-        return -np.inf
-
-def log_posterior_pm(model,data) :
+def log_likelihood_pm(model,data,match=False,detection=None) :
+    """return log10 (normalized) likelihood for model and data with proper motion
+    data : LensData or array of x,y,dx,dy,g,xe,ye,dxe,dye,ge rows
+    """
+    images = np.array(getImages_pm(model)).reshape(1,-1,5)
+    return asLensData(data).logpdf(images,[images.shape[1]],match,detection)[0]
+
+def log_posterior_pm(model,data,match=False,detection=None) :
     """return the log 10 posterior prior for model and data with proper motion"""
     logprior = log_prior_pm(model)
-    res = logprior + log_likelihood_pm(model,data) if np.isfinite(logprior) else -np.inf
-    return np.array(res)
\ No newline at end of file
+    res = logprior + log_likelihood_pm(model,data,match,detection) if np.isfinite(logprior) else -np.inf
+    return np.array(res)
+
+def logPmPrior(x):
+    """log10 of the SIS L-S proper motion prior"""
+    return (-0.5*np.power(x/0.5,2) - np.log(0.5*np.sqrt(2*np.pi)))/np.log(10)
+
+def log_prior_pm_batch(models):
+    """Return log10 of all the priors for an array of models with proper motion of shape (nwalkers,8)"""
+    (xS,yS,dxS,dyS,gS,bL,xL,yL) = tuple(np.atleast_2d(models).T)
+    res = logPositionPrior(xS) + logPositionPrior(yS) + logMagnitudePrior(gS)
+    res = res + logPmPrior(dxS) + logPmPrior(dyS)
+    res = res + logPositionPrior(xL) + logPositionPrior(yL)
+    res = res + logRadiusPrior(bL)
+    return res
+
+def getImages_pm_batch(models):
+    """return the SIS images of an array of models with proper motion as a padded array of shape (nwalkers,2,5) and the image counts"""
+    (xS,yS,dxS,dyS,gS,bL,xL,yL) = tuple(np.atleast_2d(models).T[:,:,None])
+    phiI,rI,n = sis.solveBatch(xS[:,0],yS[:,0])
+
+    # images magnitude and proper motion
+    mu,dxI,dyI = sis.imageKinematics(rI,phiI,dxS,dyS)
+    magI = gS - 2.5 * np.log10(np.abs(mu))
+
+    return np.stack([bL*rI*np.cos(phiI)+xL,bL*rI*np.sin(phiI)+yL,dxI,dyI,magI],axis=-1),n
+
+def log_likelihood_pm_batch(models,data,match=False,detection=None):
+    """return log10 (normalized) likelihood for an array of models with proper motion of shape (nwalkers,8)"""
+    images,n = getImages_pm_batch(models)
+    return asLensData(data).logpdf(images,n,match,detection)
+
+def log_posterior_pm_batch(models,data,match=False,detection=None):
+    """
+    return the log10 posterior for an array of models with proper motion of shape (nwalkers,8),
+    to be used with emcee.EnsembleSampler(...,vectorize=True)
+    match, detection : permutation-invariant image matching, see LensData.logpdf
+    """
+    models = np.atleast_2d(models)
+    res = log_prior_pm_batch(models)
+    ok = np.isfinite(res)
+    res[~ok] = -np.inf
+    res[ok] = res[ok] + log_likelihood_pm_batch(models[ok],data,match,detection)
+    return res
+
+def grad_log_prior_pm(model):
+    """Return the gradient of log10 of all the priors for model with proper motion"""
+    (xS,yS,dxS,dyS,gS,bL,xL,yL) = tuple(model)
+    res = np.array([-xS/0.01,-yS/0.01,-dxS/0.25,-dyS/0.25,9/(gS-5)-1,2/bL-1,-xL/0.01,-yL/0.01])
+    return res/np.log(10)
+
+def getImages_pm_jac(model):
+    """
+    return the SIS images of model with proper motion, of shape (k,5),
+    and their derivatives with respect to the model parameters, of shape (k,5,8)
+    """
+    (xS,yS,dxS,dyS,gS,bL,xL,yL) = tuple(model)
+    # the images of the batched solver, as used by the batched posterior
+    phiI,rI,n = sis.solveBatch(xS,yS)
+    phiI,rI = phiI[0,:n[0]],rI[0,:n[0]]
+    k = sis.kappa(rI,phiI)[:,None]
+    dphi,dr,dk = sis.imageDerivatives(rI,phiI,xS,yS)
+    c,s,r = np.cos(phiI)[:,None],np.sin(phiI)[:,None],rI[:,None]
+
+    # images proper motion w = A^-1 v = (v - 2 kappa (e.v) e)/(1 - 2 kappa) with e = (cos phi, sin phi)
+    v = np.array([dxS,dyS])
+    e = np.concatenate([c,s],axis=1)
+    eT = np.concatenate([-s,c],axis=1)
+    p = e.dot(v)[:,None]
+    w = (v-2*k*p*e)/(1-2*k)
+    dwdk = 2*(v-p*e)/np.power(1-2*k,2)
+    dwdphi = -2*k*(eT.dot(v)[:,None]*e+p*eT)/(1-2*k)
+
+    images = np.concatenate([bL*r*c+xL,bL*r*s+yL,w,gS+2.5*np.log10(np.abs(1-2*k))],axis=1)
+    jac = np.zeros((len(rI),5,8))
+    jac[:,0,0:2] = bL*(dr*c-r*s*dphi)
+    jac[:,1,0:2] = bL*(dr*s+r*c*dphi)
+    jac[:,2:4,0:2] = dwdk[:,:,None]*dk[:,None,:] + dwdphi[:,:,None]*dphi[:,None,:]
+    jac[:,2:4,2:4] = (np.eye(2)-2*k[:,:,None]*e[:,:,None]*e[:,None,:])/(1-2*k)[:,:,None]
+    jac[:,4,0:2] = -5/np.log(10)*dk/(1-2*k)
+    jac[:,4,4] = 1
+    jac[:,0,5] = r[:,0]*c[:,0]
+    jac[:,1,5] = r[:,0]*s[:,0]
+    jac[:,0,6] = 1
+    jac[:,1,7] = 1
+    return images,jac
+
+def log_posterior_pm_and_grad(model,data):
+    """return the log10 posterior for model and data with proper motion and its gradient with respect to the model parameters"""
+    data = asLensData(data)
+    logprior = log_prior_pm_batch(model)[0]
+    if not np.isfinite(logprior) :
+        return -np.inf,np.zeros(len(model))
+    images,jac = getImages_pm_jac(model)
+    if len(images)!=len(data) :
+        return -np.inf,np.zeros(len(model))
+    logl = data.logpdf(images[None],[len(images)])[0]
+    return logprior+logl,grad_log_prior_pm(model)+data.gradient(images,jac)
+
+def grad_log_posterior_pm(model,data):
+    """return the gradient of the log10 posterior for model and data with proper motion"""
+    return log_posterior_pm_and_grad(model,data)[1]
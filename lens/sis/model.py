@@ -33,6 +33,20 @@ def A(r,phi):
     A22 = 1-2*kappa(r,phi)*np.power(np.cos(phi),2)
     return np.array([[A11,A12],[A12,A22]])
 
+def imageKinematics(r,phi,dy1,dy2):
+    """
+    SIS image magnifications and proper motions w = A^-1 dy, batched over any array shape
+    with the closed form A^-1 = (I - 2 kappa e e^T)/(1 - 2 kappa), e = (cos phi, sin phi)
+    r,phi : angular polar coordinate of the images
+    dy1,dy2 : source proper motion relative to the lens
+    return : mu,dx1,dx2 the magnifications and the image proper motions
+    """
+    c,s = np.cos(phi),np.sin(phi)
+    k2 = 2*kappa(r,phi)
+    mu = 1/(1-k2)
+    p = k2*(c*dy1+s*dy2)
+    return mu,(dy1-p*c)*mu,(dy2-p*s)*mu
+
 def alpha(phi):
     """SIS deflection angle"""
     return np.array([np.cos(phi),np.sin(phi)])
@@ -86,4 +100,65 @@ def solve(y1,y2) :
         phiI.append(root%(2*np.pi))
     phiI = np.array(phiI)
     rI = radius(phiI,y1,y2)
-    return phiI,rI
\ No newline at end of file
+    return phiI,rI
+
+def solveBatch(y1,y2) :
+    """ solve SIS lens equation for many sources at once
+    the images lie along the source direction, at phi0 = atan2(y2,y1) with r = 1+|y|
+    and at phi0+pi with r = 1-|y|, the latter only when the source is inside the cut (|y|<1)
+    y1,y2 : arrays of relative source position with respect to the lens
+    return : phi,r,n padded image positions in polar coordinate as arrays of shape (N,2)
+             ordered by increasing phi in [0,2pi) as in solve, nan beyond the n images of each source
+    """
+    y1 = np.atleast_1d(np.asarray(y1,dtype=float))
+    y2 = np.atleast_1d(np.asarray(y2,dtype=float))
+    rho = np.hypot(y1,y2)
+    phi0 = np.arctan2(y2,y1)%(2*np.pi)
+    phiI = np.stack([phi0,(phi0+np.pi)%(2*np.pi)],axis=-1)
+    rI = np.stack([1+rho,1-rho],axis=-1)
+    valid = rI>0
+    # order the images by increasing phi
+    order = np.argsort(np.where(valid,phiI,np.inf),axis=-1)
+    phiI = np.take_along_axis(phiI,order,axis=-1)
+    rI = np.take_along_axis(rI,order,axis=-1)
+    valid = np.take_along_axis(valid,order,axis=-1)
+    phiI[~valid] = np.nan
+    rI[~valid] = np.nan
+    return phiI,rI,valid.sum(axis=-1)
+
+def eq2Partials(phi,y1,y2) :
+    """
+    partial derivatives of the SIS lens equation eq2
+    return : d/dphi, d/dy1, d/dy2
+    """
+    return y1*np.cos(phi)+y2*np.sin(phi),np.sin(phi),-np.cos(phi)
+
+def radiusPartials(phi,y1,y2) :
+    """
+    partial derivatives of the SIS lens equation radius
+    return : d/dphi, d/dy1, d/dy2
+    """
+    return -y1*np.sin(phi)+y2*np.cos(phi),np.cos(phi),np.sin(phi)
+
+def kappaPartials(r,phi) :
+    """
+    partial derivatives of the SIS dimensionless surface mass density kappa
+    return : d/dr, d/dphi
+    """
+    return -kappa(r,phi)/r,0*phi
+
+def imageDerivatives(r,phi,y1,y2) :
+    """
+    derivatives of the image position and of kappa with respect to the source position
+    the image angle follows the lens equation eq2(phi,y1,y2)=0 (implicit function theorem)
+    r,phi : image polar coordinates, solutions of the lens equation
+    y1,y2 : source location
+    return : dphi,dr,dkappa arrays of shape r.shape+(2,) with the derivatives with respect to y1,y2
+    """
+    e = eq2Partials(phi,y1,y2)
+    dphi = np.stack([-e[1]/e[0],-e[2]/e[0]],axis=-1)
+    rp = radiusPartials(phi,y1,y2)
+    dr = rp[0][...,None]*dphi + np.stack(rp[1:],axis=-1)
+    kp = kappaPartials(r,phi)
+    dkappa = kp[0][...,None]*dr + kp[1][...,None]*dphi
+    return dphi,dr,dkappa
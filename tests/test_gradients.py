@@ -0,0 +1,62 @@
+"""
+the analytic gradients of the posteriors (used by lens.hmc) must describe the same posterior
+as the batched posteriors used by the campaign and the screen
+"""
+
+import numpy as np
+import pytest
+
+import lens.sis.inference as sisI
+import lens.sis.inferencePM as sisPM
+import lens.sie.inference as sieI
+import lens.sie.inferencePM as siePM
+
+# model : (batched posterior, images, posterior and gradient, truth)
+MODELS = {
+    'sis' : (sisI.log_posterior_batch,sisI.getImages_batch,sisI.log_posterior_and_grad,
+             [0.05,-0.03,19.,1.,0.01,0.02]),
+    'sis_pm' : (sisPM.log_posterior_pm_batch,sisPM.getImages_pm_batch,sisPM.log_posterior_pm_and_grad,
+                [0.05,-0.03,0.2,-0.1,19.,1.,0.01,0.02]),
+    'sie' : (sieI.log_posterior_batch,sieI.getImages_batch,sieI.log_posterior_and_grad,
+             [0.02,0.01,19.,1.,0.6,0.01,0.02,0.5]),
+    'sie_pm' : (siePM.log_posterior_pm_batch,siePM.getImages_pm_batch,siePM.log_posterior_pm_and_grad,
+                [0.02,0.01,0.2,-0.1,19.,1.,0.6,0.01,0.02,0.5]),
+}
+
+
+def _data(images,n,error=0.01):
+    images = images[0,:n[0]]
+    return np.hstack([images,np.full(images.shape,error)])
+
+def _points(truth,rng,npoint=300):
+    """random points around the truth, many of them with another image count"""
+    truth = np.array(truth)
+    return truth+rng.normal(0,0.05,(npoint,len(truth)))*np.maximum(np.abs(truth),0.1)
+
+
+@pytest.mark.parametrize('model',sorted(MODELS))
+def test_value_matches_batch(model):
+    batch,images,andGrad,truth = MODELS[model]
+    rng = np.random.default_rng(0)
+    data = _data(*images(np.array(truth)[None,:]))
+    points = _points(truth,rng)
+    expected = batch(points,data)
+    values = np.array([andGrad(x,data)[0] for x in points])
+    assert np.isfinite(expected).sum() > 10
+    assert np.array_equal(np.isfinite(values),np.isfinite(expected))
+    ok = np.isfinite(expected)
+    np.testing.assert_allclose(values[ok],expected[ok],rtol=1e-8,atol=1e-8)
+
+@pytest.mark.parametrize('model',sorted(MODELS))
+def test_gradient_matches_finite_differences(model):
+    batch,images,andGrad,truth = MODELS[model]
+    rng = np.random.default_rng(1)
+    data = _data(*images(np.array(truth)[None,:]))
+    points = _points(truth,rng,50)
+    points = points[np.isfinite(batch(points,data))][:5]
+    h = 1e-6
+    for x in points :
+        value,grad = andGrad(x,data)
+        step = h*np.eye(len(x))
+        numeric = (batch(x+step,data)-batch(x-step,data))/(2*h)
+        np.testing.assert_allclose(grad,numeric,rtol=1e-4,atol=1e-3*max(1,abs(value)*1e-6))
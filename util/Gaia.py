@@ -15,16 +15,253 @@ Created on 30 jun. 2016
 
 """
 
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import tempfile
+import http.client
+import numpy as np
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from astroquery.utils.tap import TapPlus
 from astroquery.utils import commons
 from astropy import units
 from astropy.units import Quantity
+from astropy.table import Table, vstack
 
-__all__ = ['Gaia', 'GaiaClass']
+__all__ = ['Gaia', 'GaiaClass', 'QueryCache', 'CacheMissError', 'JobManager',
+           'JobFailedError', 'pixel_slice_queries']
 
 MAIN_GAIA_TABLE = "gaiadr2.gaia_source"
 MAIN_GAIA_TABLE_RA = "ra"
 MAIN_GAIA_TABLE_DEC = "dec"
+UPLOAD_TABLE_NAME = "targets"
+
+try:
+    import pyarrow
+    CACHE_FORMAT = "parquet"
+except ImportError:
+    CACHE_FORMAT = "fits"
+
+# quoted ADQL literals and delimited identifiers, kept verbatim by the normalization
+_QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+_OPERATORS = re.compile(r"\s*([(),=<>+\-*/|])\s*")
+
+
+class CacheMissError(LookupError):
+    """Raised in offline mode when a query is not in the cache"""
+
+
+class JobFailedError(RuntimeError):
+    """Raised when an asynchronous job still fails after its retries"""
+
+
+class CachedJob(object):
+
+    """
+    Completed job replayed from the query cache
+    """
+
+    def __init__(self, query, results, async_job=False):
+        self.query = query
+        self.results = results
+        self.async_ = async_job
+        self.jobid = None
+
+    def get_results(self):
+        """Returns the cached results (astropy.table)"""
+        return self.results
+
+    def is_finished(self):
+        return True
+
+    def get_phase(self):
+        return "COMPLETED"
+
+    def __str__(self):
+        return "Cached job\nQuery: " + str(self.query) + \
+            "\nNum. results: " + str(len(self.results))
+
+
+class QueryCache(object):
+
+    """
+    On-disk cache of query results
+
+    each entry is a columnar file (parquet, or FITS when pyarrow is not
+    available) named after a hash of the normalized ADQL, the output format
+    and the uploaded table, with a json file recording the query and its
+    creation and last access times.
+
+    Parameters
+    ----------
+    cache_dir : str, mandatory
+        directory of the cache files
+    ttl : float, optional, default None
+        time to live of an entry in seconds, None for no expiry
+    max_size : int, optional, default None
+        maximum total size of the cached results in bytes, the least
+        recently used entries are evicted first, None for no limit
+    """
+
+    def __init__(self, cache_dir, ttl=None, max_size=None):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def normalize(query):
+        """Returns the query with the whitespace collapsed and the keywords
+        and identifiers in lower case, the quoted parts being kept"""
+        parts = _QUOTED.split(query.strip().rstrip(";"))
+        for i in range(0, len(parts), 2):
+            part = re.sub(r"\s+", " ", parts[i]).lower()
+            parts[i] = _OPERATORS.sub(r"\1", part)
+        return "".join(parts).strip()
+
+    def key(self, query, output_format="votable", upload_resource=None,
+            upload_table_name=None):
+        """Returns the cache key of a query
+
+        Parameters
+        ----------
+        query : str, mandatory
+            ADQL query
+        output_format : str, optional, default 'votable'
+            results format
+        upload_resource: str or astropy.table, optional, default None
+            uploaded resource, the key depends on its content
+        upload_table_name: str, optional, default None
+            uploaded table name
+        """
+        h = hashlib.sha256()
+        h.update(self.normalize(query).encode())
+        h.update(("\n" + str(output_format).lower()).encode())
+        if upload_resource is not None:
+            h.update(("\n" + str(upload_table_name)).encode())
+            if isinstance(upload_resource, Table):
+                for name in upload_resource.colnames:
+                    h.update(name.encode())
+                    h.update(np.asarray(upload_resource[name]).tobytes())
+            elif os.path.isfile(str(upload_resource)):
+                with open(upload_resource, "rb") as fp:
+                    h.update(fp.read())
+            else:
+                h.update(str(upload_resource).encode())
+        return h.hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.cache_dir, key + "." + CACHE_FORMAT)
+
+    def __info(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def __read_info(self, key):
+        try:
+            with open(self.__info(key)) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def __write_info(self, key, info):
+        tmp = self.__info(key) + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump(info, fp)
+        os.replace(tmp, self.__info(key))
+
+    def __contains__(self, key):
+        info = self.__read_info(key)
+        return info is not None and not self.__expired(info) and \
+            os.path.exists(self.__path(key))
+
+    def __expired(self, info):
+        return self.ttl is not None and time.time() - info["created"] > self.ttl
+
+    def get(self, key):
+        """Returns the cached results of key (astropy.table), None when
+        missing or expired"""
+        info = self.__read_info(key)
+        if info is None or not os.path.exists(self.__path(key)):
+            return None
+        if self.__expired(info):
+            self.remove(key)
+            return None
+        if CACHE_FORMAT == "fits":
+            # FITS stores big-endian numbers and byte strings
+            results = Table.read(self.__path(key), format="fits",
+                                 character_as_bytes=False)
+            for col in results.itercols():
+                if col.dtype.byteorder == ">":
+                    results[col.name] = col.astype(
+                        col.dtype.newbyteorder("="))
+        else:
+            results = Table.read(self.__path(key), format=CACHE_FORMAT)
+        info["accessed"] = time.time()
+        self.__write_info(key, info)
+        return results
+
+    def put(self, key, results, query=None, output_format=None):
+        """Stores results (astropy.table) under key and evicts the expired
+        and least recently used entries"""
+        path = self.__path(key)
+        tmp = path + ".tmp"
+        results.write(tmp, format=CACHE_FORMAT, overwrite=True)
+        os.replace(tmp, path)
+        now = time.time()
+        self.__write_info(key, {"query": query, "output_format": output_format,
+                                "created": now, "accessed": now})
+        self.evict()
+
+    def remove(self, key):
+        """Removes an entry"""
+        for path in (self.__path(key), self.__info(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def entries(self):
+        """Returns the list of (key, info, size in bytes) of the entries"""
+        res = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                key = name[:-5]
+                info = self.__read_info(key)
+                path = self.__path(key)
+                if info is not None and os.path.exists(path):
+                    res.append((key, info, os.path.getsize(path)))
+        return res
+
+    def evict(self):
+        """Removes the expired entries, then the least recently used ones
+        until the total size is below max_size"""
+        entries = []
+        for key, info, size in self.entries():
+            if self.__expired(info):
+                self.remove(key)
+            else:
+                entries.append((info["accessed"], key, size))
+        if self.max_size is None:
+            return
+        entries.sort()
+        total = sum(size for accessed, key, size in entries)
+        for accessed, key, size in entries:
+            if total <= self.max_size:
+                break
+            self.remove(key)
+            total -= size
+
+    def clear(self):
+        """Removes all the entries"""
+        for key, info, size in self.entries():
+            self.remove(key)
+
+    def __len__(self):
+        return len(self.entries())
 
 
 class GaiaClass(object):
@@ -33,11 +270,59 @@ class GaiaClass(object):
     Proxy class to default TapPlus object (pointing to Gaia Archive)
     """
 
-    def __init__(self, tap_plus_handler=None):
+    def __init__(self, tap_plus_handler=None, cache_dir=None, cache_ttl=None,
+                 cache_max_size=None, offline=False):
+        """
+        Parameters
+        ----------
+        tap_plus_handler : TapPlus, optional, default None
+            TAP handler, default the Gaia archive
+        cache_dir : str, optional, default None
+            directory of the query cache, None for no cache
+        cache_ttl : float, optional, default None
+            time to live of the cached results in seconds
+        cache_max_size : int, optional, default None
+            maximum size of the cache in bytes
+        offline : bool, optional, default 'False'
+            if True the results are only served from the cache, a query not
+            in the cache raising CacheMissError
+        """
         if tap_plus_handler is None:
             self.__gaiatap = TapPlus(url="http://gea.esac.esa.int/tap-server/tap")
         else:
             self.__gaiatap = tap_plus_handler
+        if offline and cache_dir is None:
+            raise ValueError("Offline mode requires a cache_dir")
+        self.cache = None if cache_dir is None else \
+            QueryCache(cache_dir, cache_ttl, cache_max_size)
+        self.offline = offline
+
+    def __cached_job(self, launch, query, output_format, upload_resource,
+                     upload_table_name, async_job, cacheable=True):
+        """Returns the cached job of query, or launches it and caches its
+        results. Jobs dumped to file or run in background are not cached."""
+        if self.cache is None:
+            return launch()
+        if not cacheable:
+            if self.offline:
+                raise CacheMissError("Jobs dumped to file or run in background "
+                                     "are not cached (offline mode)")
+            return launch()
+        key = self.cache.key(query, output_format, upload_resource,
+                             upload_table_name)
+        results = self.cache.get(key)
+        if results is not None:
+            return CachedJob(query, results, async_job)
+        if self.offline:
+            raise CacheMissError("Query not in cache (offline mode): " + query)
+        job = launch()
+        self.cache.put(key, job.get_results(), query, output_format)
+        return job
+
+    def clear_cache(self):
+        """Removes all the cached results"""
+        if self.cache is not None:
+            self.cache.clear()
 
     def load_tables(self, only_names=False, include_shared_tables=False,
                     verbose=False):
@@ -105,9 +390,9 @@ class GaiaClass(object):
 
         Returns
         -------
-        A Job object
+        A Job object, or a CachedJob when the results are in the cache
         """
-        return self.__gaiatap.launch_job(query,
+        launch = lambda: self.__gaiatap.launch_job(query,
                                               name=name,
                                               output_file=output_file,
                                               output_format=output_format,
@@ -115,6 +400,9 @@ class GaiaClass(object):
                                               dump_to_file=dump_to_file,
                                               upload_resource=upload_resource,
                                               upload_table_name=upload_table_name)
+        return self.__cached_job(launch, query, output_format, upload_resource,
+                                 upload_table_name, async_job=False,
+                                 cacheable=not dump_to_file)
 
     def launch_job_async(self, query, name=None, output_file=None,
                          output_format="votable", verbose=False,
@@ -146,9 +434,9 @@ class GaiaClass(object):
 
         Returns
         -------
-        A Job object
+        A Job object, or a CachedJob when the results are in the cache
         """
-        return self.__gaiatap.launch_job_async(query,
+        launch = lambda: self.__gaiatap.launch_job_async(query,
                                                name=name,
                                                output_file=output_file,
                                                output_format=output_format,
@@ -157,6 +445,9 @@ class GaiaClass(object):
                                                background=background,
                                                upload_resource=upload_resource,
                                                upload_table_name=upload_table_name)
+        return self.__cached_job(launch, query, output_format, upload_resource,
+                                 upload_table_name, async_job=True,
+                                 cacheable=not (dump_to_file or background))
 
     def load_async_job(self, jobid=None, name=None, verbose=False):
         """Loads an asynchronous job
@@ -175,7 +466,8 @@ class GaiaClass(object):
         -------
         A Job object
         """
-        return self.__gaiatap.load_async_job(jobid, name, verbose)
+        return self.__gaiatap.load_async_job(jobid=jobid, name=name,
+                                             verbose=verbose)
 
     def search_async_jobs(self, jobfilter=None, verbose=False):
         """Searches for jobs applying the specified filter
@@ -256,9 +548,9 @@ class GaiaClass(object):
                 + str(heightDeg.value)+"))=1 \
                 ORDER BY dist ASC"
             if async_job:
-                job = self.__gaiatap.launch_job_async(query, verbose=verbose)
+                job = self.launch_job_async(query, verbose=verbose)
             else:
-                job = self.__gaiatap.launch_job(query, verbose=verbose)
+                job = self.launch_job(query, verbose=verbose)
         return job.get_results()
 
     def query_object(self, coordinate, radius=None, width=None, height=None,
@@ -368,18 +660,18 @@ class GaiaClass(object):
             CIRCLE('ICRS',"+str(ra)+","+str(dec)+", "+str(radiusDeg)+"))=1 \
             ORDER BY dist ASC"
         if async_job:
-            return self.__gaiatap.launch_job_async(query=query,
+            return self.launch_job_async(query=query,
                                          output_file=output_file,
                                          output_format=output_format,
                                          verbose=verbose,
                                          dump_to_file=dump_to_file,
                                          background=background)
         else:
-            return self.__gaiatap.launch_job(query=query,
-                                        output_file=output_file,
-                                        output_format=output_format,
-                                        verbose=verbose,
-                                        dump_to_file=dump_to_file)
+            return self.launch_job(query=query,
+                                   output_file=output_file,
+                                   output_format=output_format,
+                                   verbose=verbose,
+                                   dump_to_file=dump_to_file)
 
     def cone_search(self, coordinate, radius=None, output_file=None,
                     output_format="votable", verbose=False,
@@ -454,6 +746,98 @@ class GaiaClass(object):
                                   verbose=verbose,
                                   dump_to_file=dump_to_file)
 
+    def __targets_table(self, targets, target_id=None):
+        """Returns the targets as a table of target_id, ra and dec (deg)"""
+        if isinstance(targets, commons.CoordClasses):
+            coord = targets.icrs
+            ra, dec = np.atleast_1d(coord.ra.deg), np.atleast_1d(coord.dec.deg)
+            ids = np.arange(len(ra))
+        else:
+            ra = np.asarray(targets[MAIN_GAIA_TABLE_RA], dtype=float)
+            dec = np.asarray(targets[MAIN_GAIA_TABLE_DEC], dtype=float)
+            ids = np.arange(len(ra)) if target_id is None else \
+                np.asarray(targets[target_id])
+        return Table([ids, ra, dec], names=["target_id", "ra", "dec"])
+
+    def __cone_search_many_query(self, radius_deg, columns=None):
+        """Returns the ADQL of a cone search around the uploaded targets"""
+        if columns is None:
+            columns = ["*"]
+        select = ", ".join(c if ("(" in c or "." in c) else "g." + c
+                           for c in columns)
+        return "SELECT t.target_id, DISTANCE(POINT('ICRS', g." + \
+            str(MAIN_GAIA_TABLE_RA) + ", g." + str(MAIN_GAIA_TABLE_DEC) + \
+            "), POINT('ICRS', t.ra, t.dec)) AS dist, " + select + \
+            " FROM " + str(MAIN_GAIA_TABLE) + " AS g JOIN tap_upload." + \
+            UPLOAD_TABLE_NAME + " AS t ON 1=CONTAINS(POINT('ICRS', g." + \
+            str(MAIN_GAIA_TABLE_RA) + ", g." + str(MAIN_GAIA_TABLE_DEC) + \
+            "), CIRCLE('ICRS', t.ra, t.dec, " + str(radius_deg) + \
+            ")) ORDER BY t.target_id, dist ASC"
+
+    def __upload_job(self, query, chunk, output_format, verbose):
+        """Launches the async job of one chunk of targets uploaded as a
+        votable file, returns its results"""
+        fd, path = tempfile.mkstemp(suffix=".xml")
+        os.close(fd)
+        try:
+            chunk.write(path, format="votable", overwrite=True)
+            job = self.launch_job_async(query, output_format=output_format,
+                                        verbose=verbose,
+                                        upload_resource=path,
+                                        upload_table_name=UPLOAD_TABLE_NAME)
+            return job.get_results()
+        finally:
+            os.remove(path)
+
+    def cone_search_many(self, targets, radius, columns=None, target_id=None,
+                         chunk_size=500, max_workers=4,
+                         output_format="votable", verbose=False):
+        """Cone searches around many targets sorted by target and distance
+        TAP+ only
+        The targets are uploaded by chunks, each chunk being one asynchronous
+        job joining the uploaded table with the Gaia table, the chunks are
+        run concurrently.
+
+        Parameters
+        ----------
+        targets : astropy.coordinates or table, mandatory
+            coordinates of the targets, or a table (astropy.table or pandas
+            DataFrame) with ra and dec columns in deg
+        radius : astropy.units, mandatory
+            radius
+        columns : list of str, optional, default None
+            Gaia columns of the results, default all
+        target_id : str, optional, default None
+            column of targets identifying the targets, default the row number
+        chunk_size : int, optional, default 500
+            number of targets per job
+        max_workers : int, optional, default 4
+            number of concurrent jobs
+        output_format : str, optional, default 'votable'
+            results format
+        verbose : bool, optional, default 'False'
+            flag to display information about the process
+
+        Returns
+        -------
+        The merged results (astropy.table) with target_id and dist columns.
+        """
+        table = self.__targets_table(targets, target_id)
+        radiusQuantity = self.__getQuantityInput(radius, "radius")
+        radiusDeg = radiusQuantity.to(units.deg).value
+        query = self.__cone_search_many_query(radiusDeg, columns)
+        chunks = [table[i:i+chunk_size] for i in range(0, len(table), chunk_size)]
+        if len(chunks) == 0:
+            return Table()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(
+                lambda chunk: self.__upload_job(query, chunk, output_format,
+                                                verbose), chunks))
+        # each job is sorted, the chunks are not when target_id are names
+        results = vstack(results, metadata_conflicts="silent")
+        results.sort(["target_id", "dist"])
+        return results
+
     def remove_jobs(self, jobs_list, verbose=False):
         """Removes the specified jobs
         TAP+
@@ -559,4 +943,224 @@ class GaiaClass(object):
             return value
 
 
+def pixel_slice_queries(level, pixels, columns=None, table=MAIN_GAIA_TABLE,
+                        where=None):
+    """Returns the queries of the sources of healpix pixels
+    the source_id encoding the NESTED level 12 pixel in its high bits, the
+    sources of a pixel at a coarser level are a source_id range.
+
+    Parameters
+    ----------
+    level : int, mandatory
+        healpix level of the pixels, at most 12
+    pixels : list of int, mandatory
+        NESTED pixel indices
+    columns : list of str, optional, default None
+        columns of the results, default all
+    table : str, optional, default gaiadr2.gaia_source
+        queried table
+    where : str, optional, default None
+        additional ADQL condition
+
+    Returns
+    -------
+    A dict name (hp<level>=<pixel>) -> query, see JobManager
+    """
+    select = "*" if columns is None else ", ".join(columns)
+    shift = 35 + 2 * (12 - level)
+    res = {}
+    for pixel in pixels:
+        query = "SELECT " + select + " FROM " + str(table) + \
+            " WHERE source_id >= " + str(int(pixel) << shift) + \
+            " AND source_id < " + str((int(pixel) + 1) << shift)
+        if where is not None:
+            query += " AND (" + where + ")"
+        res["hp%d=%d" % (level, pixel)] = query
+    return res
+
+
+class JobManager(object):
+
+    """
+    Asyncio manager of many asynchronous jobs
+
+    the jobs are launched in background with at most max_concurrent jobs at
+    once, polled with an exponential backoff, relaunched on transient
+    failures (HTTP, connection and IO errors, jobs ending in error) and
+    their results yielded as they complete. The job ids are persisted in a
+    json state file so that an interrupted run resumes the launched jobs
+    instead of launching them again. The blocking TAP calls run in threads.
+    The query cache of the GaiaClass, if any, is used.
+
+    Parameters
+    ----------
+    gaia : GaiaClass, optional, default Gaia
+        TAP proxy used to launch and load the jobs
+    max_concurrent : int, optional, default 4
+        maximum number of running jobs
+    poll_interval : float, optional, default 1
+        first delay between two polls of a job in seconds
+    max_poll_interval : float, optional, default 60
+        maximum delay between two polls in seconds
+    backoff : float, optional, default 2
+        factor of the delay between two polls and between two retries
+    max_retries : int, optional, default 3
+        number of relaunches of a failed job
+    state_file : str, optional, default None
+        json file of the job ids of each job name, None for no persistence
+    """
+
+    def __init__(self, gaia=None, max_concurrent=4, poll_interval=1.,
+                 max_poll_interval=60., backoff=2., max_retries=3,
+                 state_file=None):
+        self.gaia = Gaia if gaia is None else gaia
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.max_retries = max_retries
+        self.state_file = state_file
+        self.state = {}
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file) as fp:
+                self.state = json.load(fp)
+
+    def __save_state(self):
+        if self.state_file is None:
+            return
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump(self.state, fp, indent=1)
+        os.replace(tmp, self.state_file)
+
+    def __set_state(self, name, query, jobid, phase):
+        self.state[name] = {"query": query, "jobid": jobid, "phase": phase}
+        self.__save_state()
+
+    async def __wait(self, job):
+        """Polls job until it is finished, returns its final phase"""
+        delay = self.poll_interval
+        while True:
+            phase = await asyncio.to_thread(job.get_phase, update=True)
+            if phase in ("COMPLETED", "ERROR", "ABORTED"):
+                return phase
+            await asyncio.sleep(delay)
+            delay = min(delay * self.backoff, self.max_poll_interval)
+
+    async def run_job(self, name, query, **kwargs):
+        """Runs one job, resuming its persisted job id if any
+
+        Parameters
+        ----------
+        name : str, mandatory
+            job name, key of the state file
+        query : str, mandatory
+            query to be executed
+        kwargs : optional
+            arguments of GaiaClass.launch_job_async, e.g. output_format
+
+        Returns
+        -------
+        The job name and its results (astropy.table).
+        """
+        cache = getattr(self.gaia, "cache", None)
+        key = None
+        if cache is not None:
+            key = cache.key(query, kwargs.get("output_format", "votable"),
+                            kwargs.get("upload_resource"),
+                            kwargs.get("upload_table_name"))
+            results = cache.get(key)
+            if results is not None:
+                return name, results
+            if self.gaia.offline:
+                raise CacheMissError("Query not in cache (offline mode): " + query)
+        previous = self.state.get(name)
+        jobid = previous["jobid"] if previous is not None and \
+            previous["query"] == query and previous["phase"] != "ERROR" else None
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.poll_interval * self.backoff ** attempt)
+            try:
+                if jobid is None:
+                    job = await asyncio.to_thread(self.gaia.launch_job_async,
+                                                  query, background=True,
+                                                  **kwargs)
+                    jobid = job.jobid
+                else:
+                    job = await asyncio.to_thread(self.gaia.load_async_job,
+                                                  jobid=jobid)
+                    if job is None:
+                        raise JobFailedError("Job " + str(jobid) +
+                                             " not found")
+                self.__set_state(name, query, jobid, "EXECUTING")
+                phase = await self.__wait(job)
+                if phase != "COMPLETED":
+                    raise JobFailedError("Job " + str(jobid) + " " + phase)
+                results = await asyncio.to_thread(job.get_results)
+            except (JobFailedError, OSError, http.client.HTTPException,
+                    requests.exceptions.RequestException) as e:
+                error = e
+                if jobid is not None:
+                    self.__set_state(name, query, jobid, "ERROR")
+                jobid = None
+                continue
+            self.__set_state(name, query, jobid, "COMPLETED")
+            if key is not None:
+                cache.put(key, results, query, kwargs.get("output_format"))
+            return name, results
+        raise JobFailedError("Job " + str(name) + " failed after " +
+                             str(self.max_retries + 1) + " attempts: " +
+                             repr(error))
+
+    async def as_completed(self, queries, return_exceptions=False, **kwargs):
+        """Runs many jobs, yields their results as they complete
+
+        Parameters
+        ----------
+        queries : dict, mandatory
+            job name -> query, e.g. from pixel_slice_queries
+        return_exceptions : bool, optional, default 'False'
+            if True a failed job yields its name and the exception, otherwise
+            the exception is raised and the other jobs are cancelled
+        kwargs : optional
+            arguments of GaiaClass.launch_job_async
+
+        Returns
+        -------
+        An asynchronous iterator of (name, results).
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        async def bounded(name, query):
+            async with semaphore:
+                try:
+                    return await self.run_job(name, query, **kwargs)
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    return name, e
+
+        tasks = [asyncio.ensure_future(bounded(name, query))
+                 for name, query in queries.items()]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def gather(self, queries, **kwargs):
+        """Runs many jobs, returns a dict name -> results, see as_completed"""
+        res = {}
+        async for name, results in self.as_completed(queries, **kwargs):
+            res[name] = results
+        return res
+
+    def run(self, queries, **kwargs):
+        """Runs many jobs from synchronous code, returns a dict name -> results,
+        see as_completed (in a notebook use await gather instead)"""
+        return asyncio.run(self.gather(queries, **kwargs))
+
+
 Gaia = GaiaClass()